@@ -0,0 +1,54 @@
+#! /usr/bin/python3
+
+# Counts the objects the step engine allocates per simulation step: HasUnit
+# quantities (Pos, Speed, Accel) constructed and copy.deepcopy() calls.
+# A step is one resolution's worth of travel in one direction.
+#
+#   python allocbench.py [MAXSPEEDS_FILE] [RESOLUTION_F]
+
+from simulation import Simulation
+from convunits import HasUnit, Pos, Accel
+import copy
+import sys
+import time
+
+def count_allocations(filename, resolution):
+    counts = {"HasUnit": 0, "deepcopy": 0}
+
+    orig_init = HasUnit.__init__
+    def counting_init(self, *args, **kwargs):
+        counts["HasUnit"] += 1
+        orig_init(self, *args, **kwargs)
+
+    orig_deepcopy = copy.deepcopy
+    def counting_deepcopy(*args, **kwargs):
+        counts["deepcopy"] += 1
+        return orig_deepcopy(*args, **kwargs)
+
+    sim = Simulation(filename, Accel('1.25', "f/s^2"),
+            Pos(str(resolution), "f"), "imperial")
+    length = sum(seg.length().val() for seg in sim._track)
+    steps = 2 * int(length / resolution) # forwards and back
+
+    HasUnit.__init__ = counting_init
+    copy.deepcopy = counting_deepcopy
+    try:
+        start = time.perf_counter()
+        sim.run()
+        wall = time.perf_counter() - start
+    finally:
+        HasUnit.__init__ = orig_init
+        copy.deepcopy = orig_deepcopy
+    return steps, counts, wall
+
+if __name__ == "__main__":
+    filename = "sprinter_maxspeeds_stations.csv"
+    resolution = 66
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        resolution = int(sys.argv[2])
+    steps, counts, wall = count_allocations(filename, resolution)
+    print("{} steps in {:.3f} s".format(steps, wall))
+    for name, count in counts.items():
+        print("{}: {} ({:.2f} per step)".format(name, count, count / steps))
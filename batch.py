@@ -0,0 +1,245 @@
+#! /usr/bin/python3
+
+# Many input files in one trainspeedsim run:
+#
+#   trainspeedsim [OPTIONS] [-j JOBS] [-d OUTDIR] INPUT_FILE|DIR|GLOB...
+#
+# Directories stand for the .csv files in them, and globs are expanded (quote
+# them so the shell doesn't). The inputs are simulated on a process pool.
+# With -d each gets its own output file there; otherwise all the outputs go
+# to stdout (or -o), one after another, each line tagged with its input. A
+# summary of each input's time, or why it failed, goes to stderr.
+
+from simulation import Simulation
+from trackcache import gen_maxspeeds_files
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+# output is the input's output text (None with an outdir), error the
+# exception's message if it failed
+BatchResult = namedtuple("BatchResult", ["source", "points", "wall_time",
+    "cpu_time", "output", "error"])
+
+EXTENSIONS = {"csv": ".csv", "jsonl": ".jsonl", "binary": ".tscols",
+        "gnuplot": ".gp"}
+
+def expand_inputs(paths):
+    '''Input files for paths: globs expanded, in sorted order, and
+    directories replaced with their .csv files. A glob or directory that
+    comes to nothing stands for itself, so it fails like a missing file
+    rather than quietly dropping out.'''
+    for path in paths:
+        if glob.has_magic(path):
+            files = list(gen_maxspeeds_files(sorted(glob.glob(path))))
+        else:
+            files = list(gen_maxspeeds_files([path]))
+        if files:
+            yield from files
+        else:
+            yield path
+
+def unmatched(source):
+    '''Whether source is a glob or directory that expand_inputs() found no
+    input files for'''
+    return os.path.isdir(source) or \
+            (glob.has_magic(source) and not os.path.exists(source))
+
+def output_path(outdir, source, fmt):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(outdir, stem + EXTENSIONS[fmt])
+
+def _simulate_file(source, accel, resolution, units, engine, numeric, fmt,
+        outdir, cache_dir, results_dir, results_max):
+    '''Runs in a worker process'''
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    points = None
+    output = None
+    error = None
+    try:
+        if unmatched(source):
+            raise FileNotFoundError("No input files in {}".format(source))
+        cache = results = None
+        if cache_dir is not None:
+            from trackcache import TrackCache
+            cache = TrackCache(cache_dir)
+        if results_dir is not None:
+            from resultcache import ResultCache
+            results = ResultCache(results_dir, results_max)
+        sim = Simulation(source, accel, resolution, units, engine, numeric,
+                cache=cache, results=results)
+        sim.run()
+        points = len(sim.get_best_speeds())
+        if outdir is not None:
+            mode = "wb" if fmt == "binary" else "w"
+            with open(output_path(outdir, source, fmt), mode) as out:
+                sim.output(out, fmt)
+        else:
+            out = io.StringIO()
+            sim.output(out, fmt)
+            output = out.getvalue()
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    return BatchResult(source, points, time.perf_counter() - wall_start,
+            time.process_time() - cpu_start, output, error)
+
+def tag_output(output, source, fmt):
+    '''output's lines tagged with source: first in each csv line, as a
+    "source" in each jsonl object'''
+    if fmt == "csv":
+        prefix = source + ", "
+        return "".join(prefix + line for line in output.splitlines(True))
+    prefix = '{{"source": {}, '.format(json.dumps(source))
+    return "".join(prefix + line[1:] for line in output.splitlines(True))
+
+class BatchSimulation:
+    '''Simulates each of sources (files, directories or globs) with the same
+    settings on a process pool'''
+
+    def __init__(self, sources, accel, resolution, units, engine="step",
+            numeric="exact", fmt="csv", outdir=None, cache_dir=None,
+            results_dir=None, results_max=None):
+        if outdir is None and fmt not in ("csv", "jsonl"):
+            raise ValueError("format '{}' needs an outdir".format(fmt))
+        self._sources = list(expand_inputs(sources))
+        if outdir is not None:
+            names = [output_path(outdir, s, fmt) for s in self._sources
+                    if not unmatched(s)]
+            if len(set(names)) != len(names):
+                raise ValueError("two inputs would have the same output "\
+                        "file in {}".format(outdir))
+        self._params = (accel, resolution, units, engine, numeric, fmt,
+                outdir, cache_dir, results_dir, results_max)
+        self._fmt = fmt
+        self._outdir = outdir
+        self._results = []
+        self._wall_time = None
+        self._workers = None
+
+    def get_sources(self):
+        return self._sources
+
+    def run(self, max_workers=None, out=None):
+        '''Simulates every input on max_workers processes (default one per
+        CPU). Without an outdir, each input's tagged output is written to
+        out (default stdout) in input order as soon as it's ready, rather
+        than kept. Returns the BatchResults.'''
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if out is None and self._outdir is None:
+            out = sys.stdout
+        self._workers = max_workers
+        self._results = []
+        if self._outdir is not None:
+            os.makedirs(self._outdir, exist_ok=True)
+        wall_start = time.perf_counter()
+        if len(self._sources) > 0:
+            with ProcessPoolExecutor(max_workers=min(max_workers,
+                    len(self._sources))) as pool:
+                futures = [pool.submit(_simulate_file, source,
+                    *self._params) for source in self._sources]
+                for future in futures:
+                    result = future.result()
+                    if result.output is not None:
+                        out.write(tag_output(result.output, result.source,
+                            self._fmt))
+                        result = result._replace(output=None)
+                    self._results.append(result)
+        self._wall_time = time.perf_counter() - wall_start
+        return self._results
+
+    def get_results(self):
+        return self._results
+
+    def get_failures(self):
+        return [r for r in self._results if r.error is not None]
+
+    def output_summary(self, out=None):
+        '''Each input's time or error, then the totals'''
+        if out is None:
+            out = sys.stderr
+        width = max([6] + [len(r.source) for r in self._results])
+        out.write("{:<{}} {:>9} {:>9} {:>9}\n".format("input", width,
+            "points", "wall s", "CPU s"))
+        for r in self._results:
+            if r.error is None:
+                out.write("{:<{}} {:>9} {:>9.3f} {:>9.3f}\n".format(r.source,
+                    width, r.points, r.wall_time, r.cpu_time))
+            else:
+                out.write("{:<{}} FAILED {}\n".format(r.source, width,
+                    r.error))
+        busy = sum(r.wall_time for r in self._results)
+        out.write("{} inputs, {} failed, {:.3f} s on {} workers "\
+                "({:.3f} s of simulating)\n".format(len(self._results),
+                    len(self.get_failures()), self._wall_time or 0.0,
+                    self._workers, busy))
+
+
+import unittest
+
+class TestBatchSimulation(unittest.TestCase):
+    def test_combined_and_outdir(self):
+        import tempfile
+        from convunits import Accel, Pos
+        accel = Accel('1.25', "f/s^2")
+        res = Pos(528, "f")
+        sources = ["short_maxspeeds.csv", "sprinter_maxspeeds_stations.csv",
+                "no_such_file.csv"]
+        batch = BatchSimulation(sources, accel, res, "imperial",
+                "analytic", "float")
+        out = io.StringIO()
+        results = batch.run(2, out)
+        self.assertEqual([r.source for r in results], sources)
+        self.assertEqual([r.error is None for r in results],
+                [True, True, False])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), results[0].points + results[1].points)
+        expected = io.StringIO()
+        sim = Simulation(sources[1], accel, res, "imperial", "analytic",
+                "float")
+        sim.run()
+        sim.output(expected)
+        self.assertEqual(lines[results[0].points:], [sources[1] + ", " + \
+                line for line in expected.getvalue().splitlines()])
+        summary = io.StringIO()
+        batch.output_summary(summary)
+        self.assertIn("3 inputs, 1 failed", summary.getvalue())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outdir = os.path.join(tmpdir, "out")
+            batch = BatchSimulation(["*_maxspeeds*.csv"], accel, res,
+                    "imperial", "analytic", "float", "jsonl", outdir)
+            self.assertEqual(batch.get_sources(), ["short_maxspeeds.csv",
+                "sprinter_maxspeeds.csv", "sprinter_maxspeeds_stations.csv"])
+            batch.run(2)
+            self.assertEqual(batch.get_failures(), [])
+            with open(os.path.join(outdir,
+                "sprinter_maxspeeds_stations.jsonl")) as f:
+                self.assertEqual(len(f.readlines()), results[1].points)
+
+    def test_unmatched_inputs(self):
+        # used to drop out, leaving "0 inputs, 0 failed" and exit status 0
+        import tempfile
+        from convunits import Accel, Pos
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sources = ["no_such_*.csv", tmpdir, "short_maxspeeds.csv"]
+            batch = BatchSimulation(sources, Accel('1.25', "f/s^2"),
+                    Pos(528, "f"), "imperial", "analytic", "float", "csv",
+                    os.path.join(tmpdir, "out"))
+            self.assertEqual(batch.get_sources(), sources)
+            results = batch.run(1)
+        self.assertEqual([r.error is None for r in results],
+                [False, False, True])
+        self.assertIn("No input files", results[0].error)
+
+    def test_tag_output(self):
+        self.assertEqual(tag_output('{"pos": 1, "speed": 2}\n', "a.csv",
+            "jsonl"), '{"source": "a.csv", "pos": 1, "speed": 2}\n')
+        self.assertEqual(tag_output("1.0, 2\n1.1, 3\n", "a.csv", "csv"),
+                "a.csv, 1.0, 2\na.csv, 1.1, 3\n")
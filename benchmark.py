@@ -0,0 +1,283 @@
+#! /usr/bin/python3
+
+# Times loading, simulating, outputting and editing synthetic tracks of
+# growing size, fits time against size to flag anything worse than linear,
+# and saves the results as JSON to compare between revisions.
+#
+#   python benchmark.py [--sizes 10,100,1000,10000] [--out results.json]
+#                       [--compare earlier.json] ...
+
+from simulation import Simulation, Track
+from editablesim import EditableTrack
+from convunits import Pos, Speed, Accel
+from contextlib import redirect_stdout
+from math import log
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# a phase whose time grows faster than size**MAX_EXPONENT gets flagged
+# (linear is 1, quadratic 2; timer noise at small sizes needs the slack)
+MAX_EXPONENT = 1.5
+
+PHASES = ("load", "run", "output", "edits")
+
+def gen_synthetic_maxspeeds(n_segs, seed=0, stop_density=0.05,
+        zero_len_mix=0.05):
+    """Generates the lines of a maxspeeds file (imperial) with n_segs
+    segments. Segments are whole tenths of a mile long, so any resolution
+    dividing 528 f works. Between two segments there's a stop (a 0-length,
+    0 mi/h seg) with probability stop_density, or else a 0-length seg at
+    some speed with probability zero_len_mix. Never two 0-length segs in a
+    row. The same arguments always give the same file."""
+    assert n_segs >= 3
+    rng = random.Random(seed)
+    tenths = 0
+    def mp():
+        return "{}.{}".format(tenths // 10, tenths % 10)
+    def speed():
+        return rng.randrange(15, 85, 5)
+
+    # a row per seg, giving its start and speed, then one for the end of the
+    # track; starts and ends with a stop
+    yield "{}\t0".format(mp())
+    segs = 1
+    zero_len_last = True
+    while segs < n_segs - 1:
+        if not zero_len_last and segs < n_segs - 2:
+            roll = rng.random()
+            if roll < stop_density:
+                yield "{}\t0".format(mp())
+                segs += 1
+                zero_len_last = True
+                continue
+            if roll < stop_density + zero_len_mix:
+                yield "{}\t{}".format(mp(), speed())
+                segs += 1
+                zero_len_last = True
+                continue
+        yield "{}\t{}".format(mp(), speed())
+        tenths += rng.randint(1, 20)
+        segs += 1
+        zero_len_last = False
+    # the last seg takes the last row's speed
+    yield "{}\t0".format(mp())
+    yield "{}\t0".format(mp())
+
+def write_synthetic_maxspeeds(filename, n_segs, **kwargs):
+    with open(filename, "w") as f:
+        for line in gen_synthetic_maxspeeds(n_segs, **kwargs):
+            f.write(line + "\n")
+
+def fit_exponent(sizes, times):
+    """Least-squares slope of log(time) against log(size): about 1 for
+    linear, 2 for quadratic"""
+    points = [(log(n), log(t)) for n, t in zip(sizes, times) if t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    var = sum((x - mean_x)**2 for x, y in points)
+    if var == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+class Benchmark:
+    '''Runs each phase on a synthetic track of each size'''
+
+    def __init__(self, sizes, seed=0, stop_density=0.05, zero_len_mix=0.05,
+            engine="analytic", numeric="float", edits=20):
+        self._sizes = sorted(sizes)
+        self._seed = seed
+        self._stop_density = stop_density
+        self._zero_len_mix = zero_len_mix
+        self._engine = engine
+        self._numeric = numeric
+        self._edits = edits
+        self._accel = Accel('1.25', "f/s^2")
+        self._res = Pos('528', "f")
+        self._times = {phase: {} for phase in PHASES}
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for n in self._sizes:
+                filename = os.path.join(tmpdir, "synthetic_{}.csv".format(n))
+                write_synthetic_maxspeeds(filename, n, seed=self._seed,
+                        stop_density=self._stop_density,
+                        zero_len_mix=self._zero_len_mix)
+                self._run_size(n, filename)
+        return self.get_results()
+
+    def _run_size(self, n, filename):
+        start = time.perf_counter()
+        track = Track(filename, "imperial")
+        self._times["load"][n] = time.perf_counter() - start
+
+        sim = Simulation(track, self._accel, self._res, "imperial",
+                self._engine, self._numeric)
+        start = time.perf_counter()
+        sim.run()
+        self._times["run"][n] = time.perf_counter() - start
+
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            sim.output()
+            self._times["output"][n] = time.perf_counter() - start
+
+        editable = EditableTrack(filename, "imperial")
+        editable.enable_profile(self._accel, self._res)
+        rng = random.Random(self._seed)
+        # the edit methods print as they go
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            for k in range(self._edits):
+                self._edit(editable, rng, k)
+            self._times["edits"][n] = time.perf_counter() - start
+
+    @staticmethod
+    def _edit(track, rng, k):
+        """One of a speed change, split, boundary shift and join, on a
+        random seg that can take it"""
+        tenth = Pos('0.1', "mi").to_smaller_unit()
+        segs = track._track
+        for attempt in range(100):
+            i = rng.randrange(1, len(segs) - 2)
+            seg, after = segs[i], segs[i+1]
+            if seg.length() < 2 * tenth.val() or after.length() == 0 or \
+                    seg.get_speed() == 0:
+                continue
+            if k % 4 == 0:
+                track.shift_speed_limit(seg.get_start() + tenth,
+                        Speed('5', "mi/h").to_smaller_unit())
+            elif k % 4 == 1:
+                track.split_seg(seg.get_start() + tenth)
+            elif k % 4 == 2:
+                track.shift_boundary(seg.get_end(), Pos('-0.1', "mi")\
+                        .to_smaller_unit())
+            else:
+                track.join_segs(seg.get_end())
+            return
+        raise RuntimeError("no seg to edit found")
+
+    def get_results(self):
+        scaling = {}
+        for phase in PHASES:
+            sizes = sorted(self._times[phase])
+            exponent = fit_exponent(sizes,
+                    [self._times[phase][n] for n in sizes])
+            scaling[phase] = {"exponent": exponent, "flagged":
+                    exponent is not None and exponent > MAX_EXPONENT}
+        return {
+            "revision": self._revision(),
+            "python": platform.python_version(),
+            "params": {"sizes": self._sizes, "seed": self._seed,
+                "stop_density": self._stop_density,
+                "zero_len_mix": self._zero_len_mix, "engine": self._engine,
+                "numeric": self._numeric, "edits": self._edits},
+            # JSON object keys have to be strings
+            "times": {phase: {str(n): t for n, t in times.items()} \
+                    for phase, times in self._times.items()},
+            "scaling": scaling
+            }
+
+    @staticmethod
+    def _revision():
+        try:
+            return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                    capture_output=True, text=True, check=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__)))\
+                    .stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+def output_results(results, earlier=None):
+    '''Prints a table of times per phase and size, then the fitted exponents.
+    With earlier results, also each time as a ratio to the earlier one.'''
+    sizes = results["params"]["sizes"]
+    print("phase, " + ", ".join(str(n) for n in sizes) + ", exponent")
+    for phase in PHASES:
+        times = results["times"][phase]
+        cells = []
+        for n in sizes:
+            cell = "{:.4f}".format(times[str(n)])
+            if earlier is not None and str(n) in earlier["times"][phase]:
+                cell += " (x{:.2f})".format(times[str(n)] / \
+                        earlier["times"][phase][str(n)])
+            cells.append(cell)
+        scaling = results["scaling"][phase]
+        exponent = scaling["exponent"]
+        print("{}, {}, {}{}".format(phase, ", ".join(cells),
+            "-" if exponent is None else "{:.2f}".format(exponent),
+            " SUPERLINEAR" if scaling["flagged"] else ""))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark trainspeedsim "\
+            "on synthetic tracks")
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+            help="comma-separated segment counts (10 to 1000000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stop-density", type=float, default=0.05)
+    parser.add_argument("--zero-len-mix", type=float, default=0.05)
+    parser.add_argument("--engine", default="analytic",
+            choices=Simulation.ENGINES)
+    parser.add_argument("--numeric", default="float",
+            choices=Simulation.NUMERICS)
+    parser.add_argument("--edits", type=int, default=20)
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--compare", help="earlier results JSON file")
+    args = parser.parse_args(argv[1:])
+
+    sizes = [int(n) for n in args.sizes.split(",")]
+    if any(n < 10 or n > 1000000 for n in sizes):
+        parser.error("sizes must be from 10 to 1000000")
+    bench = Benchmark(sizes, args.seed, args.stop_density, args.zero_len_mix,
+            args.engine, args.numeric, args.edits)
+    results = bench.run()
+    earlier = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            earlier = json.load(f)
+    output_results(results, earlier)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    # non-zero exit when something scales badly, for scripts
+    return 1 if any(s["flagged"] for s in results["scaling"].values()) else 0
+
+
+import unittest
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_track(self):
+        lines = list(gen_synthetic_maxspeeds(200, seed=3, stop_density=0.1,
+            zero_len_mix=0.1))
+        self.assertEqual(lines, list(gen_synthetic_maxspeeds(200, seed=3,
+            stop_density=0.1, zero_len_mix=0.1)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "synthetic.csv")
+            write_synthetic_maxspeeds(filename, 200, seed=3,
+                    stop_density=0.1, zero_len_mix=0.1)
+            track = EditableTrack(filename, "imperial")
+        segs = list(track)
+        self.assertEqual(len(segs), 200)
+        self.assertEqual(segs[0].get_speed(), 0)
+        self.assertEqual(segs[-1].get_speed(), 0)
+        for a, b in zip(segs, segs[1:]):
+            self.assertFalse(a.length() == 0 and b.length() == 0)
+        self.assertGreater(len(track.get_stop_indices()), 2)
+
+    def test_fit_exponent(self):
+        sizes = [10, 100, 1000]
+        self.assertAlmostEqual(fit_exponent(sizes, [n * 1e-6 for n in sizes]),
+                1.0)
+        self.assertAlmostEqual(fit_exponent(sizes,
+            [n * n * 1e-6 for n in sizes]), 2.0)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
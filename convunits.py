@@ -1,8 +1,15 @@
 
 from fractions import Fraction
 from decimal import Decimal
+from array import array
+from itertools import repeat
 import decimal
-import copy
+import operator
+# QuantityArray works on its buffer with numpy where there is numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def decimal_from_fraction(frac):
     '''Utility function to convert a Fraction into a Decimal, losslessly or 
@@ -51,23 +58,49 @@ def system_to_unit(units, unit_type, size):
 
 class HasUnit: # virtual/interface-ish
     # Subclasses will define the values, and units
+    # Immutable (every operation makes a new one) and hashable, so anything
+    # can hand out the same object without copying it first
+    __slots__ = ("_val", "_unit")
 
     # decorator b/c needs its own decimal context
     def preservecontext(f):
         def preserver(*args, **kwargs):
             oldcontext = decimal.getcontext()
             decimal.setcontext(decimal.ExtendedContext)
-            result = f(*args, **kwargs)
-            decimal.setcontext(oldcontext)
-            return result
+            try:
+                return f(*args, **kwargs)
+            finally:
+                decimal.setcontext(oldcontext)
         return preserver
 
     def __init__(self, val, unit):
         if isinstance(val, (str, Decimal)):
-            self._val = Fraction(val)
-        else:
-            self._val = val
-        self._unit = unit
+            val = Fraction(val)
+        object.__setattr__(self, "_val", val)
+        object.__setattr__(self, "_unit", unit)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    # nothing to copy, and pickling goes through __init__ since __setattr__
+    # won't do
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), (self._val, self._unit))
+
+    # equal values are equal whatever their type (1 == Fraction(1) == 1.0),
+    # and so hash the same; quantities in different units are never equal
+    # (see __eq__()), so sharing a hash is just a collision
+    def __hash__(self):
+        return hash(self._val)
 
     @preservecontext
     def __str__(self):
@@ -84,7 +117,8 @@ class HasUnit: # virtual/interface-ish
         if isinstance(self._val, Fraction):
             return decimal_from_fraction(self._val)
         else:
-            return copy.deepcopy(self._val)
+            # int or float, so already immutable
+            return self._val
     
     def unit(self):
         return self._unit
@@ -116,6 +150,10 @@ class HasUnit: # virtual/interface-ish
 
     @preservecontext
     def __eq__(self, other):
+        # just unequal rather than _compare_to()'s error, so a set or dict
+        # can hold quantities in different units (ordering them still is one)
+        if isinstance(other, HasUnit) and other._unit != self._unit:
+            return False
         return self._val == self._compare_to(other)
 
     @preservecontext
@@ -159,6 +197,7 @@ class HasUnit: # virtual/interface-ish
 
 class ConvertibleUnit(HasUnit):
     # subclasses will define values, units, and their conversions
+    __slots__ = ()
     
     def __init__(self, val, unit):
         HasUnit.__init__(self, val, unit)
@@ -179,25 +218,53 @@ class ConvertibleUnit(HasUnit):
         return self.to_smaller_unit()
 
 
-    @HasUnit.preservecontext
     def convert_to(self, unit):
-        # find path from self._unit to unit
-        # the graph is stored as a dict where each key is a node and value is a 
-        # dict where each key is a node (unit) connected (convertible) to.
-        # to make it "undirected", include the reverse direction yeah.
-
-
-        unit_from = self._unit
-        unit_to = unit
-
-        if unit_to == self._unit:
-            return type(self)(self._val, self._unit)
-
-        conv_path = self._dijkstra(unit_from, unit_to)
-
-        result = self._conv_calc(conv_path)
-
-        return type(self)(result, unit)
+        # one lookup in the table _compile_factors() built at import, then one
+        # multiply
+        if unit == self._unit:
+            return self # immutable, so no need for a new one
+        factor = self._factor(self._unit, unit)
+        return type(self)(self._scale(self._val, factor), unit)
+
+    @classmethod
+    def convert_values(cls, values, unit_from, unit_to):
+        """Bulk convert_to(): plain values in unit_from (Fractions, ints or
+        floats) converted to unit_to, each as convert_to() would"""
+        if unit_from == unit_to:
+            return list(values)
+        factor = cls._factor(unit_from, unit_to)
+        return [cls._scale(val, factor) for val in values]
+
+    @classmethod
+    def _factor(cls, unit_from, unit_to):
+        try:
+            return cls._factors[unit_from, unit_to]
+        except KeyError:
+            raise ValueError("cannot convert to unit "+str(unit_to)) from None
+
+    @staticmethod
+    def _scale(val, factor):
+        if isinstance(val, Fraction):
+            return val * factor
+        # ints and floats come out float, as going edge by edge did
+        return val * factor.numerator / factor.denominator
+
+    @classmethod
+    def _compile_factors(cls):
+        """Fills in cls._factors, the exact factor from every unit to every
+        other reachable one, by running the old path-finding once per pair
+        rather than on every conversion"""
+        cls._factors = {}
+        for unit_from in cls._conv:
+            for unit_to in cls._conv:
+                if unit_to == unit_from:
+                    continue
+                one = cls(Fraction(1), unit_from)
+                try:
+                    path = one._dijkstra(unit_from, unit_to)
+                except ValueError:
+                    continue
+                cls._factors[unit_from, unit_to] = one._conv_calc(path)
 
     def _dijkstra(self, unit_from, unit_to):
         path = []
@@ -246,17 +313,25 @@ class ConvertibleUnit(HasUnit):
         return result
 
 class Pos(ConvertibleUnit):
+    __slots__ = ()
+
     # conversions
     # should be sufficient to convert between any of these in any direction
+    # "mf" is a thousandth of a foot, the "fixed" numeric mode's integer
+    # base unit (along with "mm")
     _conv = {"f":  {"mi": Fraction(1,5280),  \
                    "m":  Fraction('0.3048'),  \
-                   "in": Fraction(12)     }, # just to spice things up\
+                   "in": Fraction(12),        # just to spice things up\
+                   "mf": Fraction(1000)   },\
             "mi": {"f":  Fraction(5280)   },\
             "m":  {"f":  Fraction(3.2808399), # TODO make it 1/0.3048
                     "cm": Fraction(100),    \
+                    "mm": Fraction(1000),   \
                     "km": Fraction(1, 1000) },  \
             "in": {"f":  Fraction(1, 12) }, \
             "cm": {"m": Fraction(1, 100) }, \
+            "mm": {"m": Fraction(1, 1000) }, \
+            "mf": {"f": Fraction(1, 1000) }, \
             "km": {"m":  Fraction(1000) }\
            }
     _bigger = {     \
@@ -275,13 +350,19 @@ class Pos(ConvertibleUnit):
         ConvertibleUnit.__init__(self, val, unit)
 
 class Speed(ConvertibleUnit):
+    __slots__ = ()
+
     _conv = { \
         "f/s": {"mi/h": Fraction(3600,5280), \
-                "m/s": Fraction(0.3048) }, \
+                "m/s": Fraction(0.3048), \
+                "mf/s": Fraction(1000) }, \
         "mi/h":{"f/s": Fraction(5280, 3600) }, \
         "m/s": {"km/h": Fraction(3600,1000), \
-                "f/s": Fraction(3.2808399) }, \
-        "km/h":{"m/s": Fraction(1000,3600) } \
+                "f/s": Fraction(3.2808399), \
+                "mm/s": Fraction(1000) }, \
+        "km/h":{"m/s": Fraction(1000,3600) }, \
+        "mf/s":{"f/s": Fraction(1, 1000) }, \
+        "mm/s":{"m/s": Fraction(1, 1000) } \
     }
 
     _bigger = {         \
@@ -299,9 +380,15 @@ class Speed(ConvertibleUnit):
         ConvertibleUnit.__init__(self, val, unit)
     
 class Accel(ConvertibleUnit):
+    __slots__ = ()
+
     _conv = {\
-        "f/s^2": {"m/s^2": Fraction(0.3048) },\
-        "m/s^2": {"f/s^2": Fraction(3.2808399) } \
+        "f/s^2": {"m/s^2": Fraction(0.3048), \
+                  "mf/s^2": Fraction(1000) },\
+        "m/s^2": {"f/s^2": Fraction(3.2808399), \
+                  "mm/s^2": Fraction(1000) }, \
+        "mf/s^2": {"f/s^2": Fraction(1, 1000) }, \
+        "mm/s^2": {"m/s^2": Fraction(1, 1000) } \
     }
 
     _bigger = {}
@@ -312,6 +399,241 @@ class Accel(ConvertibleUnit):
         assert unit in self._conv
         ConvertibleUnit.__init__(self, val, unit)
 
+# every conversion path worked out once, up front
+for _quantity_type in (Pos, Speed, Accel):
+    _quantity_type._compile_factors()
+
+class QuantityArray:
+    """Columnar counterpart to Pos/Speed/Accel: one unit and one compact
+    buffer of float values, instead of a HasUnit object (with its own
+    Fraction and unit string) per value. quantity_type is the class whose
+    units and conversions apply, e.g. Pos.
+
+    Conversion and arithmetic work on the whole buffer at once. +, - take
+    another QuantityArray or a single value in the same unit; *, / take plain
+    numbers. <, <=, >, >= compare elementwise and give a list of bools; ==
+    and != compare whole arrays, like lists do.
+
+    The buffer is what saves memory. The time an operation takes depends on
+    numpy: with it each one is a single numpy operation over the buffer
+    (through numpy.frombuffer(), without copying), but without it each one
+    is still a Python loop over the values, about as slow as the HasUnits'
+    own arithmetic would be."""
+
+    def __init__(self, quantity_type, vals, unit):
+        assert issubclass(quantity_type, ConvertibleUnit)
+        assert unit in quantity_type._conv
+        self._type = quantity_type
+        self._unit = unit
+        if isinstance(vals, array):
+            self._vals = array('d', vals)
+        elif hasattr(vals, "tobytes") and hasattr(vals, "dtype"):
+            # numpy array: copy the bytes rather than going value by value
+            self._vals = array('d')
+            self._vals.frombytes(memoryview(numpy.ascontiguousarray(vals,
+                dtype=numpy.float64)).cast('B'))
+        else:
+            self._vals = array('d', (float(v) for v in vals))
+
+    @classmethod
+    def from_buffer(cls, quantity_type, buffer, unit):
+        """QuantityArray over a buffer of native doubles (e.g. part of an
+        mmap) without copying it. Only valid while the buffer is; anything
+        worked out from it is a new, ordinary QuantityArray."""
+        assert issubclass(quantity_type, ConvertibleUnit)
+        assert unit in quantity_type._conv
+        quantities = cls.__new__(cls)
+        quantities._type = quantity_type
+        quantities._unit = unit
+        quantities._vals = memoryview(buffer).cast('B').cast('d')
+        return quantities
+
+    @classmethod
+    def from_quantities(cls, quantities, unit=None):
+        """QuantityArray of HasUnits (all of one type), in unit or else the
+        first one's unit"""
+        quantities = list(quantities)
+        if len(quantities) == 0:
+            raise ValueError("need at least one quantity (or use __init__)")
+        quantity_type = type(quantities[0])
+        if unit is None:
+            unit = quantities[0].unit()
+        return cls(quantity_type, (float(q.convert_to(unit)._val) \
+                for q in quantities), unit)
+
+    def unit(self):
+        return self._unit
+
+    def quantity_type(self):
+        return self._type
+
+    def values(self):
+        """the buffer itself, read-only; numpy.frombuffer() can use it
+        without copying"""
+        return memoryview(self._vals).toreadonly()
+
+    def __len__(self):
+        return len(self._vals)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return QuantityArray(self._type, self._vals[index], self._unit)
+        return self._type(self._vals[index], self._unit)
+
+    def __iter__(self):
+        for val in self._vals:
+            yield self._type(val, self._unit)
+
+    def __repr__(self):
+        return "QuantityArray({}, {}, '{}')".format(self._type.__name__,
+                self._vals.tolist(), self._unit)
+
+    def convert_to(self, unit):
+        if unit == self._unit:
+            return QuantityArray(self._type, self._vals, unit)
+        # one exact factor for the whole buffer, the one a single value uses
+        factor = self._type._factor(self._unit, unit)
+        if factor < 1:
+            # dividing by the bigger unit's size keeps e.g. 20 mi/h from
+            # coming out as 19.999999999999996
+            vals = self._apply(operator.truediv, float(1 / factor))
+        else:
+            vals = self._apply(operator.mul, float(factor))
+        return QuantityArray(self._type, vals, unit)
+
+    def to_bigger_unit(self):
+        assert self._unit in self._type._bigger, "cannot bigify"
+        return self.convert_to(self._type._bigger[self._unit])
+
+    def to_smaller_unit(self):
+        assert self._unit in self._type._smaller, "cannot smallify"
+        return self.convert_to(self._type._smaller[self._unit])
+
+    def _other_vals(self, other):
+        """other's values to go elementwise with self's: the buffer of
+        another QuantityArray, else one float"""
+        if isinstance(other, QuantityArray):
+            assert other._unit == self._unit
+            if len(other) != len(self):
+                raise ValueError("lengths {} and {} differ".format(len(self),
+                    len(other)))
+            return other._vals
+        if isinstance(other, HasUnit):
+            assert other.unit() == self._unit
+            other = other._val
+        if not isinstance(other, (int, float, Fraction, Decimal)):
+            raise TypeError("incompatible types "+str(type(self))+", " \
+                    +str(type(other)))
+        return float(other)
+
+    def _apply(self, op, other, column_op=None):
+        """op(value, other value) for each of self's values, other being
+        what _other_vals() gives: as one numpy operation (column_op if
+        given) on the buffers where there's numpy, else as a generator"""
+        if numpy is not None:
+            if not isinstance(other, float):
+                other = numpy.frombuffer(other, dtype=numpy.float64)
+            return (column_op or op)(numpy.frombuffer(self._vals,
+                dtype=numpy.float64), other)
+        if isinstance(other, float):
+            other = repeat(other, len(self._vals))
+        return (op(a, b) for a, b in zip(self._vals, other))
+
+    def _compare(self, op, other):
+        result = self._apply(op, self._other_vals(other))
+        if numpy is not None:
+            return result.tolist()
+        return list(result)
+
+    def _new(self, vals):
+        return QuantityArray(self._type, vals, self._unit)
+
+    def __add__(self, other):
+        return self._new(self._apply(operator.add, self._other_vals(other)))
+
+    def __sub__(self, other):
+        return self._new(self._apply(operator.sub, self._other_vals(other)))
+
+    def __mul__(self, other):
+        if not isinstance(other, (int, float, Fraction, Decimal)):
+            raise TypeError("can only scale by a plain number")
+        return self._new(self._apply(operator.mul, float(other)))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if not isinstance(other, (int, float, Fraction, Decimal)):
+            raise TypeError("can only scale by a plain number")
+        return self._new(self._apply(operator.truediv, float(other)))
+
+    def minimum(self, other):
+        """elementwise minimum"""
+        return self._new(self._apply(min, self._other_vals(other),
+            numpy.minimum if numpy is not None else None))
+
+    def __lt__(self, other):
+        return self._compare(operator.lt, other)
+
+    def __le__(self, other):
+        return self._compare(operator.le, other)
+
+    def __gt__(self, other):
+        return self._compare(operator.gt, other)
+
+    def __ge__(self, other):
+        return self._compare(operator.ge, other)
+
+    def __eq__(self, other):
+        if not isinstance(other, QuantityArray):
+            return NotImplemented
+        return self._type is other._type and self._unit == other._unit \
+                and self._vals == other._vals
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+
+import unittest
+
+class TestHasUnit(unittest.TestCase):
+    def test_mixed_units_in_a_set(self):
+        # used to fail _compare_to()'s assert on the hash collision
+        quantities = {Pos(1, "f"), Pos(1, "mi"), Speed(1, "f/s"), Pos(1, "f"),
+                Pos("1.0", "f")}
+        self.assertEqual(len(quantities), 3)
+        self.assertIn(Pos(1, "mi"), quantities)
+        self.assertNotEqual(Pos(1, "f"), Pos(1, "mi"))
+        self.assertEqual(Pos(1, "f"), 1)
+        with self.assertRaises(AssertionError):
+            Pos(1, "f") < Pos(1, "mi")
+
+class TestQuantityArray(unittest.TestCase):
+    def test_numpy_matches_loops(self):
+        global numpy
+        speeds = QuantityArray(Speed, [0.0, 29.3333, 88.0, 117.3333],
+                "f/s")
+        limits = QuantityArray(Speed, [44.0, 20.0, 88.0, 200.0], "f/s")
+        def work():
+            return (speeds.convert_to("mi/h"), speeds.convert_to("mf/s"),
+                    speeds + limits, speeds - Speed(10, "f/s"), 2 * speeds,
+                    speeds / 3, speeds.minimum(limits), speeds < limits,
+                    speeds <= 88, speeds > limits, speeds >= limits)
+        found = work()
+        self.assertEqual(found[1][2], Speed(88000, "mf/s"))
+        self.assertEqual(found[7], [True, False, False, True])
+        numpy_was = numpy
+        numpy = None
+        try:
+            self.assertEqual(work(), found)
+        finally:
+            numpy = numpy_was
+
+
 if __name__ == "__main__":
 
     pos = Pos(1, "f")
@@ -350,6 +672,14 @@ if __name__ == "__main__":
     in_fps2 = mps.convert_to("f/s^2")
     print(mps, "is", in_fps2)
 
+    mileposts = QuantityArray(Pos, [0, 528, 1056, 5280], "f")
+    print(mileposts, "is", mileposts.to_bigger_unit())
+    speeds = QuantityArray.from_quantities([Speed('20', "mi/h"),
+        Speed('45', "mi/h")]).to_smaller_unit()
+    print(speeds, "capped at 50 f/s:", speeds.minimum(Speed(50, "f/s")))
+    print("[528, 2640, 5280] f in mi:", Pos.convert_values([528, 2640, 5280],
+        "f", "mi"))
+
     try:
         acc_big = accel.to_bigger_unit()
         print(accel, "is", acc_big)
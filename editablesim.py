@@ -1,8 +1,14 @@
 #! /usr/bin/python3
 
-from simulation import Simulation, Track, TrackSeg, PosSpeed
+from simulation import Simulation, Track, TrackSeg, PosSpeed, _float_val, \
+    _float_seg_point
 from convunits import Pos, Speed, system_to_unit
 from observer import Observable
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from operator import attrgetter
+from math import sqrt
 
 # For when an edit operation is impossible due to the circumstances and 
 # there's no valid value (so it's not ValueError)
@@ -39,6 +45,10 @@ class NegativeSpeedPotentialError(RuntimeError):
     pass
 
 class EditableTrackSeg(TrackSeg):
+    # Like TrackSeg, immutable: each with_*() returns a new seg, checked as
+    # the old setters did, and EditableTrack puts it in the old one's place
+    __slots__ = ()
+
     def __init__(self, index, start, end, speed):
         TrackSeg.__init__(self, index, start, end, speed)
         # I think that's it as far as constructoring goes
@@ -49,47 +59,46 @@ class EditableTrackSeg(TrackSeg):
         return cls(seg.get_index(), seg.get_start(), seg.get_end(),
                 seg.get_speed())
 
-    def set_index(self, index):
+    def with_index(self, index):
         if not isinstance(index, int):
             raise TypeError("index must be int-derived")
         if index < 0:
             raise IndexError("index must be non-negative")
 
-        self._index = index
+        return type(self)(index, self._start, self._end, self._speed)
 
-    def set_start(self, start):
+    def with_start(self, start):
         if start > self._end:
             raise ValueError("start must be <= end")
         if self._speed == 0 and start != self._end:
             raise Non0LengthOf0SpeedSegPotentialError("start and end must be "\
                     "equal if speed is 0")
-        self._start = start
+        return type(self)(self._index, start, self._end, self._speed)
 
-    def set_end(self, end):
+    def with_end(self, end):
         if self._start > end:
             raise ValueError("start must be <= end")
         if self._speed == 0 and self._start != end:
             raise Non0LengthOf0SpeedSegPotentialError("start and end must be "\
                     "equal if speed is 0")
-        self._end = end
+        return type(self)(self._index, self._start, end, self._speed)
 
-    def set_speed(self, speed):
+    def with_speed(self, speed):
         if speed < 0:
             raise ValueError("speed must be non-negative")
         if (speed == 0):
             if self._start != self._end:
                 raise ValueError("if start != end, speed must be > 0")
-        self._speed = speed
+        return type(self)(self._index, self._start, self._end, speed)
 
     # Convenience method
-    def set_start_end(self, start, end):
+    def with_start_end(self, start, end):
         if start > end:
             raise ValueError("start must be <= end")
         if self._speed == 0 and start != end:
             raise Non0LengthOf0SpeedSegPotentialError("start and end must be "\
                     "equal if speed is 0")
-        self._start = start
-        self._end = end
+        return type(self)(self._index, start, end, self._speed)
 
 
 
@@ -101,19 +110,21 @@ class TestEditableTrackSegMethods(unittest.TestCase):
                 Pos('13.5', "mi").to_smaller_unit(), Speed('25',
                 "mi/h").to_smaller_unit())
 
-    def test_set_index(self):
+    def test_with_index(self):
         # confirm current index
         self.assertEqual(self.seg.get_index(), 14)
 
         # set index
-        self.seg.set_index(30)
-        self.assertEqual(self.seg.get_index(), 30)
+        moved = self.seg.with_index(30)
+        self.assertEqual(moved.get_index(), 30)
+        # the original stays as it was
+        self.assertEqual(self.seg.get_index(), 14)
 
         # set index < 0 (should throw)
         with self.assertRaises(IndexError):
-            seg.set_index(-3)
+            self.seg.with_index(-3)
 
-    def test_set_start(self):
+    def test_with_start(self):
         # confirm initial seg value
         self.assertEqual(self.seg.get_start(), Pos('11.4',
                 "mi").to_smaller_unit())
@@ -121,56 +132,56 @@ class TestEditableTrackSegMethods(unittest.TestCase):
                 "mi").to_smaller_unit())
 
         # set start < end
-        self.seg.set_start(Pos('10.8', "mi").to_smaller_unit())
+        self.seg = self.seg.with_start(Pos('10.8', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_start(), 
                 Pos('10.8', "mi").to_smaller_unit())
 
         # set start > end (should throw)
         with self.assertRaises(ValueError):
-            self.seg.set_start(Pos('15', "mi").to_smaller_unit())
+            self.seg.with_start(Pos('15', "mi").to_smaller_unit())
 
         # set start so length == 0
         self.assertEqual(self.seg.get_end(), Pos('13.5', 
                 "mi").to_smaller_unit())
-        self.seg.set_start(Pos('13.5', "mi").to_smaller_unit())
+        self.seg = self.seg.with_start(Pos('13.5', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_start(),
                 Pos('13.5', "mi").to_smaller_unit())
 
-        # set_start should throw ValueError IFF speed is 0 and length > 0
-        self.seg.set_speed(Speed('0', "mi/h").to_smaller_unit())
+        # with_start should throw ValueError IFF speed is 0 and length > 0
+        self.seg = self.seg.with_speed(Speed('0', "mi/h").to_smaller_unit())
         self.assertEqual(self.seg.get_speed(), 
                 Speed('0', "mi/h").to_smaller_unit())
         with self.assertRaises(Non0LengthOf0SpeedSegPotentialError):
-            self.seg.set_start(Pos('13.4', "mi").to_smaller_unit())
+            self.seg.with_start(Pos('13.4', "mi").to_smaller_unit())
 
-    def test_set_end(self):
+    def test_with_end(self):
         # check initial start & end values
         self.assertEqual(self.seg.get_start(),
                 Pos('11.4', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_end(), Pos('13.5', "mi").to_smaller_unit())
 
         # set end farther to 14 miles and check
-        self.seg.set_end(Pos('14', "mi").to_smaller_unit())
+        self.seg = self.seg.with_end(Pos('14', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_end(), Pos('14', "mi").to_smaller_unit())
         
         # set end to earlier than start (should throw)
         with self.assertRaises(ValueError):
-            self.seg.set_end(Pos('10', "mi").to_smaller_unit())
+            self.seg.with_end(Pos('10', "mi").to_smaller_unit())
 
         # set end to equal start and check
-        self.seg.set_end(Pos('11.4', "mi").to_smaller_unit())
+        self.seg = self.seg.with_end(Pos('11.4', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_start(),
             Pos('11.4', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_start(), self.seg.get_end())
 
-        # set_end should throw ValueError IFF speed is 0 and length > 0
-        self.seg.set_speed(Speed('0', "mi/h").to_smaller_unit())
+        # with_end should throw ValueError IFF speed is 0 and length > 0
+        self.seg = self.seg.with_speed(Speed('0', "mi/h").to_smaller_unit())
         self.assertEqual(self.seg.get_speed(), 
             Speed('0', "mi/h").to_smaller_unit())
         with self.assertRaises(Non0LengthOf0SpeedSegPotentialError):
-            self.seg.set_end(Pos('11.6', "mi").to_smaller_unit())
+            self.seg.with_end(Pos('11.6', "mi").to_smaller_unit())
 
-    def test_set_speed(self):
+    def test_with_speed(self):
         # check initial start & end values
         self.assertEqual(self.seg.get_start(),
                 Pos('11.4', "mi").to_smaller_unit())
@@ -178,65 +189,158 @@ class TestEditableTrackSegMethods(unittest.TestCase):
 
         # set speed < 0 (should throw)
         with self.assertRaises(ValueError):
-            self.seg.set_speed(Speed('-3', "mi/h").to_smaller_unit())
+            self.seg.with_speed(Speed('-3', "mi/h").to_smaller_unit())
 
         # set speed to 100 mi/h
-        self.seg.set_speed(Speed('100', "mi/h").to_smaller_unit())
+        self.seg = self.seg.with_speed(Speed('100', "mi/h").to_smaller_unit())
         self.assertEqual(self.seg.get_speed(),
                 Speed('100', "mi/h").to_smaller_unit())
 
         # set speed to 0 mi/h, while length > 0 (should throw)
         self.assertGreater(self.seg.length(), 0)
         with self.assertRaises(ValueError):
-            self.seg.set_speed(Speed('0', "mi/h").to_smaller_unit())
+            self.seg.with_speed(Speed('0', "mi/h").to_smaller_unit())
 
         # set speed 0 mi/h while length == 0
-        self.seg.set_end(Pos('20', "mi").to_smaller_unit())
-        self.seg.set_start(Pos('20', "mi").to_smaller_unit())
+        self.seg = self.seg.with_end(Pos('20', "mi").to_smaller_unit())
+        self.seg = self.seg.with_start(Pos('20', "mi").to_smaller_unit())
         self.assertEqual(self.seg.length(), 0)
-        self.seg.set_speed(Speed('0', "mi/h").to_smaller_unit())
+        self.seg = self.seg.with_speed(Speed('0', "mi/h").to_smaller_unit())
         self.assertEqual(self.seg.get_speed(), 0)
 
         # set speed > 0 mi/h while length == 0
         self.assertEqual(self.seg.length(), 0)
-        self.seg.set_speed(Speed('20', "mi/h").to_smaller_unit())
+        self.seg = self.seg.with_speed(Speed('20', "mi/h").to_smaller_unit())
         self.assertEqual(self.seg.get_speed(), 
                 Speed('20', "mi/h").to_smaller_unit())
 
-    def test_set_start_end(self):
+    def test_with_start_end(self):
         # check initial start & end values
         self.assertEqual(self.seg.get_start(),
                 Pos('11.4', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_end(), Pos('13.5', "mi").to_smaller_unit())
 
         # set start and end to > current end
-        self.seg.set_start_end(Pos('14', "mi").to_smaller_unit(),
+        self.seg = self.seg.with_start_end(Pos('14', "mi").to_smaller_unit(),
                 Pos('15', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_start(), Pos('14', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_end(), Pos('15', "mi").to_smaller_unit())
 
         # set start > end (should throw)
         with self.assertRaises(ValueError):
-            self.seg.set_start_end(Pos('16', "mi").to_smaller_unit(),
+            self.seg.with_start_end(Pos('16', "mi").to_smaller_unit(),
                     Pos('10', "mi").to_smaller_unit())
 
         # set start == end
-        self.seg.set_start_end(Pos('9.5', "mi").to_smaller_unit(),
+        self.seg = self.seg.with_start_end(Pos('9.5', "mi").to_smaller_unit(),
                 Pos('9.5', "mi").to_smaller_unit())
         self.assertEqual(self.seg.get_start(), self.seg.get_end())
         
         # set start < end with 0 speed, should throw
-        self.seg.set_speed(Speed('0', "mi/h").to_smaller_unit())
+        self.seg = self.seg.with_speed(Speed('0', "mi/h").to_smaller_unit())
         with self.assertRaises(Non0LengthOf0SpeedSegPotentialError):
-            self.seg.set_start_end(Pos('8', "mi").to_smaller_unit(),
+            self.seg.with_start_end(Pos('8', "mi").to_smaller_unit(),
                     Pos('9.9', "mi").to_smaller_unit())
 
 
+class ProfileChunk:
+    """One track seg's share of EditableTrack's cached best-speed profile:
+    its sample points' positions and forward/reverse speeds squared, all
+    floats in the small units. None means not yet computed."""
+    def __init__(self, seg, resolution, two_a):
+        start = _float_val(seg.get_start())
+        end = _float_val(seg.get_end())
+        self.limit = _float_val(seg.get_speed())**2
+        if seg.length() == 0:
+            self.pos = [start]
+            self.step = 0.0
+        else:
+            steps = round((end - start) / resolution)
+            if steps == 0 or abs(steps * resolution - (end - start)) > \
+                    Simulation.FLOAT_ATOL:
+                raise ValueError("length of {} not a multiple of resolution "\
+                        "{}".format(seg, resolution))
+            self.pos = [_float_seg_point(start, end, j, steps, resolution) \
+                    for j in range(1, steps + 1)]
+            self.step = two_a * resolution
+        self.fwd = [None] * len(self.pos)
+        self.rev = [None] * len(self.pos)
+
+
+_raw_val = attrgetter("_val")
+
+class _EditableSegs:
+    """EditableTrack's segs as a sequence, each made from the columns when
+    asked for. Assigning a seg writes its start, end and speed back, so the
+    neighbours sharing those boundaries see the change too."""
+
+    def __init__(self, track):
+        self._t = track
+
+    def __len__(self):
+        return len(self._t._speeds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("seg index out of range")
+        bounds = self._t._bounds
+        return EditableTrackSeg._unchecked(index, bounds[index],
+                bounds[index+1], self._t._speeds[index])
+
+    def __setitem__(self, index, seg):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("seg index out of range")
+        self._t._bounds[index] = seg.get_start()
+        self._t._bounds[index+1] = seg.get_end()
+        self._t._speeds[index] = seg.get_speed()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+
+
+# One undoable edit: the splices that undo it, the (first, old_count,
+# new_count) it marked for the profile, and a number no other edit has
+_Step = namedtuple("_Step", ["splices", "edit", "serial"])
+
+def _splices_window(undo_splices):
+    """(first, old_count, new_count) covering every seg that a run of edits
+    changed, from the splices that undo them"""
+    first = old_count = new_count = None
+    for f, n, old_bounds, old_speeds in undo_splices:
+        o = len(old_speeds)
+        if first is None:
+            first, old_count, new_count = f, o, n
+            continue
+        end = max(first + new_count, f + o)
+        old_end = end - new_count + old_count
+        first = min(first, f)
+        old_count = old_end - first
+        new_count = end - o + n - first
+    return first, old_count, new_count
+
 class EditableTrack(Track, Observable):
-    def __init__(self, filename=None, units=None):
+    # Kept as columns rather than a list of segs: _bounds holds the n+1 seg
+    # boundaries, in order, each shared by the segs either side of it, and
+    # _speeds the n speed limits. A seg's index is just where it is, so an
+    # edit only touches the entries it changes. _track makes segs from them
+    # for everything that wants segs.
+    # history is how many edits undo() can go back
+    def __init__(self, filename=None, units=None, history=1000):
         if filename is None:
             # start a track from scratch
-            self._track = []
+            self._bounds = []
+            self._speeds = []
             self._units = units
         else:
             # Track-style behavior and load a track
@@ -244,17 +348,40 @@ class EditableTrack(Track, Observable):
             # Make it editable
             self._editableify()
             self._units = units
+        self._track = _EditableSegs(self)
         Observable.__init__(self)
+        # best-speed profile, off until enable_profile()
+        self._chunks = None
+        self._resolution = None
+        self._two_a = None
+        self._edit = None
+        self._changed = None
+        # undo/redo: each step keeps only the column entries its edit
+        # replaced, so undoing or redoing costs what the edit did
+        self._undo = deque(maxlen=history)
+        self._redo = []
+        self._step = None # splices of the edit under way
+        self._serial = 0
+        self._base = 0 # serial of the last edit to fall off _undo, if any
+        self._transaction = None # splices so far, in a transaction()
 
     # need to override Observable's _common_notify() b/c additional requirements
     def _common_notify(func):
         def return_f(*args, **kwargs):
             self = args[0] # that should do it if func is always a method
+            if self._transaction is not None:
+                # observers hear about it when the transaction commits
+                retval, step = self._run_edit(func, args, kwargs)
+                self._transaction.extend(step)
+                self._edit = None
+                return retval
             try:
-                retval = func(*args, **kwargs)
+                retval, step = self._run_edit(func, args, kwargs)
                 if retval is None or retval == True:
                     # None b/c editing methods haven't all been updated to
                     # return bool
+                    self._record_step(step, self._edit)
+                    self._update_profile()
                     self.notify_observers("ChangeSuccess")
                 else:
                     self.notify_observers("NoChange")
@@ -272,10 +399,81 @@ class EditableTrack(Track, Observable):
             return retval
         return return_f
 
+    def _run_edit(self, func, args, kwargs):
+        """Runs an edit method, collecting its splices. Returns what it
+        returned and the splices."""
+        self._step = []
+        try:
+            retval = func(*args, **kwargs)
+        except BaseException:
+            # back out whatever part of the edit got done
+            self._revert_splices(self._step)
+            self._edit = None
+            raise
+        finally:
+            step, self._step = self._step, None
+        return retval, step
+
+    def _record_step(self, splices, edit):
+        if len(splices) > 0:
+            self._serial += 1
+            self._push_undo(_Step(splices, edit, self._serial))
+            self._redo.clear()
+
+    @contextmanager
+    def transaction(self):
+        """For making many edits as one:
+
+            with track.transaction():
+                track.split_seg(mp)
+                track.shift_speed_limit(mp, diff)
+
+        Observers hear nothing until the block ends, then a single
+        "ChangeSuccess" ("NoChange" if nothing changed). If the block raises,
+        every edit in it is backed out, observers get one "ChangeFail" and
+        the exception carries on. The whole block is one step to undo().
+        A transaction inside another is backed out on its own if it fails,
+        and otherwise becomes part of the outer one."""
+        if self._transaction is not None:
+            savepoint = len(self._transaction)
+            try:
+                yield self
+            except BaseException:
+                self._revert_splices(self._transaction[savepoint:])
+                del self._transaction[savepoint:]
+                raise
+            return
+        self._transaction = []
+        try:
+            yield self
+        except BaseException as e:
+            splices, self._transaction = self._transaction, None
+            self._revert_splices(splices)
+            self._edit = None
+            if isinstance(e, Exception) and len(self._observers) > 0:
+                self.notify_observers("ChangeFail", e)
+            raise
+        splices, self._transaction = self._transaction, None
+        if len(splices) == 0:
+            self.notify_observers("NoChange")
+            return
+        edit = _splices_window(splices)
+        self._record_step(splices, edit)
+        self._mark_edit(*edit)
+        self._update_profile()
+        self.notify_observers("ChangeSuccess")
+
     def _editableify(self):
-        for i in range(0, len(self._track)):
-            editable_seg = EditableTrackSeg.editableify(self._track[i])
-            self._track[i] = editable_seg
+        """Turns the loaded segs into the columns"""
+        segs = self._track
+        self._bounds = [segs[0].get_start()]
+        self._speeds = []
+        for seg in segs:
+            if seg.get_start()._val != self._bounds[-1]._val:
+                raise ValueError("seg {} doesn't start where the one before "\
+                        "it ends".format(seg))
+            self._bounds.append(seg.get_end())
+            self._speeds.append(seg.get_speed())
 
     def __str__(self):
         return Track.__str__(self) + "\nEditable"
@@ -285,15 +483,160 @@ class EditableTrack(Track, Observable):
         boundary and speed represents speed limit between that boundary and 
         next PosSpeed's boundary. Final PosSpeed is end of track, so has
         speed None.'''
-        speed_limits = []
-        for seg in self._track:
-            speed_limits.append(PosSpeed(seg.get_start().to_bg().val(), 
-                seg.get_speed().to_bg().val()))
-            if (seg is self._track[-1]):
-                # append very end of track
-                speed_limits.append(PosSpeed(seg.get_end().to_bg().val(), None))
+        speed_limits = [PosSpeed(start.to_bg().val(), speed.to_bg().val()) \
+                for start, speed in zip(self._bounds, self._speeds)]
+        if len(self._speeds) > 0:
+            # append very end of track
+            speed_limits.append(PosSpeed(self._bounds[-1].to_bg().val(), None))
         return speed_limits
 
+    def enable_profile(self, accel, resolution):
+        """Starts keeping a best-speed profile for a train with acceleration
+        accel, sampled every resolution (in the small units). After that each
+        edit only re-simulates the points it can affect: from the edited segs
+        out to where the new forward and reverse speeds rejoin the old ones,
+        which is at the latest the nearest stop."""
+        self._resolution = _float_val(resolution)
+        self._two_a = 2.0 * _float_val(accel)
+        self._edit = None
+        self._rebuild_profile()
+
+    def get_best_speeds(self):
+        """Best speeds as PosSpeeds of floats in the small units, as a
+        float-mode Simulation.run() would give them"""
+        self._check_profile()
+        best_speeds = list(self._gen_points(0))
+        return [ps for i, ps in enumerate(best_speeds) \
+                if i == 0 or ps != best_speeds[i-1]]
+
+    def get_best_speeds_between(self, first, last):
+        """get_best_speeds()'s points from position first to last (floats,
+        small units), e.g. those in get_changed_window(). Takes time for the
+        points in the span, not for the whole track, so a view can follow
+        each edit without the cost growing with the track's length."""
+        self._check_profile()
+        # seg i's points are in (bounds[i], bounds[i+1]], so the first seg
+        # that can have one at or after first ends at or after it
+        i = max(0, bisect_left(self._bounds, first, key=_raw_val) - 1)
+        prev = None
+        if i > 0:
+            chunk = self._chunks[i-1]
+            prev = PosSpeed(chunk.pos[-1], sqrt(min(chunk.fwd[-1],
+                chunk.rev[-1])))
+        best_speeds = []
+        for ps in self._gen_points(i):
+            if ps.pos > last:
+                break
+            if ps.pos >= first and ps != prev:
+                best_speeds.append(ps)
+            prev = ps
+        return best_speeds
+
+    def _check_profile(self):
+        if self._chunks is None:
+            if self._resolution is None:
+                raise SituationError("profile not enabled")
+            # an earlier edit left it uncomputable; maybe this one fixed it
+            self._rebuild_profile()
+
+    def _gen_points(self, first):
+        """Every chunk's points from chunk first on, as PosSpeeds, except
+        the very end of the track, which isn't a point of its own"""
+        chunks = self._chunks
+        for k in range(first, len(chunks)):
+            chunk = chunks[k]
+            n = len(chunk.pos)
+            if k == len(chunks) - 1:
+                n -= 1
+            for j in range(n):
+                yield PosSpeed(chunk.pos[j], sqrt(min(chunk.fwd[j],
+                    chunk.rev[j])))
+
+    def get_changed_window(self):
+        """(first, last) positions (floats, small units) whose best speed the
+        last edit may have changed, or None"""
+        return self._changed
+
+    def _mark_edit(self, first, old_count, new_count):
+        """Edit methods call this once they've replaced the old_count segs
+        from index first on with new_count segs"""
+        self._edit = (first, old_count, new_count)
+
+    def _rebuild_profile(self):
+        self._chunks = None
+        self._edit = None
+        chunks = [ProfileChunk(seg, self._resolution, self._two_a) \
+                for seg in self._track]
+        self._chunks = chunks
+        if len(chunks) > 0:
+            self._update_fwd(0)
+            self._update_rev(len(chunks) - 1)
+        self._changed = None
+
+    def _update_profile(self):
+        if self._resolution is None:
+            return
+        if self._chunks is None or self._edit is None:
+            # no record of what changed, so redo everything
+            try:
+                self._rebuild_profile()
+            except ValueError:
+                self._chunks = None
+            return
+        first, old_count, new_count = self._edit
+        self._edit = None
+        try:
+            new_chunks = [ProfileChunk(seg, self._resolution, self._two_a) \
+                    for seg in self._track[first:first+new_count]]
+        except ValueError:
+            self._chunks = None
+            return
+        self._chunks[first:first+old_count] = new_chunks
+        last_fwd = self._update_fwd(first)
+        first_rev = self._update_rev(first + new_count - 1)
+        self._changed = (self._chunks[first_rev].pos[0],
+                self._chunks[last_fwd].pos[-1])
+
+    def _update_fwd(self, first):
+        """Recomputes forward speeds from chunk first on until they rejoin
+        the old ones. Returns the index of the last chunk changed."""
+        chunks = self._chunks
+        if first > 0:
+            fwd = chunks[first-1].fwd[-1]
+        else:
+            fwd = 0.0 # train starts out stopped
+        for i in range(first, len(chunks)):
+            chunk = chunks[i]
+            for j in range(len(chunk.pos)):
+                fwd = min(chunk.limit, fwd + chunk.step)
+                if chunk.fwd[j] == fwd:
+                    return i
+                chunk.fwd[j] = fwd
+        return len(chunks) - 1
+
+    def _update_rev(self, last):
+        """Recomputes reverse speeds from chunk last back until they rejoin
+        the old ones. A point's reverse speed comes from the seg of the point
+        after it. Returns the index of the first chunk changed."""
+        chunks = self._chunks
+        if last + 1 < len(chunks):
+            after = chunks[last+1]
+            limit, step, rev = after.limit, after.step, after.rev[0]
+        else:
+            limit, step, rev = None, None, None
+        for i in range(last, -1, -1):
+            chunk = chunks[i]
+            for j in range(len(chunk.pos) - 1, -1, -1):
+                if rev is None:
+                    new_rev = 0.0 # train ends stopped
+                else:
+                    new_rev = min(limit, rev + step)
+                if chunk.rev[j] == new_rev:
+                    return i
+                chunk.rev[j] = new_rev
+                limit, step, rev = chunk.limit, chunk.step, new_rev
+        return 0
+
     @_common_notify
     def append_seg(self, speed, length):
         # no need to validate, EditableTrackSeg takes care of that
@@ -313,11 +656,14 @@ class EditableTrack(Track, Observable):
             start = self._track[-1].get_end()
             end = start + length
 
-        # append new EditableTrackSeg
-        self._track.append(EditableTrackSeg(index, start, end, speed))
+        # checks the new seg, then appends its end and speed
+        seg = EditableTrackSeg(index, start, end, speed)
+        self._splice(index, 0, [seg.get_start(), seg.get_end()],
+                [seg.get_speed()])
+        self._mark_edit(index, 0, 1)
 
     # Splits track segment that mp intersects with, at mp, into 2 new segs
-    # and updates subsequent segs' indexes accordingly
+    # (subsequent segs' indexes follow, being where they are)
     # Throws if mp lies on boundary of track segment (i.e. mp == seg.get_start()
     # or mp == seg.get_end() for some segment seg)
     @_common_notify
@@ -336,22 +682,13 @@ class EditableTrack(Track, Observable):
         # checks up there ^^^ guarantee there's exactly 1 seg in question
         seg_to_split = self._intersecting_segs(mp)[0]
 
-        # make seg_to_split's end be mp, and make new seg whose start is mp
-        # and end is seg_to_split's old end
-        old_end = seg_to_split.get_end()
-        seg_to_split.set_end(mp)
-        import copy
-        new_seg = EditableTrackSeg(seg_to_split.get_index() + 1, copy.copy(mp), 
-                old_end, seg_to_split.get_speed())
-
-        # insert new_seg
+        # mp becomes the boundary between seg_to_split and a new seg with
+        # the same speed that runs to seg_to_split's old end
         new_seg_i = seg_to_split.get_index() + 1
-        self._track.insert(new_seg_i, new_seg)
-
-        # update subsequent segs' index members
-        for i in range(new_seg_i+1, len(self._track)):
-            self._track[i].set_index(i)
+        self._splice(new_seg_i - 1, 1, [seg_to_split.get_start(), mp,
+            seg_to_split.get_end()], [seg_to_split.get_speed()] * 2)
 
+        self._mark_edit(new_seg_i - 1, 1, 2)
 
         # that should do it
 
@@ -383,10 +720,6 @@ class EditableTrack(Track, Observable):
             raise RuntimeError("{} doesn't intersect with any track segment..."\
                     " Previous checks should have stopped this".format(mp))
 
-        # It occurs to me that having one TrackSeg's _end refer to the same
-        # object as next TrackSeg's _start would be desirable...
-        # TODO
-
         #import math
         #min_index = math.inf
         #for s in intersecting:
@@ -401,21 +734,15 @@ class EditableTrack(Track, Observable):
 
         print("*********", mp.to_bigger_unit(), min_index, max_index, max_end.to_bigger_unit(), max_speed, "*************")
 
-        # Toss unneeded segments into the ether
-        for i in range(min_index+1, max_index+1):
-            self._track.pop(i)
+        # check the joined seg before changing anything
+        joined = intersecting[0].with_end(max_end).with_speed(max_speed)
 
-        # modify segment at min_index to have correct properties
-        self._track[min_index].set_end(max_end)
-        self._track[min_index].set_speed(max_speed)
+        # the boundaries inside it go into the ether. Later segs' indexes
+        # follow.
+        self._splice(min_index, max_index - min_index + 1,
+                [joined.get_start(), joined.get_end()], [joined.get_speed()])
 
-        # adjust subsequent segments' indexes
-        for s in self._track[min_index+1:]:
-            old_i = s.get_index()
-            s.set_index(old_i - (max_index - min_index))
-
-        print("track with segments joined at", mp.to_bigger_unit(),":", self)
-        pass
+        self._mark_edit(min_index, max_index - min_index + 1, 1)
 
     @_common_notify
     def shift_speed_limit(self, mp, speed_diff):
@@ -474,7 +801,8 @@ class EditableTrack(Track, Observable):
                     "so speed cannot be 0".format(seg))
         else:
             # we're good
-            seg.set_speed(new_speed)
+            self._replace_seg(seg.with_speed(new_speed))
+            self._mark_edit(seg.get_index(), 1, 1)
             return True
 
     # Shifts a boundary of a track seg and of its neighbor if applicable
@@ -550,6 +878,11 @@ class EditableTrack(Track, Observable):
             # somehow we have multiple adjacent 0-length segments
             raise Adjacent0LenExistsError("Multiple adjacent 0-length segs at "\
                     + str(mp) + " (programming error)")
+        # a neighbour either side too, in case a shrink spilled into it
+        indices = [seg.get_index() for seg in intersecting]
+        first = max(0, min(indices) - 1)
+        last = min(len(self._track) - 1, max(indices) + 1)
+        self._mark_edit(first, last - first + 1, last - first + 1)
         pass
 
     def _shift_2_boundary(self, intersecting, dist):
@@ -620,40 +953,30 @@ class EditableTrack(Track, Observable):
                         "at {}".format(shrinkseg_boundary, dist,
                             shrinkseg_other_end))
 
-        # save old values in case we need to back out
-        # (e.g. trying to make length of 0-speed seg nonzero)
-        lseg_orig_end = intersecting[0].get_end()
-        rseg_orig_start = intersecting[1].get_start()
-
-        # do the actual work
-        try:
-            intersecting[0].set_end(lseg_orig_end+dist)
-            intersecting[1].set_start(rseg_orig_start+dist)
-        except Non0LengthOf0SpeedSegPotentialError as e:
-            # undo what might have been done
-            intersecting[0].set_end(lseg_orig_end)
-            # technically don't need next line but included for symmetry
-            intersecting[1].set_start(rseg_orig_start)
-            raise e
+        # do the actual work. Both new segs are made before either goes in
+        # the track, so if one can't be (e.g. trying to make length of
+        # 0-speed seg nonzero) there's nothing to back out
+        lseg = intersecting[0].with_end(intersecting[0].get_end()+dist)
+        rseg = intersecting[1].with_start(intersecting[1].get_start()+dist)
 
         # invariant
-        if intersecting[0].get_end() != intersecting[1].get_start():
+        if lseg.get_end() != rseg.get_start():
             raise RuntimeError("Track seg {} end {} != seg {} start {}"\
-                    .format(intersecting[0].get_index(),
-                        intersecting[0].get_end(),
-                        intersecting[1].get_index(),
-                        intersecting[1].get_start()))
+                    .format(lseg.get_index(), lseg.get_end(),
+                        rseg.get_index(), rseg.get_start()))
+        self._replace_seg(lseg)
+        self._replace_seg(rseg)
 
     def _expand_one_seg(self, seg, dist):
         if dist > 0:
-            boundary_shifter = seg.set_end
+            boundary_shifter = seg.with_end
             orig_boundary = seg.get_end()
         elif dist < 0:
-            boundary_shifter = seg.set_start
+            boundary_shifter = seg.with_start
             orig_boundary = seg.get_start()
 
         # might raise Non0LengthOf0SpeedSegPotentialError
-        boundary_shifter(orig_boundary + dist)
+        self._replace_seg(boundary_shifter(orig_boundary + dist))
 
     def _shift_1_boundary(self, seg, mp, dist):
         """shifts boundary of seg at mp; ONLY CALL THIS IF NO ADJACENT SEG
@@ -663,32 +986,118 @@ class EditableTrack(Track, Observable):
             # but better safe than sorry
             raise ValueError("{} not on track segment boundary".format(mp))
         if mp == seg.get_start():
-            boundary_setter = seg.set_start
+            boundary_setter = seg.with_start
         elif mp == seg.get_end():
-            boundary_setter = seg.set_end
+            boundary_setter = seg.with_end
 
-        boundary_setter(mp + dist)
+        new_seg = boundary_setter(mp + dist)
 
-        # check if this made seg 0-length
-        if seg.length() == 0:
+        # check if this would make seg 0-length
+        if new_seg.length() == 0:
             # make sure resulting 0-length seg not next to another 0-length
-            adjacent_seg = self._seg_adjacent_to(seg, '+')
-            if adjacent_seg is not None and adjacent_seg.length()==0:
-                # undo problematic shift
-                boundary_setter(mp)
-                raise Adjacent0LenPotentialError("moving boundary at "\
-                        "{} by {} creates multiple 0-length segments "\
-                        "at {}".format(shrinkseg_boundary, dist,
-                            shrinkseg_other_end))
-            adjacent_seg = self._seg_adjacent_to(seg, '-')
-            if adjacent_seg is not None and adjacent_seg.length()==0:
-                # undo problematic shift
-                boundary_setter(mp)
-                raise Adjacent0LenPotentialError("moving boundary at "\
-                        "{} by {} creates multiple 0-length segments "\
-                        "at {}".format(shrinkseg_boundary, dist,
-                            shrinkseg_other_end))
+            for direction in ('+', '-'):
+                adjacent_seg = self._seg_adjacent_to(seg, direction)
+                if adjacent_seg is not None and adjacent_seg.length()==0:
+                    # new_seg never went in the track, so nothing to undo
+                    raise Adjacent0LenPotentialError("moving boundary at "\
+                            "{} by {} creates multiple 0-length segments "\
+                            "at {}".format(mp, dist, mp + dist))
+        self._replace_seg(new_seg)
+
+
+    def _replace_seg(self, seg):
+        """puts seg in place of the seg with its index"""
+        i = seg.get_index()
+        self._splice(i, 1, [seg.get_start(), seg.get_end()],
+                [seg.get_speed()])
+
+    def _splice(self, first, old_count, bounds, speeds):
+        """Replaces the old_count segs from index first on with len(speeds)
+        segs: speeds, and bounds, which run from the first one's start to
+        the last one's end. Every change to the columns goes through here,
+        so the edit under way can be undone."""
+        inverse = self._apply_splice(first, old_count, bounds, speeds)
+        if self._step is not None:
+            self._step.append(inverse)
+
+    def _apply_splice(self, first, old_count, bounds, speeds):
+        """Does a splice, returning the one that undoes it"""
+        old_bounds = self._bounds[first:first+old_count+1]
+        old_speeds = self._speeds[first:first+old_count]
+        self._bounds[first:first+old_count+1] = bounds
+        self._speeds[first:first+old_count] = speeds
+        return (first, len(speeds), old_bounds, old_speeds)
+
+    def _revert_splices(self, splices):
+        """Undoes splices, last first. Returns the splices that redo them."""
+        return [self._apply_splice(*splice) for splice in reversed(splices)]
+
+    def _push_undo(self, step):
+        if len(self._undo) == self._undo.maxlen:
+            self._base = self._undo[0].serial if len(self._undo) > 0 \
+                    else step.serial
+        self._undo.append(step)
+
+    def _check_not_in_transaction(self):
+        if self._transaction is not None:
+            raise SituationError("can't undo or redo in a transaction")
+
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    @_common_notify
+    def undo(self):
+        """Undoes the last edit (one still in the history)"""
+        self._check_not_in_transaction()
+        if len(self._undo) == 0:
+            raise SituationError("nothing to undo")
+        self._undo_step()
+
+    def _undo_step(self):
+        step = self._undo.pop()
+        redo = self._revert_splices(step.splices)
+        if step.edit is not None:
+            first, old_count, new_count = step.edit
+            self._mark_edit(first, new_count, old_count)
+        self._redo.append(step._replace(splices=redo))
+
+    @_common_notify
+    def redo(self):
+        """Does the last undone edit again, if there's been no edit since"""
+        self._check_not_in_transaction()
+        if len(self._redo) == 0:
+            raise SituationError("nothing to redo")
+        step = self._redo.pop()
+        undo = self._revert_splices(step.splices)
+        if step.edit is not None:
+            self._mark_edit(*step.edit)
+        self._push_undo(step._replace(splices=undo))
+
+    def checkpoint(self):
+        """Marks where the track is now in the history, for undo_to()"""
+        if len(self._undo) == 0:
+            return self._base
+        return self._undo[-1].serial
 
+    @_common_notify
+    def undo_to(self, checkpoint):
+        """Undoes every edit since checkpoint() returned checkpoint, as one
+        change. Raises SituationError, changing nothing, if some of them are
+        no longer in the history or it was undone and edited over."""
+        self._check_not_in_transaction()
+        if self.checkpoint() == checkpoint:
+            return False
+        if checkpoint != self._base and \
+                checkpoint not in [step.serial for step in self._undo]:
+            raise SituationError("checkpoint {} not in the history".format(
+                checkpoint))
+        while self.checkpoint() != checkpoint:
+            self._undo_step()
+        # the steps' windows don't line up, so the profile is redone
+        self._edit = None
 
     def _seg_adjacent_to(self, seg, direction):
         """returns track seg next to seg in + or - direction or None if no
@@ -725,58 +1134,14 @@ class EditableTrack(Track, Observable):
             raise ValueError("mp {} > max mp {}".format(mp, 
                 self._track[-1].get_end()))
 
-        # we'll have to do a search
-        low_index = 0
-        high_index = len(self._track) - 1
-        check_index = round((low_index + high_index) / 2)
-
-        #print("mp:", mp)
-
-        while True:
-            seg = self._track[check_index]
-
-            #print("low_index:", low_index, " check_index:", check_index,
-            #    " high_index:", high_index)
-            #print("seg:", seg)
-            if seg.get_start() <= mp and seg.get_end() >= mp:
-                break
-            elif seg.get_start() > mp:
-                # - 1 b/c seg at check_index is NOT intersected
-                high_index = check_index - 1
-            elif seg.get_end() < mp:
-                # + 1 b/c seg at check_index is NOT intersected
-                low_index = check_index + 1
-            else:
-                # should never get here
-                raise RuntimeError("got past if-elifs that should've exhausted"+
-                    "all possibilities (i.e., you should never see this)")
-
-            #print("NEW: low_index:", low_index, " high_index:", high_index)
-            #print("---------------")
-
-            # the + 1 and - 1 ensure that low or high will always change
-            # each iteration, so we can't get stuck
-            # but just in case, let's make sure low <= high:
-            if not (low_index <= high_index):
-                raise RuntimeError("somehow low index > high index ("+
-                        str(low_index)+" > "+str(high_index)+")")
-
-            check_index = round((low_index + high_index) / 2)
-            # that biases check_index to equal high_index when high_index - 
-            # low_index == 1
-
-        # check if other segs before or after check_index also intersected
-        intersected = []
-        # before
-        low_i = check_index
-        while low_i-1 >= 0 and self._track[low_i-1].get_end() == mp:
-            low_i = low_i - 1
-        # after
-        hi_i = check_index
-        while hi_i+1 < len(self._track) \
-                and self._track[hi_i+1].get_start() == mp:
-            hi_i = hi_i + 1
-
+        # boundaries equal to mp are bounds[lo:hi]; mp is inside seg lo-1
+        # if there are none, otherwise it's the end of seg lo-1 and the
+        # start of segs lo to hi-1 (those that exist)
+        target = mp._val if isinstance(mp, Pos) else mp
+        lo = bisect_left(self._bounds, target, key=_raw_val)
+        hi = bisect_right(self._bounds, target, lo, key=_raw_val)
+        low_i = max(0, lo - 1)
+        hi_i = min(len(self._speeds), max(lo, hi)) - 1
         return self._track[low_i:hi_i+1]
 
 
@@ -1025,8 +1390,10 @@ class TestEditableTrack(unittest.TestCase):
         # (I'll have to make one first)
         self.assertEqual(self.shorttrack._track[0].get_speed(),
                 Speed('0', 'mi/h').to_sm())
-        self.shorttrack._track[0].set_speed(Speed('10', 'mi/h').to_sm())
-        # really I don't need the following line b/c set_speed() already tested
+        self.shorttrack._track[0] = self.shorttrack._track[0].with_speed(
+                Speed('10', 'mi/h').to_sm())
+        # really I don't need the following line b/c with_speed() already
+        # tested
         self.assertEqual(self.shorttrack._track[0].get_speed(),
                 Speed('10', 'mi/h').to_sm())
         self.shorttrack.shift_boundary(Pos('10.1', 'mi').to_sm(),
@@ -1100,7 +1467,8 @@ class TestEditableTrack(unittest.TestCase):
                     Pos('0.5', 'mi').to_sm())
 
         # raise its speed so we CAN do that
-        self.shorttrack._track[-1].set_speed(Speed('30', 'mi/h').to_sm())
+        self.shorttrack._track[-1] = self.shorttrack._track[-1].with_speed(
+                Speed('30', 'mi/h').to_sm())
         # I need to make an EditableTrack-level method to change speed TODO
 
         # Shift end of track (should test _shift_2_boundary())
@@ -1278,6 +1646,228 @@ class TestEditableTrack(unittest.TestCase):
         self.assertEqual(self.shorttrack._track[4].get_speed(),
                 Speed('0', 'mi/h').to_sm())
 
+    def test_shared_boundaries(self):
+        track = self.filetrack
+        tenth = Pos('0.1', 'mi').to_sm()
+        for i in (40, 30, 20, 10):
+            seg = track._track[i]
+            if seg.length() > tenth:
+                track.split_seg(seg.get_start() + tenth)
+        track.join_segs(track._track[5].get_end())
+        track.shift_boundary(track._track[12].get_end(), Pos('-0.05',
+            'mi').to_sm())
+        segs = list(track._track)
+        self.assertEqual(len(track._bounds), len(segs) + 1)
+        for i, (a, b) in enumerate(zip(segs, segs[1:])):
+            self.assertEqual(a.get_index(), i)
+            # the very same Pos, not just an equal one
+            self.assertIs(a.get_end(), b.get_start())
+        # the bisect finds what looking at every seg would
+        for mp in (segs[0].get_start(), segs[7].get_end(), segs[12].get_end(),
+                segs[12].get_end() + tenth, segs[-1].get_end()):
+            self.assertEqual(track._intersecting_segs(mp), [seg for seg in \
+                    segs if seg.get_start() <= mp <= seg.get_end()])
+
+class TestIncrementalProfile(unittest.TestCase):
+    def setUp(self):
+        from convunits import Accel
+        self.accel = Accel('1.25', "f/s^2")
+        self.res = Pos('528', "f")
+        self.track = EditableTrack("short_maxspeeds.csv", "imperial")
+        self.track.enable_profile(self.accel, self.res)
+
+    def assertMatchesFullRun(self):
+        sim = Simulation(self.track, self.accel, self.res, "imperial",
+                "analytic", "float")
+        sim.run()
+        self.assertTrue(Simulation.profiles_match(sim.get_best_speeds(),
+            self.track.get_best_speeds()))
+
+    def test_edits(self):
+        self.assertMatchesFullRun()
+        self.track.shift_speed_limit(Pos('10.7', 'mi').to_sm(),
+                Speed('-20', 'mi/h').to_sm())
+        self.assertMatchesFullRun()
+        self.track.split_seg(Pos('12.0', 'mi').to_sm())
+        self.assertMatchesFullRun()
+        self.track.shift_speed_limit(Pos('12.2', 'mi').to_sm(),
+                Speed('15', 'mi/h').to_sm())
+        self.assertMatchesFullRun()
+        self.track.shift_boundary(Pos('12.0', 'mi').to_sm(),
+                Pos('-0.1', 'mi').to_sm())
+        self.assertMatchesFullRun()
+        self.track.join_segs(Pos('11.9', 'mi').to_sm())
+        self.assertMatchesFullRun()
+        # a full run wants the track to end in a stop
+        self.track.append_seg(Speed('20', 'mi/h').to_sm(),
+                Pos('0.5', 'mi').to_sm())
+        self.track.append_seg(Speed('0', 'mi/h').to_sm(),
+                Pos('0', 'mi').to_sm())
+        self.assertMatchesFullRun()
+
+    def test_window_is_local(self):
+        track = EditableTrack("sprinter_maxspeeds_stations.csv", "imperial")
+        track.enable_profile(self.accel, self.res)
+        track.shift_speed_limit(Pos('109.5', 'mi').to_sm(),
+                Speed('-5', 'mi/h').to_sm())
+        first, last = track.get_changed_window()
+        # a few miles around the edit, not the whole ~25 mi
+        self.assertLess(last - first, Pos('5', 'mi').to_sm().val())
+        self.assertLessEqual(first, Pos('109.5', 'mi').to_sm().val())
+        self.assertGreaterEqual(last, Pos('109.5', 'mi').to_sm().val())
+        self.assertEqual(track.get_best_speeds_between(first, last),
+                [ps for ps in track.get_best_speeds() \
+                        if first <= ps.pos <= last])
+        # and the whole track, ends included
+        self.assertEqual(track.get_best_speeds_between(0.0, float("inf")),
+                track.get_best_speeds())
+
+class TestUndo(unittest.TestCase):
+    class Recorder:
+        def __init__(self, observable):
+            observable.register_observer(self)
+            self.events = []
+
+        def notify(self, observable, event, *args):
+            self.events.append(event)
+
+    def setUp(self):
+        from convunits import Accel
+        self.accel = Accel('1.25', "f/s^2")
+        self.res = Pos('528', "f")
+        self.track = EditableTrack("short_maxspeeds.csv", "imperial")
+        self.track.enable_profile(self.accel, self.res)
+        self.recorder = self.Recorder(self.track)
+
+    def edit_all_ways(self):
+        track = self.track
+        track.shift_speed_limit(Pos('10.7', 'mi').to_sm(),
+                Speed('-20', 'mi/h').to_sm())
+        track.split_seg(Pos('12.0', 'mi').to_sm())
+        track.shift_boundary(Pos('12.0', 'mi').to_sm(),
+                Pos('-0.1', 'mi').to_sm())
+        track.join_segs(Pos('11.9', 'mi').to_sm())
+        track.append_seg(Speed('20', 'mi/h').to_sm(), Pos('0.5', 'mi').to_sm())
+
+    def test_undo_redo(self):
+        before = self.track.get_limits()
+        profile_before = self.track.get_best_speeds()
+        self.edit_all_ways()
+        after = self.track.get_limits()
+        profile_after = self.track.get_best_speeds()
+        for i in range(5):
+            self.track.undo()
+        self.assertEqual(self.track.get_limits(), before)
+        self.assertEqual(self.track.get_best_speeds(), profile_before)
+        self.assertFalse(self.track.can_undo())
+        for i in range(5):
+            self.track.redo()
+        self.assertEqual(self.track.get_limits(), after)
+        self.assertEqual(self.track.get_best_speeds(), profile_after)
+        self.assertEqual(self.recorder.events, ["ChangeSuccess"] * 15)
+        with self.assertRaises(SituationError):
+            self.track.redo()
+        self.assertEqual(self.recorder.events[-1], "ChangeFail")
+        # a new edit drops what could have been redone
+        self.track.undo()
+        self.track.split_seg(Pos('11.0', 'mi').to_sm())
+        self.assertFalse(self.track.can_redo())
+
+    def test_failed_edit_isnt_recorded(self):
+        before = self.track.get_limits()
+        with self.assertRaises(ValueError):
+            self.track.shift_boundary(Pos('11.3', 'mi').to_sm(),
+                    Pos('5', 'mi').to_sm())
+        self.assertEqual(self.track.get_limits(), before)
+        self.assertFalse(self.track.can_undo())
+
+    def test_checkpoint(self):
+        before = self.track.get_limits()
+        start = self.track.checkpoint()
+        self.track.split_seg(Pos('10.6', 'mi').to_sm())
+        middle = self.track.checkpoint()
+        self.edit_all_ways()
+        self.track.undo_to(middle)
+        self.assertEqual(len(self.track), len(before))
+        self.track.undo_to(start)
+        self.assertEqual(self.track.get_limits(), before)
+        self.assertEqual(self.track.get_best_speeds()[-1].speed, 0.0)
+        # middle was undone, then edited over
+        self.track.split_seg(Pos('11.0', 'mi').to_sm())
+        with self.assertRaises(SituationError):
+            self.track.undo_to(middle)
+
+    def test_history_is_bounded(self):
+        track = EditableTrack("short_maxspeeds.csv", "imperial", history=2)
+        start = track.checkpoint()
+        for mp in ('10.6', '11.0', '12.0'):
+            track.split_seg(Pos(mp, 'mi').to_sm())
+        track.undo()
+        track.undo()
+        self.assertFalse(track.can_undo())
+        with self.assertRaises(SituationError):
+            track.undo_to(start)
+
+class TestTransaction(unittest.TestCase):
+    def setUp(self):
+        from convunits import Accel
+        self.accel = Accel('1.25', "f/s^2")
+        self.res = Pos('528', "f")
+        self.track = EditableTrack("short_maxspeeds.csv", "imperial")
+        self.track.enable_profile(self.accel, self.res)
+        self.recorder = TestUndo.Recorder(self.track)
+
+    def test_commit(self):
+        before = self.track.get_limits()
+        with self.track.transaction():
+            TestUndo.edit_all_ways(self)
+            self.assertEqual(self.recorder.events, [])
+        self.assertEqual(self.recorder.events, ["ChangeSuccess"])
+        # the profile caught up with all of them at once
+        profile = self.track.get_best_speeds()
+        self.track._rebuild_profile()
+        self.assertEqual(profile, self.track.get_best_speeds())
+        # and they're undone together
+        self.track.undo()
+        self.assertEqual(self.track.get_limits(), before)
+
+    def test_rollback(self):
+        before = self.track.get_limits()
+        profile = self.track.get_best_speeds()
+        with self.assertRaises(ValueError):
+            with self.track.transaction():
+                self.track.split_seg(Pos('12.0', 'mi').to_sm())
+                self.track.shift_speed_limit(Pos('12.2', 'mi').to_sm(),
+                        Speed('15', 'mi/h').to_sm())
+                # on a boundary now
+                self.track.split_seg(Pos('12.0', 'mi').to_sm())
+        self.assertEqual(self.track.get_limits(), before)
+        self.assertEqual(self.track.get_best_speeds(), profile)
+        self.assertEqual(self.recorder.events, ["ChangeFail"])
+        self.assertFalse(self.track.can_undo())
+
+    def test_nested(self):
+        with self.track.transaction():
+            self.track.split_seg(Pos('12.0', 'mi').to_sm())
+            middle = self.track.get_limits()
+            try:
+                with self.track.transaction():
+                    self.track.split_seg(Pos('10.6', 'mi').to_sm())
+                    self.track.undo()
+            except SituationError:
+                pass
+            self.assertEqual(self.track.get_limits(), middle)
+        self.assertEqual(self.recorder.events, ["ChangeSuccess"])
+        with self.track.transaction():
+            pass
+        self.assertEqual(self.recorder.events[-1], "NoChange")
+
+    def test_window(self):
+        # an insert then a join further on, in the indices after each
+        splices = [(2, 2, ["a", "b"], ["x"]), (5, 1, ["c", "d", "e"],
+            ["y", "z"])]
+        self.assertEqual(_splices_window(splices), (2, 4, 4))
+
 if __name__ == "__main__":
     seg = EditableTrackSeg(3, Pos('0', "mi").to_smaller_unit(), \
             Pos('0', "mi").to_smaller_unit(), Speed('0', 
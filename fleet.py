@@ -0,0 +1,190 @@
+#! /usr/bin/python3
+
+# Many train classes (accelerations) over one route at one resolution.
+#
+#   python fleet.py MAXSPEEDS_FILE CLASSES_FILE [imperial|metric]
+#
+# CLASSES_FILE is tab-separated like a maxspeeds file: a class name and its
+# acceleration (f/s^2 or m/s^2) per line.
+
+from simulation import Simulation, Track, FloatTrack, EnvelopeSolver, \
+    PosSpeed, PosSpeedColumns, _float_val, numpy
+from convunits import Pos, Speed, Accel, QuantityArray, system_to_unit
+from writers import gen_big_chunks
+from collections import namedtuple
+import csv
+import json
+import sys
+
+TrainClass = namedtuple("TrainClass", ["name", "accel"])
+
+def gen_train_classes(classes_file, units):
+    '''TrainClasses from an open CLASSES_FILE'''
+    accel_unit = {"imperial": "f/s^2", "metric": "m/s^2"}[units]
+    for name, accel in csv.reader(classes_file, delimiter='\t'):
+        yield TrainClass(name, Accel(accel, accel_unit))
+
+class FleetSimulation:
+    '''Best-speed profiles for several TrainClasses over one Track. The track
+    is loaded once, and with numpy its sample points are laid out once (see
+    EnvelopeSolver.best_for()), leaving only the two passes to do per class.
+    In "exact" mode each class still needs an exact Speed for every point
+    not on a speed limit, so the time grows with the number of classes,
+    unlike "float" mode's. Without numpy each class is simulated with the
+    "analytic" engine, still from the one loaded Track.'''
+
+    def __init__(self, filename, classes, resolution, units,
+            numeric="float"):
+        assert resolution > 0 and resolution % 1 == 0
+        assert units in ["imperial", "metric"]
+        if numeric not in ("exact", "float"):
+            raise ValueError("numeric '{}' must be exact or float".format(
+                numeric))
+        self._classes = list(classes)
+        names = [c.name for c in self._classes]
+        if len(set(names)) != len(names):
+            raise ValueError("class names must be unique")
+        self._resolution = resolution
+        self._units = units
+        self._numeric = numeric
+        if isinstance(filename, Track):
+            self._track = filename
+        else:
+            self._track = Track(filename, units)
+        accel_unit = {"imperial": "f/s^2", "metric": "m/s^2"}[units]
+        self._accels = [c.accel.convert_to(accel_unit) for c in self._classes]
+        for accel in self._accels:
+            assert accel > 0
+        self._profiles = {}
+        # with numpy in "float" mode, each class' (positions, speeds) arrays,
+        # and _profiles only made from them when asked for
+        self._columns = {}
+
+    def run(self):
+        if numpy is None:
+            for c, accel in zip(self._classes, self._accels):
+                sim = Simulation(self._track, accel, self._resolution,
+                        self._units, "analytic", self._numeric)
+                sim.run()
+                self._profiles[c.name] = sim.get_best_speeds()
+            return
+
+        if self._numeric == "float":
+            track = self._track if self._track.FLOAT_VALUED else \
+                    FloatTrack(self._track)
+            resolution = _float_val(self._resolution)
+            accels = [_float_val(a) for a in self._accels]
+        else:
+            track = self._track
+            resolution = self._resolution
+            accels = self._accels
+        # the acceleration given here isn't used by best_for()
+        solver = EnvelopeSolver(track, accels[0], resolution, self._numeric)
+        if self._numeric == "float":
+            # a PosSpeed per point would cost more than the passes do
+            for c, columns in zip(self._classes, solver.best_for(accels,
+                    columns=True)):
+                self._columns[c.name] = columns
+            return
+        for c, best_speeds in zip(self._classes, solver.best_for(accels)):
+            self._profiles[c.name] = best_speeds
+
+    def get_profiles(self):
+        '''{class name: best speeds}, as Simulation.get_best_speeds() would
+        give for each class, in the order the classes were given'''
+        for name, (pos, speed) in self._columns.items():
+            if name not in self._profiles:
+                self._profiles[name] = [PosSpeed(p, v) for p, v in \
+                        zip(pos.tolist(), speed.tolist())]
+        return {c.name: self._profiles[c.name] for c in self._classes \
+                if c.name in self._profiles}
+
+    def get_profile_columns(self, name):
+        '''One class' profile as PosSpeedColumns, like
+        Simulation.get_profile_columns()'''
+        if name in self._columns:
+            pos, speed = self._columns[name]
+        else:
+            best_speeds = self._profiles[name]
+            pos = [_float_val(ps.pos) for ps in best_speeds]
+            speed = [_float_val(ps.speed) for ps in best_speeds]
+        return PosSpeedColumns(
+                QuantityArray(Pos, pos, system_to_unit(self._units, "pos",
+                    "small")),
+                QuantityArray(Speed, speed, system_to_unit(self._units,
+                    "speed", "small")))
+
+    def output(self, out=None, fmt="csv"):
+        '''Writes every class' profile keyed by its name: in csv each line
+        starts with the name, in jsonl each object has a "class"'''
+        if out is None:
+            out = sys.stdout
+        if fmt not in ("csv", "jsonl"):
+            raise ValueError("format '{}' must be csv or jsonl".format(fmt))
+        for c in self._classes:
+            name = c.name
+            if name in self._columns:
+                chunks = gen_big_chunks(self._units, self._numeric,
+                        columns=self.get_profile_columns(name))
+            else:
+                chunks = gen_big_chunks(self._units, self._numeric,
+                        self._profiles[name])
+            for pos, speed in chunks:
+                if fmt == "csv":
+                    out.write("".join(["{}, {:.1f}, {}\n".format(name, p, v) \
+                            for p, v in zip(pos, speed)]))
+                else:
+                    out.write("".join(['{{"class": {}, "pos": {}, '\
+                            '"speed": {}}}\n'.format(json.dumps(name), p, v) \
+                            for p, v in zip(pos, speed)]))
+
+
+import unittest
+
+class TestFleetSimulation(unittest.TestCase):
+    def test_matches_separate_runs(self):
+        classes = [TrainClass("freight", Accel('0.5', "f/s^2")),
+                TrainClass("emu", Accel('2.5', "f/s^2")),
+                TrainClass("sprinter", Accel('1.25', "f/s^2"))]
+        res = Pos(528, "f")
+        track = Track("sprinter_maxspeeds_stations.csv", "imperial")
+        for numeric in ("exact", "float"):
+            fleet = FleetSimulation(track, classes, res, "imperial", numeric)
+            fleet.run()
+            profiles = fleet.get_profiles()
+            self.assertEqual(list(profiles), ["freight", "emu", "sprinter"])
+            for c in classes:
+                sim = Simulation(track, c.accel, res, "imperial",
+                        "numpy" if numpy is not None else "analytic",
+                        numeric)
+                sim.run()
+                self.assertEqual(profiles[c.name], sim.get_best_speeds())
+        # slower trains take longer to get up to speed
+        self.assertLess(profiles["freight"][1].speed,
+                profiles["emu"][1].speed)
+
+    def test_output(self):
+        import io
+        fleet = FleetSimulation("short_maxspeeds.csv",
+                [TrainClass("a", Accel('1', "f/s^2")),
+                    TrainClass("b", Accel('2', "f/s^2"))],
+                Pos(528, "f"), "imperial")
+        fleet.run()
+        out = io.StringIO()
+        fleet.output(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), sum(len(p) \
+                for p in fleet.get_profiles().values()))
+        self.assertTrue(lines[0].startswith("a, "))
+        self.assertTrue(lines[-1].startswith("b, "))
+
+if __name__ == "__main__":
+    units = "imperial"
+    if len(sys.argv) > 3:
+        units = sys.argv[3]
+    with open(sys.argv[2]) as classes_file:
+        classes = list(gen_train_classes(classes_file, units))
+    res = {"imperial": Pos(528, "f"), "metric": Pos(100, "m")}[units]
+    fleet = FleetSimulation(sys.argv[1], classes, res, units)
+    fleet.run()
+    fleet.output()
@@ -0,0 +1,260 @@
+#! /usr/bin/python3
+
+# Columnar files: a track's seg boundaries and speed limits, and optionally a
+# best-speed profile, as float64 columns in the small units. ColumnarFile
+# opens one with mmap, so nothing is read until a seg or point is asked for,
+# and then only the pages it's on.
+
+from simulation import Simulation, Track, TrackSeg, PosSpeed, \
+    PosSpeedColumns, _float_val
+from convunits import Pos, Speed, QuantityArray, system_to_unit
+from array import array
+import mmap
+import struct
+import sys
+
+MAGIC = b"TSCOLS\0\0"
+FORMAT_VERSION = 1
+_UNITS = ("imperial", "metric")
+# magic, version, units, then (after padding, so the columns are 8-byte
+# aligned) seg count and profile point count
+_header = struct.Struct("<8sBB6xQQ")
+
+def write_columnar(out, track, units, columns=None):
+    '''Writes track (a Track in units' small units) and, if given, a profile
+    (PosSpeedColumns, as from Simulation.get_profile_columns()) to out, a
+    filename or a binary file. Segs must each start where the last one
+    ended.'''
+    assert units in _UNITS
+    segs = iter(track)
+    first = next(segs)
+    bounds = array('d', [_float_val(first.get_start()),
+        _float_val(first.get_end())])
+    limits = array('d', [_float_val(first.get_speed())])
+    end = first.get_end()
+    for seg in segs:
+        if seg.get_start() != end:
+            raise ValueError("seg {} doesn't start where the last ended"\
+                    .format(seg.get_index()))
+        end = seg.get_end()
+        bounds.append(_float_val(end))
+        limits.append(_float_val(seg.get_speed()))
+    if columns is None:
+        pos = speed = array('d')
+    else:
+        pos = columns.pos.convert_to(system_to_unit(units, "pos", "small"))\
+                .values()
+        speed = columns.speed.convert_to(system_to_unit(units, "speed",
+            "small")).values()
+    if isinstance(out, str):
+        with open(out, "wb") as f:
+            _write_columns(f, units, bounds, limits, pos, speed)
+    else:
+        _write_columns(out, units, bounds, limits, pos, speed)
+
+def _write_columns(f, units, bounds, limits, pos, speed):
+    f.write(_header.pack(MAGIC, FORMAT_VERSION, _UNITS.index(units),
+        len(limits), len(pos)))
+    for column in (bounds, limits, pos, speed):
+        # the columns are native doubles; the file is little-endian
+        if sys.byteorder != "little":
+            column = array('d', column)
+            column.byteswap()
+        f.write(column)
+
+class ColumnarFile:
+    '''A file from write_columnar(), mapped into memory. get_track() and
+    get_profile() are views onto the mapping, valid as long as it is open.
+    Closing it (or leaving a with block) keeps the mapping while anything
+    taken from it is still around.'''
+
+    def __init__(self, filename):
+        if sys.byteorder != "little":
+            raise ValueError("columnar files can only be mapped on "\
+                    "little-endian machines")
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, units_index, n_segs, n_points = \
+                _header.unpack_from(self._mmap)
+        if magic != MAGIC or version != FORMAT_VERSION or \
+                units_index >= len(_UNITS) or len(self._mmap) != \
+                _header.size + 8 * (2 * n_segs + 1 + 2 * n_points):
+            self._mmap.close()
+            raise ValueError("{} isn't a columnar file".format(filename))
+        self._units = _UNITS[units_index]
+        view = memoryview(self._mmap)
+        columns = []
+        offset = _header.size
+        for length in (n_segs + 1, n_segs, n_points, n_points):
+            columns.append(view[offset:offset + 8 * length].cast('d'))
+            offset += 8 * length
+        self._bounds, self._limits, self._pos, self._speed = columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass # views still out there; the mapping goes with the last one
+
+    def get_units(self):
+        return self._units
+
+    def get_track(self):
+        '''The track as a MappedTrack'''
+        return MappedTrack(self._bounds, self._limits)
+
+    def get_profile(self):
+        '''The profile as a MappedProfile, or None if the file has none'''
+        if len(self._pos) == 0:
+            return None
+        return MappedProfile(self._pos, self._speed, self._units)
+
+class _MappedSegs:
+    '''Read-only sequence of float TrackSegs, each made when asked for'''
+
+    def __init__(self, bounds, limits):
+        self._bounds = bounds
+        self._limits = limits
+
+    def __len__(self):
+        return len(self._limits)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("seg index out of range")
+        return TrackSeg(index, self._bounds[index], self._bounds[index+1],
+                self._limits[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+
+class MappedTrack(Track):
+    """A Track whose segs are read from a ColumnarFile's columns as they're
+    needed. Values are floats in the small units, like FloatTrack's, so only
+    the "float" numeric mode can simulate it. The numpy engine uses the
+    columns directly (get_columns()) without making any segs."""
+    FLOAT_VALUED = True
+
+    def __init__(self, bounds, limits):
+        self._track = _MappedSegs(bounds, limits)
+        assert len(self._track) > 0, "there must be at least one track segment"
+
+    def get_columns(self):
+        '''seg boundaries (one more than there are segs) and speed limits, as
+        memoryviews of doubles'''
+        return self._track._bounds, self._track._limits
+
+    def __str__(self):
+        out = "[\n"
+        for seg in self._track:
+            out += repr(seg) + "\n"
+        out += "]"
+        return out
+
+class MappedProfile:
+    '''A profile read from a ColumnarFile: a sequence of PosSpeeds of floats
+    in the small units, like Simulation.get_best_speeds() in "float" mode,
+    each made when asked for'''
+
+    def __init__(self, pos, speed, units):
+        self._pos = pos
+        self._speed = speed
+        self._units = units
+
+    def __len__(self):
+        return len(self._pos)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return PosSpeed(self._pos[index], self._speed[index])
+
+    def __iter__(self):
+        return map(PosSpeed, self._pos, self._speed)
+
+    def get_columns(self):
+        '''PosSpeedColumns over the mapping itself, nothing copied'''
+        return PosSpeedColumns(
+                QuantityArray.from_buffer(Pos, self._pos,
+                    system_to_unit(self._units, "pos", "small")),
+                QuantityArray.from_buffer(Speed, self._speed,
+                    system_to_unit(self._units, "speed", "small")))
+
+
+import unittest
+
+class TestColumnarFile(unittest.TestCase):
+    def test_round_trip(self):
+        import os
+        import tempfile
+        from convunits import Accel
+        accel = Accel(1.25, "f/s^2")
+        res = Pos(528, "f")
+        sim = Simulation("sprinter_maxspeeds_stations.csv", accel, res,
+                "imperial", "analytic", "float")
+        sim.run()
+        track = Track("sprinter_maxspeeds_stations.csv", "imperial")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "sprinter.tscols")
+            write_columnar(filename, track, "imperial",
+                    sim.get_profile_columns())
+            with ColumnarFile(filename) as f:
+                self.assertEqual(f.get_units(), "imperial")
+                mapped = f.get_track()
+                self.assertEqual(len(mapped), len(track))
+                self.assertEqual(mapped.get_stop_indices(),
+                        track.get_stop_indices())
+                seg = next(reversed(mapped))
+                self.assertEqual(seg.get_end(),
+                        _float_val(next(reversed(track)).get_end()))
+                profile = f.get_profile()
+                self.assertEqual(list(profile), sim.get_best_speeds())
+                self.assertEqual(profile.get_columns(),
+                        sim.get_profile_columns())
+                # simulating the mapped track gives the same profile
+                for engine in Simulation.ENGINES:
+                    if engine == "numpy":
+                        try:
+                            import numpy
+                        except ImportError:
+                            continue
+                    again = Simulation(mapped, accel, res, "imperial",
+                            engine, "float")
+                    again.run()
+                    self.assertTrue(Simulation.profiles_match(
+                        again.get_best_speeds(), profile))
+                with self.assertRaises(ValueError):
+                    Simulation(mapped, accel, res, "imperial")
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from convunits import Accel
+    sim = Simulation("sprinter_maxspeeds_stations.csv", Accel(1.25, "f/s^2"),
+            Pos(528, "f"), "imperial", "analytic", "float")
+    sim.run()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "sprinter.tscols")
+        write_columnar(filename, Track("sprinter_maxspeeds_stations.csv",
+            "imperial"), "imperial", sim.get_profile_columns())
+        print("{}: {} bytes".format(filename, os.path.getsize(filename)))
+        with ColumnarFile(filename) as f:
+            print("{} segs, {} profile points; seg 1 is {!r}".format(
+                len(f.get_track()), len(f.get_profile()),
+                f.get_track().get_next_seg(0, "+")))
@@ -0,0 +1,429 @@
+#! /usr/bin/python3
+
+# Routes over a network of lines. Each line is a maxspeeds file with its own
+# mileposts; junctions join a milepost on one line to a milepost on another,
+# and a route is a list of legs (line, from milepost, to milepost), each leg
+# starting where a junction leaves the last one. The train starts and ends
+# each route stopped.
+#
+#   python network.py
+#
+# runs two routes sharing a trunk and prints how much of the second was
+# reused from the first.
+
+from simulation import Track, PosSpeed, _float_val, _float_seg_point
+from convunits import Pos, Speed, system_to_unit
+from collections import namedtuple
+from fractions import Fraction
+from math import sqrt, inf
+import sys
+
+Leg = namedtuple("Leg", ["line", "start", "end"])
+
+class Network:
+    '''Named lines joined at junctions, and named routes through them.
+    Mileposts are given in the big units (mi or km), as in a maxspeeds file,
+    as strings or numbers.'''
+
+    def __init__(self, units):
+        assert units in ["imperial", "metric"]
+        self._units = units
+        self._pos_big = system_to_unit(units, "pos", "big")
+        self._lines = {}
+        self._junctions = set() # {((line, mp), (line, mp))}, both ways round
+        self._cuts = {} # line: set of its junctions' mps
+        self._routes = {}
+
+    def get_units(self):
+        return self._units
+
+    def _mp(self, mp):
+        '''Exact small-unit value of milepost mp'''
+        return Pos(str(mp), self._pos_big).to_smaller_unit()._val
+
+    def add_line(self, name, filename):
+        '''filename can also be an already-loaded Track in the network's
+        units'''
+        if name in self._lines:
+            raise ValueError("line '{}' already added".format(name))
+        if isinstance(filename, Track):
+            track = filename
+        else:
+            track = Track(filename, self._units)
+        if track.FLOAT_VALUED:
+            raise ValueError("line '{}' must be an exact Track".format(name))
+        self._lines[name] = track
+        self._cuts[name] = set()
+
+    def get_line(self, name):
+        return self._lines[name]
+
+    def _check_on_line(self, line, mp):
+        if line not in self._lines:
+            raise KeyError("no line '{}'".format(line))
+        track = self._lines[line]
+        start = track.get_first_seg().get_start()._val
+        end = next(reversed(track)).get_end()._val
+        if not start <= mp <= end:
+            raise ValueError("milepost not on line '{}'".format(line))
+
+    def add_junction(self, line_a, mp_a, line_b, mp_b):
+        '''Joins line_a at mp_a to line_b at mp_b'''
+        a = (line_a, self._mp(mp_a))
+        b = (line_b, self._mp(mp_b))
+        for line, mp in (a, b):
+            self._check_on_line(line, mp)
+        self._junctions.add((a, b))
+        self._junctions.add((b, a))
+        self._cuts[line_a].add(a[1])
+        self._cuts[line_b].add(b[1])
+
+    def add_route(self, name, legs):
+        '''legs are (line, from mp, to mp), each running up the line's
+        mileposts, and each after the first starting at a junction with
+        where the one before ended'''
+        legs = [Leg(line, self._mp(start), self._mp(end)) \
+                for line, start, end in legs]
+        if len(legs) == 0:
+            raise ValueError("route '{}' has no legs".format(name))
+        for leg in legs:
+            self._check_on_line(leg.line, leg.start)
+            self._check_on_line(leg.line, leg.end)
+            if not leg.start < leg.end:
+                raise ValueError("leg on line '{}' must run up the mileposts"\
+                        .format(leg.line))
+        for before, after in zip(legs, legs[1:]):
+            if ((before.line, before.end), (after.line, after.start)) not in \
+                    self._junctions:
+                raise ValueError("no junction from line '{}' to line '{}' "\
+                        "there".format(before.line, after.line))
+        self._routes[name] = legs
+
+    def get_routes(self):
+        return list(self._routes)
+
+    def get_sections(self, route):
+        '''route's legs cut at every junction on them, as (line, from, to) in
+        exact small units. Routes over the same stretch between junctions
+        share its sections.'''
+        sections = []
+        for leg in self._routes[route]:
+            cuts = sorted([leg.start, leg.end] + [mp for mp in \
+                    self._cuts[leg.line] if leg.start < mp < leg.end])
+            sections.extend((leg.line, a, b) for a, b in zip(cuts, cuts[1:]))
+        return sections
+
+class _Section:
+    '''A stretch of a line between two cuts, laid out at one resolution and
+    acceleration. Its points are the sample points in (start, end], each with
+    its seg's limit and the distance from the point before, both as v^2
+    (limit squared, 2ad).
+
+    Forward from an entry v^2 e, the envelope at point k is
+    min(fwd_free[k], e + climb[k]), where fwd_free is the envelope with no
+    limit at the entry and climb[k] is the v^2 gained from the start to k.
+    Likewise backward from an exit v^2 x. So where the section leaves its
+    neighbours and what it needs from them is worked out once, and a profile
+    only depends on (e, x), and not at all on e past e_free (or x past
+    x_free).'''
+
+    def __init__(self, points, limits_sq, steps_sq, start):
+        self.start = start
+        self.points = points # positions relative to start
+        n = len(points)
+        self.climb = 0.0
+        fwd_free = []
+        fwd_climb = []
+        u = inf
+        for limit_sq, step_sq in zip(limits_sq, steps_sq):
+            self.climb += step_sq
+            u = min(limit_sq, u + step_sq)
+            fwd_free.append(u)
+            fwd_climb.append(self.climb)
+        # point k's reverse value comes from the seg point k+1 is on (the
+        # last point's comes from the next section)
+        rev_free = [inf] * n
+        rev_climb = [0.0] * n
+        for k in range(n - 2, -1, -1):
+            rev_free[k] = min(limits_sq[k+1], rev_free[k+1] + steps_sq[k+1])
+            rev_climb[k] = rev_climb[k+1] + steps_sq[k+1]
+        self.fwd_free, self.fwd_climb = fwd_free, fwd_climb
+        self.rev_free, self.rev_climb = rev_free, rev_climb
+        # what the last point hands the next section, with no entry limit
+        self.fwd_exit_free = fwd_free[-1] if n else inf
+        # what the point before the first gets in reverse, with no exit limit
+        if n:
+            self.rev_entry_free = min(limits_sq[0], rev_free[0] + steps_sq[0])
+        else:
+            self.rev_entry_free = inf
+        # past these, e (or x) is above both envelopes everywhere, so it
+        # can't change the profile whatever the other end's condition
+        free = [min(f, r) for f, r in zip(fwd_free, rev_free)]
+        self.e_free = max((m - c for m, c in zip(free, fwd_climb)),
+                default=-inf)
+        self.x_free = max((m - c for m, c in zip(free, rev_climb)),
+                default=-inf)
+        self.profiles = {} # (entry key, exit key): [(pos, speed)]
+
+    def fwd_exit(self, e):
+        return min(self.fwd_exit_free, e + self.climb)
+
+    def rev_entry(self, x):
+        return min(self.rev_entry_free, x + self.climb)
+
+    def key(self, e, x):
+        '''Boundary conditions with the same key give the same profile'''
+        return (inf if e >= self.e_free else e, inf if x >= self.x_free else x)
+
+    def profile(self, key):
+        '''(relative pos, speed) per point, given boundary conditions key'''
+        e, x = key
+        return [(p, sqrt(max(min(f, e + fc, r, x + rc), 0.0))) \
+                for p, f, fc, r, rc in zip(self.points, self.fwd_free,
+                    self.fwd_climb, self.rev_free, self.rev_climb)]
+
+class NetworkSimulation:
+    '''Best-speed profiles for a Network's routes, in the "float" numeric
+    mode, positions being the distance along the route (f or m) from its
+    start.
+
+    Each section a route passes through is laid out once, however many
+    routes share it, and its profile is kept per pair of boundary conditions
+    (the v^2 it enters with going forward and leaves with braking back). A
+    route over already simulated sections with matching conditions reuses
+    their profiles; only its new sections, or those whose conditions differ,
+    are solved. sections_solved and sections_reused count which.'''
+
+    def __init__(self, network, accel, resolution):
+        units = network.get_units()
+        assert accel > 0
+        assert resolution > 0 and resolution % 1 == 0
+        self._network = network
+        self._units = units
+        accel_unit = {"imperial": "f/s^2", "metric": "m/s^2"}[units]
+        self._accel = _float_val(accel.convert_to(accel_unit))
+        pos_small = system_to_unit(units, "pos", "small")
+        self._res = resolution.convert_to(pos_small)._val
+        self._sections = {}
+        self._best_speeds = {}
+        self.sections_solved = 0
+        self.sections_reused = 0
+        self.points_solved = 0
+
+    def _section(self, key):
+        section = self._sections.get(key)
+        if section is None:
+            line, a, b = key
+            section = self._sections[key] = self._lay_out(
+                    self._network.get_line(line), a, b)
+        return section
+
+    def _lay_out(self, track, a, b):
+        '''_Section of track's sample points in (a, b]. A seg cut by a or b
+        is sampled from the cut, so a section is laid out the same whichever
+        route it's on. Where the resolution doesn't divide a seg (or cut
+        piece), the last step is shortened or stretched to end on it, as
+        Simulation's "float" mode does.'''
+        res = self._res
+        res_f = float(res)
+        two_a = 2.0 * self._accel
+        points, limits_sq, steps_sq = [], [], []
+        for seg in track:
+            start = seg.get_start()._val
+            end = seg.get_end()._val
+            if end < a or start > b:
+                continue
+            limit_sq = float(seg.get_speed()._val) ** 2
+            if start == end:
+                if a < start <= b:
+                    points.append(float(start - a))
+                    limits_sq.append(limit_sq)
+                    steps_sq.append(0.0)
+                continue
+            lo, hi = max(start, a), min(end, b)
+            if lo >= hi:
+                continue
+            # the part of the seg in the section is laid out like a seg of
+            # its own: the nearest whole number of steps (at least one), the
+            # last point snapped to its end
+            steps = max(1, round((hi - lo) / res))
+            lo_rel, hi_rel = float(lo - a), float(hi - a)
+            points.extend(_float_seg_point(lo_rel, hi_rel, j, steps, res_f) \
+                    for j in range(1, steps + 1))
+            limits_sq.extend([limit_sq] * steps)
+            steps_sq.extend([two_a * res_f] * steps)
+        return _Section(points, limits_sq, steps_sq, float(a))
+
+    def run(self, route):
+        '''Simulates route, reusing whatever it can, and returns its best
+        speeds as get_best_speeds() would'''
+        keys = self._network.get_sections(route)
+        sections = [self._section(key) for key in keys]
+        # the train starts and ends stopped; boundary conditions pass along
+        # in O(1) per section
+        entries = [0.0]
+        for section in sections[:-1]:
+            entries.append(section.fwd_exit(entries[-1]))
+        exits = [0.0]
+        for section in reversed(sections[1:]):
+            exits.append(section.rev_entry(exits[-1]))
+        exits.reverse()
+
+        best = [PosSpeed(0.0, 0.0)]
+        offset = 0.0
+        for key, section, e, x in zip(keys, sections, entries, exits):
+            bc = section.key(e, x)
+            profile = section.profiles.get(bc)
+            if profile is None:
+                profile = section.profiles[bc] = section.profile(bc)
+                self.sections_solved += 1
+                self.points_solved += len(profile)
+            else:
+                self.sections_reused += 1
+            for pos, speed in profile:
+                ps = PosSpeed(offset + pos, speed)
+                if ps != best[-1]:
+                    best.append(ps)
+            offset += float(key[2] - key[1])
+        self._best_speeds[route] = best
+        return best
+
+    def get_best_speeds(self, route):
+        return self._best_speeds[route]
+
+    def output(self, route, out=None, fmt="csv"):
+        '''Writes route's profile to out (default stdout) in fmt, csv or
+        jsonl, as Simulation.output() does'''
+        from writers import write_profile
+        if out is None:
+            out = sys.stdout
+        if fmt not in ("csv", "jsonl"):
+            raise ValueError("format '{}' must be csv or jsonl".format(fmt))
+        write_profile(out, fmt, self._units, "float",
+                self._best_speeds[route])
+
+
+import unittest
+
+class TestNetwork(unittest.TestCase):
+    # a trunk with a branch off each end's junction, all in mi and mph
+    LINES = {"trunk": "10.0\t30\n10.5\t60\n14.0\t45\n15.0\t45\n",
+            "east": "0.0\t50\n2.0\t20\n2.5\t20\n",
+            "west": "5.0\t60\n5.5\t50\n7.0\t50\n",
+            "spur": "0.0\t10\n1.0\t10\n"}
+
+    def setUp(self):
+        import os
+        import tempfile
+        from convunits import Accel
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.network = Network("imperial")
+        for name, rows in self.LINES.items():
+            filename = os.path.join(self.tmpdir.name, name + ".csv")
+            with open(filename, "w") as f:
+                f.write(rows)
+            self.network.add_line(name, filename)
+        self.network.add_junction("trunk", "15.0", "east", "0.0")
+        self.network.add_junction("trunk", "15.0", "west", "5.0")
+        self.network.add_junction("trunk", "15.0", "spur", "0.0")
+        self.network.add_route("to east", [("trunk", "10.0", "15.0"),
+            ("east", "0.0", "2.5")])
+        self.network.add_route("to west", [("trunk", "10.0", "15.0"),
+            ("west", "5.0", "7.0")])
+        # braking for the spur reaches back onto the trunk
+        self.network.add_route("to spur", [("trunk", "12.0", "15.0"),
+            ("spur", "0.0", "1.0")])
+        self.accel = Accel('1.25', "f/s^2")
+        self.res = Pos(264, "f")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def reference(self, route):
+        '''route as one Track, simulated by Simulation'''
+        from simulation import Simulation, TrackSeg
+        f = Pos(0, "f")
+        segs = [TrackSeg(0, f, f, Speed(0, "f/s"))]
+        offset = Fraction(0)
+        # cut at each section, as NetworkSimulation is
+        for line, a, b in self.network.get_sections(route):
+            for seg in self.network.get_line(line):
+                start = max(seg.get_start()._val, a)
+                end = min(seg.get_end()._val, b)
+                if start < end:
+                    segs.append(TrackSeg(len(segs),
+                        Pos(offset + start - a, "f"),
+                        Pos(offset + end - a, "f"), seg.get_speed()))
+            offset += b - a
+        end = Pos(offset, "f")
+        segs.append(TrackSeg(len(segs), end, end, Speed(0, "f/s")))
+        track = Track.__new__(Track)
+        track._track = segs
+        sim = Simulation(track, self.accel, self.res, "imperial", "analytic",
+                "float")
+        sim.run()
+        return sim.get_best_speeds()
+
+    def test_matches_simulation(self):
+        from simulation import Simulation
+        sim = NetworkSimulation(self.network, self.accel, self.res)
+        for route in self.network.get_routes():
+            self.assertTrue(Simulation.profiles_match(sim.run(route),
+                self.reference(route)))
+
+    def test_off_grid_resolution(self):
+        # 100 f divides neither the segs nor the junctions' offsets
+        from simulation import Simulation
+        self.res = Pos(100, "f")
+        sim = NetworkSimulation(self.network, self.accel, self.res)
+        for route in self.network.get_routes():
+            self.assertTrue(Simulation.profiles_match(sim.run(route),
+                self.reference(route)))
+
+    def test_reuses_shared_trunk(self):
+        sim = NetworkSimulation(self.network, self.accel, self.res)
+        sim.run("to east")
+        self.assertEqual((sim.sections_solved, sim.sections_reused), (2, 0))
+        solved = sim.points_solved
+        # both branches start faster than the trunk's 45 mph end, so the
+        # trunk is left the same way for either and only west is new
+        sim.run("to west")
+        self.assertEqual((sim.sections_solved, sim.sections_reused), (3, 1))
+        self.assertEqual(sim.points_solved - solved, 40)
+
+    def test_bad_routes(self):
+        with self.assertRaises(ValueError):
+            # no junction between them there
+            self.network.add_route("nowhere", [("trunk", "10.0", "14.0"),
+                ("east", "0.0", "2.5")])
+        with self.assertRaises(ValueError):
+            self.network.add_route("backwards", [("trunk", "15.0", "10.0")])
+        with self.assertRaises(ValueError):
+            self.network.add_junction("trunk", "16.0", "east", "0.0")
+
+if __name__ == "__main__":
+    import tempfile
+    import os
+    from convunits import Accel
+    network = Network("imperial")
+    network.add_line("trunk", "sprinter_maxspeeds_stations.csv")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, rows in (("branch a", "121.3\t0\n121.3\t40\n124.0\t0\n"
+                "124.0\t0\n"), ("branch b", "0.0\t0\n0.0\t30\n3.0\t0\n"
+                    "3.0\t0\n")):
+            filename = os.path.join(tmpdir, name + ".csv")
+            with open(filename, "w") as f:
+                f.write(rows)
+            network.add_line(name, filename)
+    network.add_junction("trunk", "121.3", "branch a", "121.3")
+    network.add_junction("trunk", "121.3", "branch b", "0.0")
+    network.add_route("a", [("trunk", "99.3", "121.3"),
+        ("branch a", "121.3", "124.0")])
+    network.add_route("b", [("trunk", "99.3", "121.3"),
+        ("branch b", "0.0", "3.0")])
+    sim = NetworkSimulation(network, Accel('1.25', "f/s^2"), Pos(528, "f"))
+    for route in network.get_routes():
+        sim.run(route)
+        print("route {}: {} points; {} sections solved, {} reused so far"\
+                .format(route, len(sim.get_best_speeds(route)),
+                    sim.sections_solved, sim.sections_reused))
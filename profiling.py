@@ -0,0 +1,118 @@
+#! /usr/bin/python3
+
+from convunits import HasUnit, ConvertibleUnit
+from contextlib import contextmanager
+import copy
+import json
+import time
+
+class Profiler:
+    '''Wall and CPU time per phase of a run, plus counters of the hot path's
+    allocations. Used as a context manager, it hooks HasUnit.__init__,
+    ConvertibleUnit.convert_to and copy.deepcopy to count calls, and unhooks
+    them on the way out. Steps are counted by whoever takes them (count()).
+
+    The hooks make everything they count slower, so times are for comparing
+    phases, not for quoting.'''
+
+    COUNTERS = ("steps", "HasUnit", "convert_to", "deepcopy")
+
+    def __init__(self):
+        self._phases = {} # name: [wall s, CPU s], in the order first seen
+        self._counts = dict.fromkeys(self.COUNTERS, 0)
+        self._unhooks = []
+
+    def __enter__(self):
+        counts = self._counts
+
+        orig_init = HasUnit.__init__
+        def counting_init(self, *args, **kwargs):
+            counts["HasUnit"] += 1
+            orig_init(self, *args, **kwargs)
+
+        orig_convert_to = ConvertibleUnit.convert_to
+        def counting_convert_to(self, unit):
+            counts["convert_to"] += 1
+            return orig_convert_to(self, unit)
+
+        orig_deepcopy = copy.deepcopy
+        def counting_deepcopy(*args, **kwargs):
+            counts["deepcopy"] += 1
+            return orig_deepcopy(*args, **kwargs)
+
+        HasUnit.__init__ = counting_init
+        ConvertibleUnit.convert_to = counting_convert_to
+        copy.deepcopy = counting_deepcopy
+        self._unhooks = [(HasUnit, "__init__", orig_init),
+                (ConvertibleUnit, "convert_to", orig_convert_to),
+                (copy, "deepcopy", orig_deepcopy)]
+        return self
+
+    def __exit__(self, *exc):
+        for owner, name, orig in self._unhooks:
+            setattr(owner, name, orig)
+        self._unhooks = []
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        '''Adds the time spent in the with block to phase name'''
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            times = self._phases.setdefault(name, [0.0, 0.0])
+            times[0] += time.perf_counter() - wall
+            times[1] += time.process_time() - cpu
+
+    def count(self, name, n=1):
+        # anything besides COUNTERS (e.g. the result cache's hits) is only
+        # reported once it has been counted
+        self._counts[name] = self._counts.get(name, 0) + n
+
+    def report(self):
+        '''Phases and counters as a dict (what the JSON report holds)'''
+        phases = {name: {"wall": wall, "cpu": cpu} \
+                for name, (wall, cpu) in self._phases.items()}
+        return {"phases": phases,
+                "total": {"wall": sum(p["wall"] for p in phases.values()),
+                    "cpu": sum(p["cpu"] for p in phases.values())},
+                "counters": dict(self._counts)}
+
+    def format_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def format_text(self):
+        report = self.report()
+        width = max([10] + [len(name) for name in report["counters"]])
+        lines = ["{:<{}} {:>10} {:>10}".format("phase", width, "wall s",
+            "CPU s")]
+        for name, times in list(report["phases"].items()) + \
+                [("total", report["total"])]:
+            lines.append("{:<{}} {:>10.4f} {:>10.4f}".format(name, width,
+                times["wall"], times["cpu"]))
+        lines.append("")
+        for name, n in report["counters"].items():
+            lines.append("{:<{}} {:>10}".format(name, width, n))
+        return "\n".join(lines)
+
+
+import unittest
+
+class TestProfiler(unittest.TestCase):
+    def test_counts_and_unhooks(self):
+        from convunits import Pos
+        orig_init = HasUnit.__init__
+        with Profiler() as profiler:
+            with profiler.phase("work"):
+                p = Pos(1, "mi").convert_to("f")
+                copy.deepcopy(p)
+            profiler.count("steps", 3)
+        self.assertIs(HasUnit.__init__, orig_init)
+        report = profiler.report()
+        self.assertEqual(list(report["phases"]), ["work"])
+        self.assertEqual(report["counters"], {"steps": 3, "HasUnit": 2,
+            "convert_to": 1, "deepcopy": 1})
+        self.assertEqual(json.loads(profiler.format_json()), report)
+        self.assertIn("work", profiler.format_text())
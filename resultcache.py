@@ -0,0 +1,224 @@
+#! /usr/bin/python3
+
+# Simulation results kept on disk, named after a hash of everything that goes
+# into them: the track's contents, units, acceleration, resolution, engine,
+# numeric mode and Simulation.ENGINE_VERSION. Running the same thing again
+# just reads the profile back.
+
+from convunits import Pos, Speed, Accel, system_to_unit
+from fractions import Fraction
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+        "trainspeedsim", "results")
+# 256 MiB
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+class ResultCache:
+    '''Directory of best-speed profiles, at most max_bytes of them. Reading
+    one marks it as just used; storing one evicts the least recently used
+    until what's left fits.
+
+    A profile is stored as JSON: the numeric mode, the small units, and its
+    positions and speeds, each value as a float, an int or, for a Fraction,
+    [numerator, denominator], so it comes back exactly as it went in.'''
+
+    FORMAT_VERSION = 1
+    SUFFIX = ".tsresult"
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("TRAINSPEEDSIM_RESULTS",
+                    DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_BYTES
+        self._dir = cache_dir
+        self._max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(source, units, accel, resolution, engine, numeric, version):
+        '''Hex digest naming the result for a track whose contents are source
+        (bytes). accel and resolution count as equal whatever unit or type
+        they're given in.'''
+        accel_unit = {"imperial": "f/s^2", "metric": "m/s^2"}[units]
+        pos_unit = system_to_unit(units, "pos", "small")
+        h = hashlib.sha256()
+        h.update(source)
+        h.update("\0{}\0{}\0{}\0{}\0{}\0{}".format(units,
+            Fraction(accel.convert_to(accel_unit)._val),
+            Fraction(resolution.convert_to(pos_unit)._val), engine, numeric,
+            version).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def track_source(track):
+        '''Stand-in for the file's contents when given an already-loaded
+        Track: its segs' exact values'''
+        return "\n".join("{} {} {}".format(seg.get_start()._val,
+            seg.get_end()._val, seg.get_speed()._val) \
+            for seg in track).encode()
+
+    def path_for(self, key):
+        return os.path.join(self._dir, key + self.SUFFIX)
+
+    def get(self, key):
+        '''The stored best speeds for key, or None'''
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                stored = json.loads(f.read())
+            best_speeds = self._decode(stored)
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path) # just used
+        except OSError:
+            pass # evicted by someone else meanwhile; we've read it anyway
+        self.hits += 1
+        return best_speeds
+
+    def put(self, key, best_speeds, units, numeric):
+        '''Stores best speeds (from Simulation.get_best_speeds()) under key,
+        then evicts down to the size limit'''
+        data = json.dumps(self._encode(best_speeds, units, numeric),
+                separators=(",", ":")).encode()
+        if len(data) > self._max_bytes:
+            return # would only evict everything, itself included
+        os.makedirs(self._dir, exist_ok=True)
+        # written under another name then renamed, so a reader never sees
+        # half a file
+        fd, tmp = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.path_for(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self._dir):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self._dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self._dir, name))
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _encode(self, best_speeds, units, numeric):
+        if numeric == "float":
+            pos = [ps.pos for ps in best_speeds]
+            speed = [ps.speed for ps in best_speeds]
+        else:
+            pos = [_encode_val(ps.pos._val) for ps in best_speeds]
+            speed = [_encode_val(ps.speed._val) for ps in best_speeds]
+        return {"version": self.FORMAT_VERSION, "numeric": numeric,
+                "pos_unit": system_to_unit(units, "pos", "small"),
+                "speed_unit": system_to_unit(units, "speed", "small"),
+                "pos": pos, "speed": speed}
+
+    def _decode(self, stored):
+        from simulation import PosSpeed
+        if stored["version"] != self.FORMAT_VERSION or \
+                len(stored["pos"]) != len(stored["speed"]):
+            raise ValueError("not a stored result")
+        if stored["numeric"] == "float":
+            return list(map(PosSpeed, stored["pos"], stored["speed"]))
+        pos_unit = stored["pos_unit"]
+        speed_unit = stored["speed_unit"]
+        # speeds repeat (every point held at a limit), so each is made once
+        speeds = {}
+        best_speeds = []
+        for p, v in zip(stored["pos"], stored["speed"]):
+            k = tuple(v) if isinstance(v, list) else v
+            speed = speeds.get(k)
+            if speed is None:
+                speed = speeds[k] = Speed(_decode_val(v), speed_unit)
+            best_speeds.append(PosSpeed(Pos(_decode_val(p), pos_unit),
+                speed))
+        return best_speeds
+
+def _encode_val(v):
+    if isinstance(v, Fraction):
+        return [v.numerator, v.denominator]
+    return v
+
+def _decode_val(v):
+    if isinstance(v, list):
+        return Fraction(*v)
+    return v
+
+
+import unittest
+
+class TestResultCache(unittest.TestCase):
+    def test_hit_returns_stored_profile(self):
+        from simulation import Simulation
+        accel = Accel('1.25', "f/s^2")
+        res = Pos(528, "f")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ResultCache(tmpdir)
+            for numeric in Simulation.NUMERICS:
+                first = Simulation("sprinter_maxspeeds_stations.csv", accel,
+                        res, "imperial", "analytic", numeric, results=cache)
+                first.run()
+                # the same values as a float and from a string
+                again = Simulation("sprinter_maxspeeds_stations.csv",
+                        Accel(1.25, "f/s^2"), Pos('528', "f"), "imperial",
+                        "analytic", numeric, results=cache)
+                again._gen_best_speeds_dir = None # mustn't be needed
+                again.run()
+                self.assertEqual(again.get_best_speeds(),
+                        first.get_best_speeds())
+                self.assertEqual([type(ps.speed) for ps in \
+                        again.get_best_speeds()],
+                        [type(ps.speed) for ps in first.get_best_speeds()])
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+            # a different engine is a different result
+            other = Simulation("sprinter_maxspeeds_stations.csv", accel, res,
+                    "imperial", "step", "float", results=cache)
+            other.run()
+            self.assertEqual(cache.misses, 4)
+
+    def test_lru_eviction(self):
+        from simulation import Simulation
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ResultCache(tmpdir)
+            paths = []
+            for i, res in enumerate((132, 264, 528)):
+                sim = Simulation("sprinter_maxspeeds_stations.csv",
+                        Accel('1.25', "f/s^2"), Pos(res, "f"), "imperial",
+                        "analytic", "float", results=cache)
+                sim.run()
+                paths.append(cache.path_for(sim._result_key))
+                # mtimes a second apart, oldest first
+                os.utime(paths[-1], (i, i))
+            # using the oldest makes the middle one least recently used
+            self.assertIsNotNone(cache.get(os.path.basename(paths[0])[:-len(
+                ResultCache.SUFFIX)]))
+            sizes = [os.path.getsize(p) for p in paths]
+            cache._max_bytes = sizes[0] + sizes[2]
+            cache._evict()
+            self.assertEqual([os.path.exists(p) for p in paths],
+                    [True, False, True])
+            self.assertEqual(cache.evictions, 1)
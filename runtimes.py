@@ -0,0 +1,193 @@
+#! /usr/bin/python3
+
+from simulation import Simulation, PosSpeed, _float_val
+from convunits import HasUnit, Pos, Accel, system_to_unit
+from itertools import accumulate
+from bisect import bisect_right
+from math import sqrt
+
+class RunTimeIndex:
+    '''Elapsed time along a best-speed profile, summed up once so that
+    time_between(), speed_at() and position_at() are each a binary search.
+
+    Between two profile points the train is taken to accelerate uniformly,
+    which is what the engines do (v^2 changes linearly with distance), so an
+    interval of length d from speed v0 to v1 takes 2d / (v0 + v1).
+
+    Positions, speeds and times are floats in the small units (f or m, f/s
+    or m/s, and s). Positions passed in can also be Pos in any unit.'''
+
+    def __init__(self, best_speeds, units, end=None):
+        '''best_speeds as from Simulation.get_best_speeds(). end is the end
+        of the track, where the train is stopped; the profile itself stops
+        one point short of it.'''
+        assert units in ["imperial", "metric"]
+        self._units = units
+        self._pos_unit = system_to_unit(units, "pos", "small")
+        points = [(_float_val(ps.pos), _float_val(ps.speed)) \
+                for ps in best_speeds]
+        if end is not None:
+            end = self._to_float_pos(end)
+            if len(points) == 0 or points[-1][0] != end:
+                points.append((end, 0.0))
+        if len(points) == 0:
+            raise ValueError("empty profile")
+        self._pos = [p for p, v in points]
+        self._speed = [v for p, v in points]
+
+        intervals = []
+        for (p0, v0), (p1, v1) in zip(points, points[1:]):
+            if p1 < p0:
+                raise ValueError("profile goes backwards at {}".format(p1))
+            if p1 == p0:
+                intervals.append(0.0) # speed changes at a point
+            elif v0 + v1 == 0:
+                raise ValueError("train stopped between {} and {}".format(p0,
+                    p1))
+            else:
+                intervals.append(2.0 * (p1 - p0) / (v0 + v1))
+        # _time[i] is when the train reaches point i
+        self._time = list(accumulate(intervals, initial=0.0))
+
+    def get_total_time(self):
+        return self._time[-1]
+
+    def time_at(self, mp):
+        '''Time at which the train passes mp, counted from the profile's
+        first point'''
+        mp = self._to_float_pos(mp)
+        i = self._interval_at(mp)
+        p0, v0 = self._pos[i], self._speed[i]
+        if mp == p0:
+            return self._time[i]
+        v = self._speed_in(i, mp)
+        return self._time[i] + 2.0 * (mp - p0) / (v0 + v)
+
+    def time_between(self, mp_a, mp_b):
+        '''Running time between two positions (in either order)'''
+        return abs(self.time_at(mp_b) - self.time_at(mp_a))
+
+    def speed_at(self, mp):
+        '''Speed at mp. Where the profile has several points at mp (a speed
+        limit change), it's the last of them.'''
+        mp = self._to_float_pos(mp)
+        i = self._interval_at(mp)
+        if mp == self._pos[i]:
+            return self._speed[i]
+        return self._speed_in(i, mp)
+
+    def position_at(self, t):
+        '''Where the train is t s after the profile's first point'''
+        if t < 0 or t > self._time[-1]:
+            raise ValueError("time {} outside 0 - {}".format(t,
+                self._time[-1]))
+        i = bisect_right(self._time, t) - 1
+        if i == len(self._pos) - 1:
+            return self._pos[-1]
+        p0, v0 = self._pos[i], self._speed[i]
+        p1, v1 = self._pos[i+1], self._speed[i+1]
+        dt = t - self._time[i]
+        accel = (v1*v1 - v0*v0) / (2.0 * (p1 - p0))
+        # never past the interval's end, whatever rounding does
+        return min(p1, p0 + v0 * dt + accel * dt * dt / 2.0)
+
+    def get_stations(self):
+        '''Positions where the train is stopped, in order'''
+        stations = []
+        for p, v in zip(self._pos, self._speed):
+            if v == 0 and (len(stations) == 0 or stations[-1] != p):
+                stations.append(p)
+        return stations
+
+    def run_time_table(self, stations=None):
+        '''Table of running times between every pair of stations (default
+        get_stations()): table[i][j] is the time from stations[i] to
+        stations[j]'''
+        if stations is None:
+            stations = self.get_stations()
+        times = [self.time_at(s) for s in stations]
+        return [[abs(tj - ti) for tj in times] for ti in times]
+
+    def output_run_time_table(self, stations=None):
+        '''Prints run_time_table() as CSV, stations as big-unit positions
+        and times as minutes:seconds'''
+        if stations is None:
+            stations = self.get_stations()
+        big = [self._big_pos(s) for s in stations]
+        print(", ".join(["from\\to"] + ["{:.1f}".format(b) for b in big]))
+        for b, row in zip(big, self.run_time_table(stations)):
+            print(", ".join(["{:.1f}".format(b)] + ["{}:{:04.1f}".format(
+                int(t // 60), t % 60) for t in row]))
+
+    def _to_float_pos(self, mp):
+        if isinstance(mp, HasUnit):
+            mp = mp.convert_to(self._pos_unit)
+        return _float_val(mp)
+
+    def _big_pos(self, p):
+        return _float_val(Pos(str(p), self._pos_unit).to_bigger_unit())
+
+    def _interval_at(self, mp):
+        '''Index of the last point at or before mp'''
+        if mp < self._pos[0] or mp > self._pos[-1]:
+            raise ValueError("{} outside profile {} - {}".format(mp,
+                self._pos[0], self._pos[-1]))
+        return bisect_right(self._pos, mp) - 1
+
+    def _speed_in(self, i, mp):
+        '''Speed at mp strictly inside interval i'''
+        p0, v0 = self._pos[i], self._speed[i]
+        p1, v1 = self._pos[i+1], self._speed[i+1]
+        return sqrt(max(0.0, v0*v0 + (v1*v1 - v0*v0) * (mp - p0) / (p1 - p0)))
+
+
+import unittest
+
+class TestRunTimeIndex(unittest.TestCase):
+    def setUp(self):
+        # 0-10 f accelerating to 10 f/s at 5 f/s^2, 10-30 f cruising, 30-40 f
+        # braking
+        self.index = RunTimeIndex([PosSpeed(0, 0), PosSpeed(10, 10),
+            PosSpeed(30, 10)], "imperial", 40)
+
+    def test_times(self):
+        self.assertAlmostEqual(self.index.get_total_time(), 6.0)
+        self.assertAlmostEqual(self.index.time_between(10, 30), 2.0)
+        self.assertAlmostEqual(self.index.time_between(30, 10), 2.0)
+        # halfway along the first interval in time is a quarter in distance
+        self.assertAlmostEqual(self.index.time_at(2.5), 1.0)
+        self.assertAlmostEqual(self.index.position_at(1.0), 2.5)
+        self.assertAlmostEqual(self.index.position_at(3.0), 20.0)
+        self.assertAlmostEqual(self.index.speed_at(2.5), 5.0)
+        self.assertEqual(self.index.get_stations(), [0.0, 40.0])
+        with self.assertRaises(ValueError):
+            self.index.speed_at(41)
+
+    def test_matches_simulation(self):
+        sim = Simulation("sprinter_maxspeeds_stations.csv",
+                Accel('1.25', "f/s^2"), Pos('528', "f"), "imperial",
+                "analytic")
+        sim.run()
+        index = sim.get_run_time_index()
+        # summing the profile directly
+        total = 0.0
+        points = [(_float_val(ps.pos), _float_val(ps.speed)) \
+                for ps in sim.get_best_speeds()]
+        for (p0, v0), (p1, v1) in zip(points, points[1:]):
+            if p1 > p0:
+                total += 2.0 * (p1 - p0) / (v0 + v1)
+        self.assertAlmostEqual(index.get_total_time(), total)
+        stations = index.get_stations()
+        self.assertEqual(stations[-1],
+                float(Pos('121.3', "mi").to_smaller_unit().val()))
+        table = index.run_time_table()
+        self.assertEqual(len(table), len(stations))
+        self.assertAlmostEqual(table[0][-1], total)
+        for t in (0, 100, 1000, total):
+            self.assertAlmostEqual(index.time_at(index.position_at(t)), t)
+
+if __name__ == "__main__":
+    sim = Simulation("sprinter_maxspeeds_stations.csv", Accel('1.25', "f/s^2"),
+            Pos('528', "f"), "imperial", "analytic")
+    sim.run()
+    sim.get_run_time_index().output_run_time_table()
@@ -0,0 +1,446 @@
+#! /usr/bin/python3
+
+# trainspeedsim as a long-running service, so each run skips interpreter
+# startup, imports and (usually) parsing the track.
+#
+#   trainspeedsim serve [--port PORT | --socket PATH] [-j WORKERS]
+#       [--tracks N]
+#
+# speaks just enough HTTP/1.1 on localhost (or a Unix socket):
+#
+#   POST /simulate   body {"args": [trainspeedsim's OPTIONS and INPUT_FILE]}
+#                    answers with what trainspeedsim would write
+#   GET /stats       request count, latency percentiles, queue depth and
+#                    track pool hits, as JSON
+#
+#   curl --unix-socket /tmp/tss.sock -d '{"args": ["-n", "float", "x.csv"]}' \
+#       http://localhost/simulate
+
+from simulation import Simulation, Track, Config, ArgvError
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+DEFAULT_PORT = 8528
+DEFAULT_TRACKS = 16
+# latencies kept for the percentiles
+LATENCY_WINDOW = 1000
+
+class TrackPool:
+    '''The most recently used max_tracks parsed Tracks, each under its file's
+    path, size and modification time and the units, so an edited file is
+    parsed again'''
+
+    def __init__(self, max_tracks=DEFAULT_TRACKS):
+        assert max_tracks > 0
+        self._max = max_tracks
+        self._tracks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def get(self, filename, units, cache=None):
+        st = os.stat(filename)
+        key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns, units)
+        track = self._tracks.get(key)
+        if track is not None:
+            self._tracks.move_to_end(key)
+            self.hits += 1
+            return track
+        self.misses += 1
+        track = self._tracks[key] = Track(filename, units, cache)
+        if len(self._tracks) > self._max:
+            self._tracks.popitem(last=False)
+        return track
+
+# each worker process keeps its own TrackPool, set up by _init_worker()
+_worker_pool = None
+
+def _init_worker(max_tracks):
+    global _worker_pool
+    _worker_pool = TrackPool(max_tracks)
+
+# flags that make no sense without a terminal of one's own
+_UNSERVED = ("stream", "parallel", "outfile", "profile")
+
+def _simulate(args):
+    '''Runs in a worker process: args as trainspeedsim would take them.
+    Returns (content type, body, whether the track was already parsed).'''
+    conf = Config(["trainspeedsim"] + args)
+    if conf.mode != "sim":
+        raise ArgvError("Nothing to simulate")
+    for name in _UNSERVED:
+        if getattr(conf, name):
+            raise ArgvError("Cannot use {} in a request".format(name))
+    if conf.batch:
+        raise ArgvError("Cannot simulate a batch in a request")
+    if conf.infile == "-":
+        raise ArgvError("Cannot use stdin in a request")
+    cache = results = None
+    if conf.cache is not None:
+        from trackcache import TrackCache
+        cache = TrackCache(conf.cache)
+    if conf.results is not None:
+        from resultcache import ResultCache
+        results = ResultCache(conf.results,
+                int(conf.results_max * 1024 * 1024))
+    hits = _worker_pool.hits
+    track = _worker_pool.get(conf.infile, conf.units, cache)
+    _check_resolution(track, conf.res, conf.numeric)
+    sim = Simulation(track, conf.accel, conf.res, conf.units, conf.engine,
+            conf.numeric, results=results)
+    sim.run()
+    if conf.format == "binary":
+        out = io.BytesIO()
+        sim.output(out, conf.format)
+        body = out.getvalue()
+        content_type = "application/octet-stream"
+    else:
+        out = io.StringIO()
+        sim.output(out, conf.format)
+        body = out.getvalue().encode()
+        content_type = "text/plain; charset=utf-8"
+    return content_type, body, _worker_pool.hits > hits
+
+def _check_resolution(track, res, numeric):
+    '''Only "float" mode rounds each seg to the nearest number of steps;
+    the others need res to divide every seg (and the engines assert it)'''
+    if numeric == "float":
+        return
+    for seg in track:
+        if seg.length() % res != 0:
+            raise ArgvError("-r {} doesn't divide the seg from {} to {}; "\
+                    "use -n float for any resolution".format(res,
+                        seg.get_start().to_bigger_unit(),
+                        seg.get_end().to_bigger_unit()))
+
+def percentile(sorted_vals, p):
+    '''p-th percentile (0-100) of sorted_vals, by nearest rank'''
+    if not sorted_vals:
+        return None
+    rank = max(1, -(-len(sorted_vals) * p // 100))
+    return sorted_vals[int(rank) - 1]
+
+class SimulationService:
+    '''Serves simulation requests on a process pool of workers (default one
+    per CPU), at most that many at once; the rest wait in line, which is
+    the queue depth /stats reports'''
+
+    def __init__(self, workers=None, max_tracks=DEFAULT_TRACKS):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._workers = workers
+        self._max_tracks = max_tracks
+        self._pool = None
+        self._slots = None
+        self._started = None
+        self.requests = 0
+        self.errors = 0
+        self.track_hits = 0
+        self.track_misses = 0
+        self.queued = 0
+        self.running = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self._pool = self._new_pool()
+        self._slots = asyncio.Semaphore(self._workers)
+        self._started = time.monotonic()
+
+    def _new_pool(self):
+        # not forked from here, where they'd inherit every open connection
+        # and keep it from closing
+        import multiprocessing
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" \
+                if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=self._workers,
+                mp_context=context, initializer=_init_worker,
+                initargs=(self._max_tracks,))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    async def simulate(self, args):
+        '''(content type, body) for trainspeedsim args'''
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        pool = self._pool
+        try:
+            loop = asyncio.get_running_loop()
+            content_type, body, hit = await loop.run_in_executor(pool,
+                    _simulate, args)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for its memory), which takes the
+            # whole pool with it: the requests running on it fail, later
+            # ones get a new pool
+            if self._pool is pool:
+                pool.shutdown(wait=False)
+                self._pool = self._new_pool()
+            raise
+        finally:
+            self.running -= 1
+            self._slots.release()
+        if hit:
+            self.track_hits += 1
+        else:
+            self.track_misses += 1
+        return content_type, body
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {"uptime": time.monotonic() - self._started,
+                "requests": self.requests,
+                "errors": self.errors,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "workers": self._workers,
+                "latency_ms": {"p50": percentile(latencies, 50),
+                    "p90": percentile(latencies, 90),
+                    "p99": percentile(latencies, 99),
+                    "max": latencies[-1] if latencies else None,
+                    "window": len(latencies)},
+                "tracks": {"hits": self.track_hits,
+                    "misses": self.track_misses}}
+
+    async def handle(self, reader, writer):
+        '''One HTTP request per connection'''
+        start = time.perf_counter()
+        timed = True
+        try:
+            status, content_type, body, timed = await self._respond(reader)
+        except Exception as e:
+            # repr, since e.g. an AssertionError has no message of its own
+            status, content_type, body = 500, "text/plain; charset=utf-8", \
+                    "{!r}\n".format(e).encode()
+        if status != 200:
+            self.errors += 1
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\n"\
+                "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+                    status, _REASONS[status], content_type,
+                    len(body)).encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        # simulation requests only, not /stats
+        if timed:
+            self._latencies.append(1000 * (time.perf_counter() - start))
+
+    async def _respond(self, reader):
+        text = "text/plain; charset=utf-8"
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) != 3:
+            return 400, text, b"bad request line\n", False
+        method, path, _ = request_line
+
+        if path == "/stats" and method == "GET":
+            return 200, "application/json", \
+                    (json.dumps(self.stats(), indent=2) + "\n").encode(), False
+        if path != "/simulate":
+            return 404, text, b"no such endpoint\n", False
+        if method != "POST":
+            return 405, text, b"POST a request to /simulate\n", False
+        self.requests += 1
+        try:
+            length = int(headers.get("content-length", "0"))
+            request = json.loads(await reader.readexactly(length))
+            args = request["args"]
+            if not isinstance(args, list) or \
+                    not all(isinstance(a, str) for a in args):
+                raise ValueError("args must be a list of strings")
+        except (ValueError, KeyError, TypeError,
+                asyncio.IncompleteReadError) as e:
+            return 400, text, "bad request: {}\n".format(e).encode(), True
+        try:
+            content_type, body = await self.simulate(args)
+        except (ArgvError, KeyError) as e:
+            # KeyError is Config's "No such flag"
+            return 400, text, "{}\n".format(e).encode(), True
+        except FileNotFoundError as e:
+            return 404, text, "{}\n".format(e).encode(), True
+        except ValueError as e:
+            # the track or its values, e.g. a damaged cache file or -r not
+            # fitting -n fixed's units
+            return 400, text, "{}\n".format(e).encode(), True
+        except BrokenProcessPool:
+            return 500, text, b"a worker process died; "\
+                    b"restarted the workers, try again\n", True
+        return 200, content_type, body, True
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+        405: "Method Not Allowed", 500: "Internal Server Error"}
+
+async def serve(service, port=DEFAULT_PORT, socket_path=None):
+    '''Serves until cancelled, on localhost:port or the Unix socket'''
+    service.start()
+    try:
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(service.handle,
+                    socket_path)
+        else:
+            server = await asyncio.start_server(service.handle, "127.0.0.1",
+                    port)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def main(argv):
+    '''trainspeedsim serve: argv[0] is "serve"'''
+    port = DEFAULT_PORT
+    socket_path = None
+    workers = None
+    max_tracks = DEFAULT_TRACKS
+    usage = "trainspeedsim serve [--port PORT | --socket PATH] "\
+            "[-j WORKERS] [--tracks N]\n"
+    args = iter(argv[1:])
+    try:
+        for arg in args:
+            if arg == "--port":
+                port = int(next(args))
+            elif arg == "--socket":
+                socket_path = next(args)
+            elif arg in ("-j", "--jobs"):
+                workers = int(next(args))
+            elif arg == "--tracks":
+                max_tracks = int(next(args))
+            else:
+                raise ValueError(arg)
+        if (workers is not None and workers < 1) or max_tracks < 1:
+            raise ValueError()
+    except (ValueError, StopIteration):
+        sys.stderr.write(usage)
+        return 2
+    where = socket_path if socket_path is not None else \
+            "http://127.0.0.1:{}".format(port)
+    sys.stderr.write("serving on {}\n".format(where))
+    try:
+        asyncio.run(serve(SimulationService(workers, max_tracks), port,
+            socket_path))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+import unittest
+
+class TestService(unittest.TestCase):
+    def test_track_pool(self):
+        pool = TrackPool(1)
+        first = pool.get("short_maxspeeds.csv", "imperial")
+        self.assertIs(pool.get("short_maxspeeds.csv", "imperial"), first)
+        pool.get("short_maxspeeds.csv", "metric")
+        self.assertIsNot(pool.get("short_maxspeeds.csv", "imperial"), first)
+        self.assertEqual((pool.hits, pool.misses, len(pool)), (1, 3, 1))
+
+    def test_requests(self):
+        import tempfile
+
+        async def request(socket_path, method, path, body=b""):
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            writer.write("{} {} HTTP/1.1\r\nHost: localhost\r\n"\
+                    "Content-Length: {}\r\n\r\n".format(method, path,
+                        len(body)).encode() + body)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b"\r\n\r\n")
+            return int(head.split()[1]), body
+
+        async def session(socket_path):
+            service = SimulationService(workers=1)
+            server = asyncio.ensure_future(serve(service,
+                socket_path=socket_path))
+            while not os.path.exists(socket_path):
+                await asyncio.sleep(0.01)
+            args = json.dumps({"args": ["-e", "analytic", "-n", "float",
+                "sprinter_maxspeeds_stations.csv"]}).encode()
+            try:
+                first = await request(socket_path, "POST", "/simulate", args)
+                again = await request(socket_path, "POST", "/simulate", args)
+                bad = await request(socket_path, "POST", "/simulate",
+                        b'{"args": ["-s", "short_maxspeeds.csv"]}')
+                missing = await request(socket_path, "POST", "/simulate",
+                        b'{"args": ["no_such_file.csv"]}')
+                batch = await request(socket_path, "POST", "/simulate",
+                        b'{"args": ["short_maxspeeds.csv", "limits.csv"]}')
+                # used to be 500s with an empty body, from the engines'
+                # asserts
+                values = [await request(socket_path, "POST", "/simulate",
+                    json.dumps({"args": flags + ["short_maxspeeds.csv"]})\
+                            .encode())
+                    for flags in (["-a", "-1"], ["-r", "7"],
+                        ["-r", "7", "-n", "fixed"])]
+                # a worker dying used to break every later request too
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                            service._pool, os._exit, 1)
+                except BrokenProcessPool:
+                    pass
+                died = await request(socket_path, "POST", "/simulate", args)
+                after = await request(socket_path, "POST", "/simulate", args)
+                stats = await request(socket_path, "GET", "/stats")
+            finally:
+                server.cancel()
+                try:
+                    await server
+                except asyncio.CancelledError:
+                    pass
+            return first, again, bad, missing, batch, values, died, after, \
+                    stats
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first, again, bad, missing, batch, values, died, after, stats = \
+                    asyncio.run(session(os.path.join(tmpdir, "tss.sock")))
+        sim = Simulation("sprinter_maxspeeds_stations.csv",
+                Config(["", "x"]).accel, Config(["", "x"]).res, "imperial",
+                "analytic", "float")
+        sim.run()
+        out = io.StringIO()
+        sim.output(out)
+        self.assertEqual(first, (200, out.getvalue().encode()))
+        self.assertEqual(again, first)
+        self.assertEqual(bad[0], 400)
+        self.assertEqual(missing[0], 404)
+        self.assertEqual(batch[0], 400)
+        for status, body in values:
+            self.assertEqual(status, 400)
+            self.assertTrue(body.strip())
+        self.assertEqual(died[0], 500)
+        self.assertIn(b"worker", died[1])
+        self.assertEqual(after, first)
+        self.assertEqual(stats[0], 200)
+        stats = json.loads(stats[1])
+        self.assertEqual((stats["requests"], stats["errors"]), (10, 7))
+        self.assertEqual(stats["tracks"], {"hits": 1, "misses": 2})
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["latency_ms"]["window"], 10)
+        self.assertLessEqual(stats["latency_ms"]["p50"],
+                stats["latency_ms"]["p99"])
+
+if __name__ == "__main__":
+    sys.exit(main(["serve"] + sys.argv[1:]))
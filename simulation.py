@@ -1,15 +1,58 @@
 #! /usr/bin/python3
 
 from multidict import MultiDict
-from convunits import Pos, Speed, Accel
-import copy
+from convunits import Pos, Speed, Accel, QuantityArray, system_to_unit
+from fractions import Fraction
+from contextlib import nullcontext
+from math import inf
+# only the "numpy" engine needs numpy, so don't make it a hard requirement
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # used in sim and interface with View etc.
 from collections import namedtuple
 PosSpeed = namedtuple("PosSpeed", ["pos", "speed"])
+# a whole profile as two convunits.QuantityArrays
+PosSpeedColumns = namedtuple("PosSpeedColumns", ["pos", "speed"])
+
+def _float_val(q):
+    """plain float of a HasUnit (in its own unit) or of an already-float
+    value, so code can run in either numeric mode"""
+    if isinstance(q, (int, float)):
+        return float(q)
+    return float(q.val())
+
+# "fixed" numeric mode: positions are ints in these units, and computed
+# speeds are rounded to 1/FIXED_SPEED_DENOMINATOR of the speed unit, so no
+# Fraction's denominator grows beyond that (or a speed limit's own)
+FIXED_UNITS = {
+        "imperial": {"pos": "mf", "speed": "mf/s", "accel": "mf/s^2"},
+        "metric": {"pos": "mm", "speed": "mm/s", "accel": "mm/s^2"}
+        }
+FIXED_SPEED_DENOMINATOR = 1000
+
+def _fixed_speed(v, unit):
+    """Speed for a float v in the "fixed" mode: rounded, so the same v always
+    gives the same Fraction whatever order things were worked out in"""
+    return Speed(Fraction(round(v * FIXED_SPEED_DENOMINATOR),
+        FIXED_SPEED_DENOMINATOR), unit)
+
+def _float_seg_point(start, end, j, steps, resolution):
+    """position of the j-th of steps sample points past start of a float-mode
+    seg. Counted rather than accumulated, and the last point snapped to end,
+    so every engine and both directions land on identical floats."""
+    if j == steps:
+        return end
+    return start + j * resolution
 
 
 class TrackSeg:
+    # Immutable and hashable like the Pos and Speed it holds, so the getters
+    # hand those out as they are. Changing a seg means making a new one.
+    __slots__ = ("_index", "_start", "_end", "_speed")
+
     def __init__(self, index, start, end, speed):
         # assert index >= 0 and type(index) is int
         if not isinstance(index, int):
@@ -26,10 +69,39 @@ class TrackSeg:
             # assert start == end, "TrackSeg length must be 0 when speed is 0"
             if start != end:
                 raise ValueError("start and end must be equal if speed is 0")
-        self._index = index
-        self._start = start
-        self._end   = end
-        self._speed = speed
+        object.__setattr__(self, "_index", index)
+        object.__setattr__(self, "_start", start)
+        object.__setattr__(self, "_end", end)
+        object.__setattr__(self, "_speed", speed)
+
+    @classmethod
+    def _unchecked(cls, index, start, end, speed):
+        """A seg from values already known to be valid (e.g. from a compiled
+        track), skipping __init__'s comparisons"""
+        seg = cls.__new__(cls)
+        object.__setattr__(seg, "_index", index)
+        object.__setattr__(seg, "_start", start)
+        object.__setattr__(seg, "_end", end)
+        object.__setattr__(seg, "_speed", speed)
+        return seg
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), (self._index, self._start, self._end, self._speed))
+
+    def __hash__(self):
+        return hash((self._index, self._start, self._end, self._speed))
     
     def __str__(self):
         # want units to be in miles/km ("big" units)
@@ -52,18 +124,17 @@ class TrackSeg:
                 self._end == other._end and self._speed == other._speed
     
     def get_index(self):
-        return copy.deepcopy(self._index) # just in case
+        return self._index
     
-    # returns copy so you can't do something STUPID like call 
-    # seg.get_start() to modify it (self._start is a Pos, so is modifiable)
+    # no need to copy: Pos and Speed can't be modified
     def get_start(self):
-        return copy.deepcopy(self._start)
+        return self._start
     
     def get_end(self):
-        return copy.deepcopy(self._end)
+        return self._end
     
     def get_speed(self):
-        return copy.deepcopy(self._speed)
+        return self._speed
     
     def length(self):
         return self._end - self._start
@@ -71,10 +142,18 @@ class TrackSeg:
 class Track:
     from collections import namedtuple
     RawMaxSpeed = namedtuple("MaxSpeed", ["milepost", "speed"])
+    # whether the segs hold plain floats in the small units rather than
+    # Pos/Speed, so only the "float" numeric mode can simulate it as is
+    FLOAT_VALUED = False
 
-    def __init__(self, filename, units):
+    # cache, a trackcache.TrackCache, loads the compiled track instead when
+    # it has one for the file
+    def __init__(self, filename, units, cache=None):
         # load the file into TrackSegs into
-        self._track = self._load_maxspeeds(filename, units)
+        if cache is not None:
+            self._track = cache.load(filename, units)
+        else:
+            self._track = self._load_maxspeeds(filename, units)
         # and throw if anything goes wrong
         assert len(self._track) > 0, "there must be at least one track segment"
 
@@ -85,9 +164,44 @@ class Track:
         out += "]"
         return out
 
+    def __len__(self):
+        return len(self._track)
+
+    # segments in index order (reversed() walks them in "-" direction)
+    def __iter__(self):
+        return iter(self._track)
+
+    def __reversed__(self):
+        return reversed(self._track)
+
     def get_first_seg(self):
         return self._track[0]
 
+    # a stop is a 0-length, 0-speed seg: the train is always stopped there
+    # whatever happens either side of it
+    def get_stop_indices(self):
+        return [seg.get_index() for seg in self._track \
+                if seg.length() == 0 and seg.get_speed() == 0]
+
+    def split_at_stops(self):
+        """Splits into Tracks running from one stop to the next, which can be
+        simulated independently. Neighbouring sections share their stop.
+        Sections' segs are re-indexed from 0. Returns [self] when the track
+        doesn't start and end with stops."""
+        stops = self.get_stop_indices()
+        if len(stops) < 2 or stops[0] != 0 or stops[-1] != len(self._track)-1:
+            return [self]
+        return [self._section(first, last) \
+                for first, last in zip(stops, stops[1:])]
+
+    def _section(self, first, last):
+        """Track of copies of segs first to last inclusive, re-indexed"""
+        section = Track.__new__(Track)
+        section._track = [TrackSeg(i, seg.get_start(), seg.get_end(),
+            seg.get_speed()) for i, seg in \
+            enumerate(self._track[first:last+1])]
+        return section
+
     # throws IndexError and AssertionError
     def get_next_seg(self, index, direction):
         assert direction == "+" or direction == "-"
@@ -99,15 +213,24 @@ class Track:
         return self._track[index + d]
 
     def _load_maxspeeds(self, filename, units):
-        assert units in ["imperial", "metric"]
         with open(filename, "r") as maxspeeds_file:
-            import csv
-            raw_maxspeeds = [maxspeed for maxspeed in map (\
-                    self.RawMaxSpeed._make, csv.reader(maxspeeds_file,
-                        delimiter='	'))]
-            # Don't do quoting=csv.QUOTE_NONNUMERIC b/c numbers need to be 
-            # strings to be converted to Decimals to be preserved exactly
-        
+            return list(self.gen_segs(self.gen_raw_maxspeeds(maxspeeds_file),
+                units))
+
+    @classmethod
+    def gen_raw_maxspeeds(cls, maxspeeds_file):
+        """RawMaxSpeeds read lazily from an open file (or sys.stdin)"""
+        import csv
+        return map(cls.RawMaxSpeed._make, csv.reader(maxspeeds_file,
+            delimiter='	'))
+        # Don't do quoting=csv.QUOTE_NONNUMERIC b/c numbers need to be 
+        # strings to be converted to Decimals to be preserved exactly
+
+    @staticmethod
+    def gen_segs(raw_maxspeeds, units):
+        """Generates TrackSegs from RawMaxSpeeds, reading only one entry
+        ahead of the seg it yields, so it works on a stream"""
+        assert units in ["imperial", "metric"]
         if units == "imperial":
             pos_unit = "mi"
             speed_unit = "mi/h"
@@ -121,22 +244,71 @@ class Track:
         # assumes units in file are "big units" (mi or km, mph or kph)
         # might change that later (TODO)
         # generate segments from that
-        maxspeedsegs = []
-        for x in range(0, len(raw_maxspeeds)-1):
-            maxguy = raw_maxspeeds[x]
+        # each seg runs from one entry's milepost to the next's, at the first
+        # entry's speed, except the last seg, which takes the last entry's
+        # speed. So a seg is only yielded once the entry after next is read.
+        x = 0
+        maxguy = None
+        maxguy2 = None
+        for raw in raw_maxspeeds:
+            if maxguy is not None:
+                mp1 = Pos(maxguy.milepost, pos_unit).to_smaller_unit()
+                mp2 = Pos(maxguy2.milepost, pos_unit).to_smaller_unit()
+                speed1 = Speed(maxguy.speed, speed_unit).to_smaller_unit()
+                yield TrackSeg(x, mp1, mp2, speed1)
+                x += 1
+            maxguy = maxguy2
+            maxguy2 = raw
+        if maxguy is not None:
             mp1 = Pos(maxguy.milepost, pos_unit).to_smaller_unit()
-            maxguy2 = raw_maxspeeds[x+1]
             mp2 = Pos(maxguy2.milepost, pos_unit).to_smaller_unit()
-            #if maxguy2.speed != 0:
-            speed1 = Speed(maxguy.speed, speed_unit).to_smaller_unit()
-            seg = TrackSeg(x, mp1, mp2, speed1)
-            if (x+1 == len(raw_maxspeeds)-1):
-                speed2 = Speed(maxguy2.speed, speed_unit).to_smaller_unit()
-                seg = TrackSeg(x, mp1, mp2, speed2)
-            maxspeedsegs.append(seg)
-
-        return maxspeedsegs
+            speed2 = Speed(maxguy2.speed, speed_unit).to_smaller_unit()
+            yield TrackSeg(x, mp1, mp2, speed2)
  
+class FloatTrack(Track):
+    """A Track's segments as plain floats in its small units (f, f/s or m,
+    m/s), for the "float" numeric mode, so the simulation hot path never
+    touches HasUnit"""
+    FLOAT_VALUED = True
+
+    def __init__(self, track):
+        self._track = [TrackSeg(seg.get_index(), _float_val(seg.get_start()),
+            _float_val(seg.get_end()), _float_val(seg.get_speed())) \
+            for seg in track]
+        assert len(self._track) > 0, "there must be at least one track segment"
+
+    def __str__(self):
+        out = "[\n"
+        for seg in self._track:
+            out += repr(seg) + "\n"
+        out += "]"
+        return out
+
+class FixedTrack(Track):
+    """A Track's segments for the "fixed" numeric mode: positions as ints in
+    FIXED_UNITS (thousandths of a foot, or mm), speeds converted exactly to
+    the matching speed unit. A position that isn't a whole number of those
+    is rounded to the nearest."""
+    def __init__(self, track, units):
+        pos_unit = FIXED_UNITS[units]["pos"]
+        speed_unit = FIXED_UNITS[units]["speed"]
+        self._track = [TrackSeg(seg.get_index(),
+            self.fixed_pos(seg.get_start(), pos_unit),
+            self.fixed_pos(seg.get_end(), pos_unit),
+            seg.get_speed().convert_to(speed_unit)) for seg in track]
+        assert len(self._track) > 0, "there must be at least one track segment"
+
+    @staticmethod
+    def fixed_pos(pos, pos_unit):
+        return Pos(round(pos.convert_to(pos_unit)._val), pos_unit)
+
+    def __str__(self):
+        out = "[\n"
+        for seg in self._track:
+            out += repr(seg) + "\n"
+        out += "]"
+        return out
+
 class Train:
     def __init__(self, track, acceleration, resolution):
         assert acceleration > 0
@@ -233,8 +405,8 @@ class Train:
         # accelerate() over one resolution of distance? I didn't think 
         # this far ahead.
         segspeed = self._seg.get_speed()
-        acc_speed = Speed(str(self._accelerate(segspeed.val(), self._acceleration.val(), \
-            self._speed.val(), self._resolution.val())), self._speed.unit())
+        acc_speed = self._new_speed(self._accelerate(segspeed.val(), self._acceleration.val(), \
+            self._speed.val(), self._resolution.val()), self._speed.unit())
         self._speed = min(segspeed, acc_speed)
             
 
@@ -250,11 +422,397 @@ class Train:
                 self._finished_seg = True
         return self._finished_seg
 
+    def _new_speed(self, v, unit):
+        return Speed(str(v), unit)
+
+class FixedTrain(Train):
+    """Train for the "fixed" numeric mode, on a FixedTrack with acceleration
+    and resolution in FIXED_UNITS"""
+    # the last speed _new_speed() made and the float it was rounded from
+    _carry = None
+
+    def _new_speed(self, v, unit):
+        speed = _fixed_speed(v, unit)
+        self._carry = (speed, v)
+        return speed
+
+    def _accelerate(self, v_target, acc, v_i, d):
+        # carry on from the unrounded speed, so each point is rounded once
+        # rather than the rounding building up step after step
+        if self._carry is not None and self._speed is self._carry[0]:
+            v_i = self._carry[1]
+        return Train._accelerate(self, v_target, acc, v_i, d)
+
+class FloatTrain(Train):
+    """Train for the "float" numeric mode. Runs on a FloatTrack with float
+    acceleration and resolution, so each step is plain float arithmetic."""
+
+    def __str__(self):
+        return ("pos: {:.1f}, speed {:.2f}, dir: {}, seg: ({}), accel: {}, "+ \
+            "res: {}, finished {}").format(self._pos, self._speed, self._dir,
+            repr(self._seg), self._acceleration, self._resolution,
+            self._finished_seg)
+
+    def _travel_non0_seg(self):
+        start = self._seg.get_start()
+        end = self._seg.get_end()
+        steps = round((end - start) / self._resolution)
+        assert steps > 0
+
+        segspeed = self._seg.get_speed()
+        acc_speed = self._accelerate(segspeed, self._acceleration,
+            self._speed, self._resolution)
+        self._speed = min(segspeed, acc_speed)
+
+        # which sample point of the seg the train is at
+        j = round((self._pos - start) / self._resolution)
+        assert self._dir == "+" or self._dir == "-"
+        if self._dir == "+":
+            j += 1
+            self._finished_seg = j == steps
+        elif self._dir == "-":
+            j -= 1
+            self._finished_seg = j == 0
+        self._pos = _float_seg_point(start, end, j, steps, self._resolution)
+        return self._finished_seg
+
+class KinematicSolver:
+    """Analytic counterpart to Train. Rather than stepping one resolution at a
+    time, it solves v^2 = v0^2 + 2ad once per segment and only evaluates that
+    curve at the sample points. Produces the same PosSpeed lists as driving
+    Train through Simulation._gen_best_speeds_dir()."""
+
+    def __init__(self, track, acceleration, resolution, numeric="exact"):
+        assert acceleration > 0
+        assert resolution > 0 and resolution % 1 == 0 # is inty
+        assert numeric in ("exact", "float", "fixed")
+        self._track = track
+        self._acceleration = acceleration
+        self._resolution = resolution
+        self._numeric = numeric
+
+    def gen_best_speeds_dir(self, direction):
+        assert direction == "+" or direction == "-"
+        if direction == "+":
+            segs = iter(self._track)
+        else:
+            segs = reversed(self._track)
+        # twice the acceleration times one resolution of distance, i.e. how
+        # much v^2 grows per sample
+        a2r = 2.0 * _float_val(self._acceleration) * \
+                _float_val(self._resolution)
+
+        best = []
+        speed = None
+        for seg in segs:
+            segspeed = seg.get_speed()
+            if speed is None:
+                # train starts out stopped on the end segment
+                speed = segspeed
+                assert speed == 0
+            if direction == "+":
+                pos = seg.get_start()
+            else:
+                pos = seg.get_end()
+
+            if seg.length() == 0:
+                speed = min(segspeed, speed)
+                best.append(PosSpeed(pos, speed))
+            elif self._numeric == "float":
+                speed = self._solve_non0_seg_float(seg, segspeed, speed,
+                        direction, a2r, best)
+            else:
+                speed = self._solve_non0_seg(seg, segspeed, speed, pos,
+                        direction, a2r, best)
+
+        # Train never reports the point at the very end of the track
+        best.pop()
+        return best
+
+    def _solve_non0_seg(self, seg, segspeed, speed, pos, direction, a2r, best):
+        """appends seg's sample points to best, returns speed at the last
+        one"""
+        assert seg.length() % self._resolution == 0
+        from math import sqrt
+        steps = int(seg.length().val() / self._resolution.val())
+        v0_sq = float(speed.val())**2
+        seg_v = float(segspeed.val())
+        unit = speed.unit()
+        capped = False
+        for k in range(1, steps + 1):
+            if direction == "+":
+                pos = pos + self._resolution
+            else:
+                pos = pos - self._resolution
+            if not capped:
+                v = sqrt(v0_sq + a2r * k)
+                # once at the speed limit the curve can never come back below
+                # it within this segment
+                capped = v >= seg_v
+            if capped:
+                speed = segspeed
+            elif self._numeric == "fixed":
+                speed = _fixed_speed(v, unit)
+            else:
+                speed = Speed(str(v), unit)
+            best.append(PosSpeed(pos, speed))
+        return speed
+
+    def _solve_non0_seg_float(self, seg, segspeed, speed, direction, a2r,
+            best):
+        """_solve_non0_seg() for the "float" numeric mode, where seg, speed
+        and resolution are plain floats"""
+        from math import sqrt
+        start = seg.get_start()
+        end = seg.get_end()
+        steps = round((end - start) / self._resolution)
+        v0_sq = speed**2
+        capped = False
+        for k in range(1, steps + 1):
+            if direction == "+":
+                j = k
+            else:
+                j = steps - k
+            pos = _float_seg_point(start, end, j, steps, self._resolution)
+            if not capped:
+                v = sqrt(v0_sq + a2r * k)
+                capped = v >= segspeed
+            if capped:
+                speed = segspeed
+            else:
+                speed = v
+            best.append(PosSpeed(pos, speed))
+        return speed
+
+class EnvelopeSolver:
+    """NumPy counterpart to Train and KinematicSolver. Expands the Track onto
+    the same grid of sample points the other engines produce, then computes
+    the forward (acceleration) and reverse (braking) envelopes as whole-array
+    passes and merges them with a single elementwise minimum.
+
+    Works in v^2, where each pass is u[k] = min(limit[k], u[k-1] + 2a*d[k]).
+    With D the running sum of 2a*d, that unrolls to
+    u[k] = min(limit[k], D[k] + min(limit[j] - D[j] for j <= k)), which is a
+    cumulative minimum."""
+
+    CAP_RTOL = 1e-12
+
+    def __init__(self, track, acceleration, resolution, numeric="exact"):
+        if numpy is None:
+            raise ImportError("the numpy engine requires numpy")
+        assert acceleration > 0
+        assert resolution > 0 and resolution % 1 == 0 # is inty
+        assert numeric in ("exact", "float", "fixed")
+        self._track = track
+        self._acceleration = acceleration
+        self._resolution = resolution
+        self._numeric = numeric
+
+    def best_speeds(self):
+        """Returns merged, de-duplicated PosSpeeds like Simulation.run()
+        builds from the forward and reverse passes"""
+        segs, steps, pos_f, best, keep, fwd_capped, rev_capped, fwd_seg, \
+                rev_seg = self._solve()
+        if self._numeric == "float":
+            return [PosSpeed(pos, speed) for pos, speed in \
+                    zip(pos_f[keep].tolist(), best[keep].tolist())]
+        return self._to_posspeeds(self._exact_points(segs, steps, len(best)),
+                keep, best, fwd_capped, rev_capped, fwd_seg, rev_seg)
+
+    def best_columns(self):
+        """Same profile as best_speeds(), but as two float arrays (positions
+        and speeds, small units) without building a PosSpeed per point"""
+        segs, steps, pos_f, best, keep = self._solve()[:5]
+        return pos_f[keep], best[keep]
+
+    def best_for(self, accelerations, columns=False):
+        """best_speeds() (or with columns, best_columns()) for each of
+        accelerations in turn, in the track's units. The sample points are
+        laid out once for all of them, as are their exact positions outside
+        "float" mode; only the two passes (and the computed speeds) are per
+        acceleration."""
+        layout = self._layout()
+        points = None
+        for accel in accelerations:
+            best, keep, fwd_capped, rev_capped = self._best(layout,
+                    2.0 * _float_val(accel))
+            if columns:
+                yield layout.pos_f[keep], best[keep]
+            elif self._numeric == "float":
+                yield [PosSpeed(pos, speed) for pos, speed in \
+                        zip(layout.pos_f[keep].tolist(), best[keep].tolist())]
+            else:
+                if points is None:
+                    points = self._exact_points(layout.segs, layout.steps,
+                            len(best))
+                yield self._to_posspeeds(points, keep, best, fwd_capped,
+                        rev_capped, layout.fwd_seg, layout.rev_seg)
+
+    def _seg_arrays(self, res):
+        """The segs (None if not needed), sample points per seg, and each
+        seg's limit^2, start and end as arrays. A track with get_columns()
+        (a mapped.MappedTrack) is read straight from its columns."""
+        if self._numeric == "float" and hasattr(self._track, "get_columns"):
+            bounds, limits = self._track.get_columns()
+            bounds = numpy.frombuffer(bounds, dtype=numpy.float64)
+            starts, ends = bounds[:-1], bounds[1:]
+            # numpy.rint() rounds halves to even like round()
+            steps = numpy.rint((ends - starts) / res).astype(numpy.int64)
+            limits_sq = numpy.frombuffer(limits, dtype=numpy.float64)**2
+            return None, steps, limits_sq, starts, ends
+
+        segs = list(self._track)
+        steps = numpy.empty(len(segs), dtype=numpy.int64)
+        for i, seg in enumerate(segs):
+            if self._numeric == "float":
+                steps[i] = round(seg.length() / res)
+            else:
+                assert seg.length() % self._resolution == 0
+                steps[i] = int(seg.length().val() / self._resolution.val())
+        limits_sq = numpy.array([_float_val(seg.get_speed())**2 \
+                for seg in segs])
+        starts = numpy.array([_float_val(seg.get_start()) for seg in segs])
+        ends = numpy.array([_float_val(seg.get_end()) for seg in segs])
+        return segs, steps, limits_sq, starts, ends
+
+    def _solve(self):
+        layout = self._layout()
+        best, keep, fwd_capped, rev_capped = self._best(layout,
+                2.0 * _float_val(self._acceleration))
+        self._points = len(best)
+        return layout.segs, layout.steps, layout.pos_f, best, keep, \
+                fwd_capped, rev_capped, layout.fwd_seg, layout.rev_seg
+
+    # the sample points, and all about them that doesn't depend on the
+    # acceleration. fwd_limits/fwd_dists are each point's limit^2 and
+    # distance from the previous point in forward order, rev_limits/rev_dists
+    # the same for the reverse pass in reverse order. fwd_seg and rev_seg are
+    # the seg each point's forward and reverse speed comes from, both in
+    # forward order.
+    _Layout = namedtuple("_Layout", ["segs", "steps", "pos_f", "fwd_seg",
+        "rev_seg", "fwd_limits", "fwd_dists", "rev_limits", "rev_dists"])
+
+    def _layout(self):
+        res = _float_val(self._resolution)
+
+        # sample points per segment; a 0-length seg still gets 1 point
+        segs, steps, limits_sq, starts, ends = self._seg_arrays(res)
+        n_segs = len(steps)
+        counts = numpy.maximum(steps, 1)
+        # distance covered getting to each point of a seg
+        dists = numpy.where(steps > 0, res, 0.0)
+
+        # forward pass: segs in order; the last point of the track is never
+        # reported, hence [:-1]
+        fwd_seg = numpy.repeat(numpy.arange(n_segs), counts)[:-1]
+        # reverse pass: segs in reverse, flipped back to line up with the
+        # forward pass' points once the envelope's worked out
+        rev_seg = numpy.repeat(numpy.arange(n_segs)[::-1],
+                counts[::-1])[:-1]
+
+        # forward pass' positions (as floats) only to find duplicates;
+        # 0-length segs produce repeated points
+        offsets = numpy.cumsum(counts) - counts
+        within = numpy.arange(counts.sum()) - numpy.repeat(offsets, counts)
+        within = numpy.where(steps[fwd_seg] > 0, within[:-1] + 1, 0)
+        # same as _float_seg_point()
+        pos_f = numpy.where(within == steps[fwd_seg], ends[fwd_seg],
+                starts[fwd_seg] + within * res)
+        return self._Layout(segs, steps, pos_f, fwd_seg, rev_seg[::-1],
+                limits_sq[fwd_seg], dists[fwd_seg], limits_sq[rev_seg],
+                dists[rev_seg])
+
+    def _best(self, layout, two_a):
+        """Both passes at acceleration two_a / 2 over layout, merged:
+        best speeds, which to keep (not duplicates), and which are capped
+        by the forward and reverse seg's limit"""
+        fwd = self._envelope(layout.fwd_limits, two_a * layout.fwd_dists)
+        rev = self._envelope(layout.rev_limits,
+                two_a * layout.rev_dists)[::-1]
+        fwd_limits = layout.fwd_limits
+        rev_limits = layout.rev_limits[::-1]
+
+        best_sq = numpy.minimum(fwd, rev)
+        # which points sit on a speed limit, so the seg's own exact Speed can
+        # be used rather than a float approximation. The running sums lose a
+        # few ulps to cancellation, so "on" means within CAP_RTOL.
+        fwd_capped = numpy.isclose(best_sq, fwd_limits, rtol=self.CAP_RTOL,
+                atol=0.0)
+        rev_capped = numpy.isclose(best_sq, rev_limits, rtol=self.CAP_RTOL,
+                atol=0.0)
+        best_sq[fwd_capped] = fwd_limits[fwd_capped]
+        best_sq[rev_capped] = rev_limits[rev_capped]
+        best = numpy.sqrt(best_sq)
+
+        pos_f = layout.pos_f
+        # a 0-length seg's point is where the one before it is, and should
+        # have the same speed, but the running sums can leave it a few ulps
+        # off, which would keep both
+        same = numpy.nonzero((pos_f[1:] == pos_f[:-1]) & numpy.isclose(
+            best[1:], best[:-1], rtol=self.CAP_RTOL, atol=0.0))[0] + 1
+        for i in same.tolist():
+            best[i] = best[i-1]
+        keep = numpy.ones(len(best), dtype=bool)
+        keep[1:] = (pos_f[1:] != pos_f[:-1]) | (best[1:] != best[:-1])
+        return best, keep, fwd_capped, rev_capped
+
+    def get_points(self):
+        """Points each pass of the last solve evaluated"""
+        return self._points
+
+    @staticmethod
+    def _envelope(limits_sq, step_sq):
+        """one pass in v^2 given each point's limit and 2a*distance from the
+        previous point; the train starts out stopped"""
+        climb = numpy.cumsum(step_sq)
+        floor = numpy.minimum(numpy.minimum.accumulate(limits_sq - climb), 0.0)
+        return numpy.minimum(limits_sq, climb + floor)
+
+    # each point's exact position, and the segs' exact speeds, for
+    # _to_posspeeds()
+    _ExactPoints = namedtuple("_ExactPoints", ["positions", "seg_speeds"])
+
+    def _exact_points(self, segs, steps, n_points):
+        positions = []
+        for seg, n in zip(segs, steps.tolist()):
+            pos = seg.get_start()
+            for step in range(max(n, 1)):
+                if n > 0:
+                    pos = pos + self._resolution
+                positions.append(pos)
+        # the last point of the track isn't one
+        del positions[n_points:]
+        return self._ExactPoints(positions,
+                [seg.get_speed() for seg in segs])
+
+    def _to_posspeeds(self, points, keep, best, fwd_capped, rev_capped,
+            fwd_seg, rev_seg):
+        positions, seg_speeds = points
+        unit = seg_speeds[0].unit()
+        best_speeds = []
+        best = best.tolist()
+        fwd_capped = fwd_capped.tolist()
+        rev_capped = rev_capped.tolist()
+        for k in numpy.flatnonzero(keep).tolist():
+            if fwd_capped[k]:
+                speed = seg_speeds[fwd_seg[k]]
+            elif rev_capped[k]:
+                speed = seg_speeds[rev_seg[k]]
+            elif self._numeric == "fixed":
+                speed = _fixed_speed(best[k], unit)
+            else:
+                speed = Speed(str(best[k]), unit)
+            best_speeds.append(PosSpeed(positions[k], speed))
+        return best_speeds
+
 class ArgvError(Exception):
     """ An error having to do with the command-line arguments """
     pass
 
 class Config:
+    # writers.FORMATS (not imported here, since writers imports this module)
+    FORMATS = ("csv", "jsonl", "binary", "gnuplot")
+
     class FlagDesc:
         def __init__(self, needs_val, default_val=None):
             self.val = None
@@ -271,15 +829,55 @@ class Config:
         self._flagsdict["-r"] = self.FlagDesc(True, \
             {"imperial": Pos(528, "f"), "metric": Pos(100, "m")} )
         self._flagsdict.join("--resolution", "-r")
+        self._flagsdict["-e"] = self.FlagDesc(True, "step")
+        self._flagsdict.join("--engine", "-e")
+        self._flagsdict["-n"] = self.FlagDesc(True, "exact")
+        self._flagsdict.join("--numeric", "-n")
+        self._flagsdict["-p"] = self.FlagDesc(False)
+        self._flagsdict.join("--parallel", "-p")
+        self._flagsdict["-s"] = self.FlagDesc(False)
+        self._flagsdict.join("--stream", "-s")
+        self._flagsdict["-c"] = self.FlagDesc(True)
+        self._flagsdict.join("--cache", "-c")
+        self._flagsdict["-f"] = self.FlagDesc(True, "csv")
+        self._flagsdict.join("--format", "-f")
+        self._flagsdict["-o"] = self.FlagDesc(True)
+        self._flagsdict.join("--output", "-o")
+        self._flagsdict["-P"] = self.FlagDesc(True)
+        self._flagsdict.join("--profile", "-P")
+        self._flagsdict["-R"] = self.FlagDesc(True)
+        self._flagsdict.join("--results", "-R")
+        self._flagsdict["-M"] = self.FlagDesc(True, 256)
+        self._flagsdict.join("--results-max", "-M")
+        self._flagsdict["-j"] = self.FlagDesc(True)
+        self._flagsdict.join("--jobs", "-j")
+        self._flagsdict["-d"] = self.FlagDesc(True)
+        self._flagsdict.join("--outdir", "-d")
         self._flagsdict["-h"] = self.FlagDesc(False)
         self._flagsdict.join("--help", "-h")
         
         # declare what we're configuring (just to be clear)
         self.mode = None
         self.infile = None
+        # every input given; more than one (or a directory or glob, or -j
+        # or -d) makes it a batch
+        self.infiles = []
+        self.batch = None
+        self.jobs = None
+        self.outdir = None
         self.units = None
         self.accel = None
         self.res = None
+        self.engine = None
+        self.numeric = None
+        self.parallel = None
+        self.stream = None
+        self.profile = None
+        self.cache = None
+        self.results = None
+        self.results_max = None
+        self.format = None
+        self.outfile = None
 
         self._parse(argv)
         self._validate_args()
@@ -290,7 +888,8 @@ class Config:
         #for arg in argv[1:]:
         isflagval = False
         for arg in argv[1:]:
-            if arg[0] == "-" and not isflagval: # it's a flag
+            # a lone "-" is the input file: stdin
+            if arg[0] == "-" and arg != "-" and not isflagval: # it's a flag
                 if arg in self._flagsdict:
                     if self._flagsdict[arg].needs_val:
                         flag = arg
@@ -306,10 +905,9 @@ class Config:
                 else:
                     raise ArgvError("Cannot define flag multiple times")
             else: # must be by itself (so probably input filename)
-                if self.infile == None:
-                    self.infile = arg
-                else:
-                    raise ArgvError("Cannot have multiple input files")
+                self.infiles.append(arg)
+        if len(self.infiles) == 1:
+            self.infile = self.infiles[0]
         
     def _validate_args(self):
         # make sure arguments are logical and consistent etc.
@@ -331,13 +929,20 @@ class Config:
                 self.units = uflag.default_val
             # self.units is now either "imperial" or "metric"
 
-            if self.infile == None:
+            if len(self.infiles) == 0:
                 raise ArgvError("Must specify input file")
+            self._validate_batch()
 
             aflag = self._flagsdict["-a"]
             if aflag.val is not None:
                 accel_unit = {"imperial": "f/s^2", "metric": "m/s^2"}
-                self.accel = Accel(float(aflag.val), accel_unit[self.units])
+                try:
+                    accel = float(aflag.val)
+                except ValueError:
+                    raise ArgvError("Value of -a flag must be a number")
+                if not 0 < accel < inf:
+                    raise ArgvError("Value of -a flag must be positive")
+                self.accel = Accel(accel, accel_unit[self.units])
             else: # default, in the relevant unit
                 if self.units == "imperial":
                     self.accel = aflag.default_val
@@ -350,64 +955,493 @@ class Config:
             rflag = self._flagsdict["-r"]
             if rflag.val is not None:
                 dist_unit = {"imperial": "f", "metric": "m"}
-                self.res = Pos(float(rflag.val), dist_unit[self.units])
+                # from the string, so it's an exact Fraction like the track's
+                # positions (a float can't be compared with those)
+                try:
+                    self.res = Pos(rflag.val, dist_unit[self.units])
+                except ValueError:
+                    raise ArgvError("Value of -r flag must be a number")
+                if not (self.res > 0 and self.res % 1 == 0):
+                    raise ArgvError("Value of -r flag must be a positive "\
+                            "whole number")
             else: # default, in the relevant unit
                 self.res = rflag.default_val[self.units]
 
+            eflag = self._flagsdict["-e"]
+            if eflag.val is not None:
+                if eflag.val in Simulation.ENGINES:
+                    self.engine = eflag.val
+                else:
+                    raise ArgvError("Value of -e flag must be one of " + \
+                        ", ".join('"{}"'.format(e) for e in Simulation.ENGINES))
+            else:
+                self.engine = eflag.default_val
+
+            nflag = self._flagsdict["-n"]
+            if nflag.val is not None:
+                if nflag.val in Simulation.NUMERICS:
+                    self.numeric = nflag.val
+                else:
+                    raise ArgvError("Value of -n flag must be one of " + \
+                        ", ".join('"{}"'.format(n) for n in \
+                        Simulation.NUMERICS))
+            else:
+                self.numeric = nflag.default_val
+
+            self.parallel = self._flagsdict["-p"].val == True
+            self.stream = self._flagsdict["-s"].val == True
+            if self.parallel and self.stream:
+                raise ArgvError("Cannot combine -p and -s")
+            if self.stream and self.numeric == "fixed":
+                raise ArgvError("Cannot combine -s and -n fixed")
+
+            fflag = self._flagsdict["-f"]
+            if fflag.val is not None:
+                if fflag.val in self.FORMATS:
+                    self.format = fflag.val
+                else:
+                    raise ArgvError("Value of -f flag must be one of " + \
+                        ", ".join('"{}"'.format(f) for f in self.FORMATS))
+            else:
+                self.format = fflag.default_val
+            self.outfile = self._flagsdict["-o"].val
+            # a batch's outputs all go one after another into one file
+            # unless -d is given, which only the text formats can do
+            if self.batch and self.outdir is None and \
+                    self.format not in ("csv", "jsonl"):
+                raise ArgvError("Cannot combine -f {} outputs into one; "\
+                        "use -d".format(self.format))
+            # the stream prints as it goes, in the csv format
+            if self.stream and (self.format != "csv" or \
+                    self.outfile is not None):
+                raise ArgvError("Cannot combine -s with -f or -o")
+
+            # the cache directory
+            self.cache = self._flagsdict["-c"].val
+            if self.cache is not None and (self.stream or self.infile == "-"):
+                raise ArgvError("Cannot use -c with -s or stdin")
+
+            # the result cache directory, and its size limit in MiB
+            self.results = self._flagsdict["-R"].val
+            if self.results is not None and (self.stream or \
+                    self.infile == "-"):
+                raise ArgvError("Cannot use -R with -s or stdin")
+            mflag = self._flagsdict["-M"]
+            if mflag.val is not None:
+                if self.results is None:
+                    raise ArgvError("-M needs -R")
+                try:
+                    self.results_max = float(mflag.val)
+                except ValueError:
+                    raise ArgvError("Value of -M flag must be a number")
+                if self.results_max <= 0:
+                    raise ArgvError("Value of -M flag must be positive")
+            else:
+                self.results_max = mflag.default_val
+
+            self.profile = self._flagsdict["-P"].val
+            if self.profile is not None:
+                if self.profile not in ["text", "json"]:
+                    raise ArgvError('Value of -P flag must be "text" or '+\
+                        '"json"')
+                # the workers' and the stream's counters and phases would be
+                # missing or meaningless
+                if self.parallel or self.stream:
+                    raise ArgvError("Cannot combine -P with -p or -s")
+
         if self.mode == "help":
             pass
+
+    def _validate_batch(self):
+        import glob
+        import os
+        jflag = self._flagsdict["-j"]
+        self.outdir = self._flagsdict["-d"].val
+        self.batch = len(self.infiles) > 1 or jflag.val is not None or \
+                self.outdir is not None or any(glob.has_magic(f) or \
+                os.path.isdir(f) for f in self.infiles)
+        if not self.batch:
+            return
+        # one infile doesn't mean one input any more
+        self.infile = None
+        if "-" in self.infiles:
+            raise ArgvError("Cannot use stdin with multiple inputs")
+        if jflag.val is not None:
+            try:
+                self.jobs = int(jflag.val)
+            except ValueError:
+                raise ArgvError("Value of -j flag must be an integer")
+            if self.jobs < 1:
+                raise ArgvError("Value of -j flag must be at least 1")
+        for flag in ("-s", "-p", "-P"):
+            if self._flagsdict[flag].val is not None:
+                raise ArgvError("Cannot combine {} with multiple inputs"\
+                        .format(flag))
+        if self.outdir is not None and self._flagsdict["-o"].val is not None:
+            raise ArgvError("Cannot combine -d and -o")
        
     def gen_help(self):
         # generate this automagically from self._flagsdict later
-        return  "trainspeedsim [-h|--help | OPTIONS] INPUT_FILE\n" + \
+        return  "trainspeedsim [-h|--help | OPTIONS] INPUT_FILE|-\n" + \
+                "trainspeedsim [OPTIONS] [-j JOBS] [-d OUTDIR] " + \
+                "INPUT_FILE|DIR|GLOB...\n" + \
+                "trainspeedsim precompile [-u imperial|metric] " + \
+                "[-c CACHE_DIR] DIR|FILE...\n" + \
+                "trainspeedsim serve [--port PORT | --socket PATH] " + \
+                "[-j WORKERS] [--tracks N]\n" + \
                 "OPTIONS:\n" + \
                 "  -u|--units: imperial|metric\n" + \
                 "  -a|--acceleration: decimal value (default: 1.5 ft/s^2 " + \
                 "or that converted to\n    m/s^2)\n" + \
-                "  -r|--resolution: integral value (default: 528 f or 100 m)"
+                "  -r|--resolution: integral value (default: 528 f or 100 m)\n" + \
+                "  -e|--engine: step|analytic|numpy (default: step)\n" + \
+                "  -n|--numeric: exact|float|fixed (default: exact)\n" + \
+                "  -p|--parallel: simulate stop-to-stop sections on all CPUs\n" + \
+                "  -s|--stream: print each point as soon as it is final\n" + \
+                "  -f|--format: csv|jsonl|binary|gnuplot (default: csv)\n" + \
+                "  -o|--output: file to write to (default: stdout)\n" + \
+                "  -c|--cache: directory of compiled tracks to load " + \
+                "INPUT_FILE through\n" + \
+                "  -P|--profile: text|json: report time per phase and " + \
+                "allocation counts\n    on stderr\n" + \
+                "  -R|--results: directory of stored results to reuse " + \
+                "and add to\n" + \
+                "  -M|--results-max: size limit of -R in MiB (default: 256)\n" + \
+                "  -j|--jobs: worker processes for a batch (default: one " + \
+                "per CPU)\n" + \
+                "  -d|--outdir: write each input's output to its own file " + \
+                "here"
+
+def gen_output_lines(points, units, numeric):
+    """Formats PosSpeeds (in the small units) as trainspeedsim's output lines
+    of milepost and speed in the big units"""
+    if numeric == "float":
+        # one conversion factor per column rather than a convert_to() per
+        # point. Dividing by the big unit's size in small units keeps e.g.
+        # 20 mi/h from coming out as 19.999999999999996.
+        pos_unit = system_to_unit(units, "pos", "big")
+        speed_unit = system_to_unit(units, "speed", "big")
+        pos_factor = _float_val(Pos(1, pos_unit).to_smaller_unit())
+        speed_factor = _float_val(Speed(1, speed_unit).to_smaller_unit())
+        for point in points:
+            yield "{:.1f}, {}".format(point.pos / pos_factor, \
+                point.speed / speed_factor)
+        return
+    for point in points:
+        # round so that e.g. 49.99999999999999 displays as 50.0
+        # using HasUnit introduces rounding error, so that's compensating
+        # sort of
+        # on second thought, I will use fractions.Fraction for the
+        # conversion
+        yield "{:.1f}, {}".format(point.pos.to_bigger_unit().val(), \
+            point.speed.to_bigger_unit().val())
+
+def gen_column_output_lines(columns):
+    """gen_output_lines() for PosSpeedColumns: each column is converted to
+    the big units in one go"""
+    pos = columns.pos.to_bigger_unit().values()
+    speed = columns.speed.to_bigger_unit().values()
+    for p, v in zip(pos, speed):
+        yield "{:.1f}, {}".format(p, v)
+
+def _simulate_section(track, accel, resolution, units, engine, numeric):
+    """Runs in a worker process for Simulation.run_partitioned()"""
+    sim = Simulation(track, accel, resolution, units, engine, numeric)
+    sim.run()
+    return sim.get_best_speeds()
 
 class Simulation:
-    def __init__(self, filename, accel, resolution, units):
+    # "step" drives Train one resolution at a time, "analytic" uses
+    # KinematicSolver, "numpy" uses EnvelopeSolver
+    ENGINES = ("step", "analytic", "numpy")
+    # "exact" simulates with Fraction-backed Pos/Speed, "float" with plain
+    # floats in the small units
+    NUMERICS = ("exact", "float", "fixed")
+    # The numeric modes' profiles count as equal when they have the same
+    # points, each pos and speed agreeing to within FLOAT_RTOL relatively or
+    # FLOAT_ATOL (f or m, f/s or m/s) absolutely. See profiles_match().
+    FLOAT_RTOL = 1e-9
+    FLOAT_ATOL = 1e-9
+    # part of every resultcache key: bump it whenever any engine's output
+    # changes, so stored results from before aren't used
+    ENGINE_VERSION = 1
+
+    # filename can also be an already-loaded Track (in units' units), which
+    # is then simulated without re-reading anything. profiler, a
+    # profiling.Profiler, gets the time spent in each phase and the steps.
+    # cache is a trackcache.TrackCache to load filename through. results is
+    # a resultcache.ResultCache that run() looks in before simulating and
+    # stores its profile in after.
+    def __init__(self, filename, accel, resolution, units, engine="step",
+            numeric="exact", profiler=None, cache=None, results=None):
         assert accel > 0
         assert resolution > 0 and resolution % 1 == 0 # more generic than is int
         assert units in ["imperial", "metric"] # there must be a more generic way
+        if engine not in self.ENGINES:
+            raise ValueError("engine '{}' must be one of {}".format(engine,
+                self.ENGINES))
+        if numeric not in self.NUMERICS:
+            raise ValueError("numeric '{}' must be one of {}".format(numeric,
+                self.NUMERICS))
         self._units = units
+        self._accel = accel
         self._resolution = resolution
-        self._track = Track(filename, self._units)
-        self._train = Train(self._track, accel, self._resolution)
+        self._engine = engine
+        self._numeric = numeric
+        self._profiler = profiler
+        with self._phase("load"):
+            self._init_engine(filename, cache)
+        self._results = results
+        self._result_key = None
+        if results is not None:
+            if isinstance(filename, Track):
+                source = results.track_source(self._track)
+            else:
+                with open(filename, "rb") as f:
+                    source = f.read()
+            self._result_key = results.key(source, units, accel, resolution,
+                    engine, numeric, self.ENGINE_VERSION)
         self._best_speeds = []
+        self._columns = None
+
+    def _init_engine(self, filename, cache):
+        """Loads the track and sets up the engine for it"""
+        accel = self._accel
+        if isinstance(filename, Track):
+            # already parsed, e.g. shared between many runs
+            self._track = filename
+        else:
+            self._track = Track(filename, self._units, cache)
+
+        if self._track.FLOAT_VALUED and self._numeric != "float":
+            raise ValueError("a float-valued track needs numeric 'float'")
+        if self._numeric == "float":
+            # everything the engines see from here on is a plain float
+            if self._track.FLOAT_VALUED:
+                sim_track = self._track
+            else:
+                sim_track = FloatTrack(self._track)
+            accel = _float_val(accel)
+            resolution = _float_val(self._resolution)
+            train_type = FloatTrain
+        elif self._numeric == "fixed":
+            # integer positions and bounded-denominator speeds; run() converts
+            # the result back to the small units
+            fixed = FIXED_UNITS[self._units]
+            sim_track = FixedTrack(self._track, self._units)
+            accel = accel.convert_to(fixed["accel"])
+            resolution = FixedTrack.fixed_pos(self._resolution, fixed["pos"])
+            if resolution.convert_to(self._resolution.unit()) != \
+                    self._resolution:
+                raise ValueError("resolution {} isn't a whole number of {}"\
+                        .format(self._resolution, fixed["pos"]))
+            train_type = FixedTrain
+        else:
+            sim_track = self._track
+            resolution = self._resolution
+            train_type = Train
+
+        if self._engine == "step":
+            self._train = train_type(sim_track, accel, resolution)
+        elif self._engine == "analytic":
+            self._solver = KinematicSolver(sim_track, accel, resolution,
+                    self._numeric)
+        elif self._engine == "numpy":
+            self._solver = EnvelopeSolver(sim_track, accel, resolution,
+                    self._numeric)
+
+    def _phase(self, name):
+        if self._profiler is None:
+            return nullcontext()
+        return self._profiler.phase(name)
+
+    def _count(self, name, n):
+        if self._profiler is not None:
+            self._profiler.count(name, n)
+
+    def get_best_speeds(self):
+        """PosSpeeds computed by run(), in the small units (Pos/Speed in
+        "exact" mode, floats in "float" mode)"""
+        return self._best_speeds
+
+    def get_profile_columns(self):
+        """The profile as PosSpeedColumns of float QuantityArrays in the small
+        units, from run() or run_columnar()"""
+        if self._columns is None:
+            pos_unit = system_to_unit(self._units, "pos", "small")
+            speed_unit = system_to_unit(self._units, "speed", "small")
+            self._columns = PosSpeedColumns(
+                    QuantityArray(Pos, (_float_val(ps.pos) \
+                        for ps in self._best_speeds), pos_unit),
+                    QuantityArray(Speed, (_float_val(ps.speed) \
+                        for ps in self._best_speeds), speed_unit))
+        return self._columns
+
+    def get_run_time_index(self):
+        """RunTimeIndex over the profile computed by run(), for running time,
+        speed and position queries"""
+        from runtimes import RunTimeIndex
+        return RunTimeIndex(self._best_speeds, self._units,
+                next(reversed(self._track)).get_end())
+
+    @classmethod
+    def profiles_match(cls, best_a, best_b, rtol=None, atol=None):
+        """Whether two profiles from get_best_speeds() count as equal under
+        the FLOAT_RTOL/FLOAT_ATOL tolerance, whatever their numeric modes"""
+        from math import isclose
+        if rtol is None:
+            rtol = cls.FLOAT_RTOL
+        if atol is None:
+            atol = cls.FLOAT_ATOL
+        if len(best_a) != len(best_b):
+            return False
+        for a, b in zip(best_a, best_b):
+            if not isclose(_float_val(a.pos), _float_val(b.pos), rel_tol=rtol,
+                    abs_tol=atol):
+                return False
+            if not isclose(_float_val(a.speed), _float_val(b.speed),
+                    rel_tol=rtol, abs_tol=atol):
+                return False
+        return True
 
     def run(self):
+        self._columns = None
+        if self._stored_result():
+            return
+        self._run()
+        self._store_result()
+
+    def _stored_result(self):
+        """Takes the profile from the result cache if it's there"""
+        if self._results is None:
+            return False
+        with self._phase("results"):
+            best_speeds = self._results.get(self._result_key)
+        if best_speeds is None:
+            self._count("result misses", 1)
+            return False
+        self._count("result hits", 1)
+        self._best_speeds = best_speeds
+        return True
+
+    def _store_result(self):
+        if self._results is None:
+            return
+        evictions = self._results.evictions
+        with self._phase("results"):
+            self._results.put(self._result_key, self._best_speeds,
+                    self._units, self._numeric)
+        self._count("result evictions", self._results.evictions - evictions)
+
+    def _run(self):
+        if self._engine == "numpy":
+            # merges both passes itself, so the passes aren't separate phases
+            with self._phase("solve"):
+                self._best_speeds = self._solver.best_speeds()
+                self._from_fixed_units()
+            self._count("steps", 2 * self._solver.get_points())
+            return
 
-        fwd_best_speeds = self._gen_best_speeds_dir("+")
+        with self._phase("forward"):
+            fwd_best_speeds = self._gen_best_speeds_dir("+")
         
-        rev_best_speeds = self._gen_best_speeds_dir("-")
+        with self._phase("reverse"):
+            rev_best_speeds = self._gen_best_speeds_dir("-")
+        self._count("steps", len(fwd_best_speeds) + len(rev_best_speeds))
 
         # note: all of that up there generated duplicate PosSpeeds for 0-length 
         # segments
         # we will need to fix this when building self._best_speeds
 
-        lastps = None
-        for paired in zip(fwd_best_speeds, reversed(rev_best_speeds)):
-            assert paired[0].pos == paired[1].pos
-            ps = PosSpeed(paired[0].pos, min(paired[0].speed, \
-                paired[1].speed))
-            if (lastps is None or (ps.pos != lastps.pos or ps.speed != lastps.speed)):
-                self._best_speeds.append(ps)
-            lastps = ps
+        with self._phase("merge"):
+            lastps = None
+            for paired in zip(fwd_best_speeds, reversed(rev_best_speeds)):
+                assert paired[0].pos == paired[1].pos
+                ps = PosSpeed(paired[0].pos, min(paired[0].speed, \
+                    paired[1].speed))
+                if (lastps is None or (ps.pos != lastps.pos or ps.speed != lastps.speed)):
+                    self._best_speeds.append(ps)
+                lastps = ps
+            self._from_fixed_units()
+
+    def _from_fixed_units(self):
+        """In the "fixed" mode, puts the profile back in the small units (the
+        values stay Fractions with bounded denominators)"""
+        if self._numeric != "fixed":
+            return
+        pos_unit = system_to_unit(self._units, "pos", "small")
+        speed_unit = system_to_unit(self._units, "speed", "small")
+        # as Fractions, since converting an int would give a float
+        self._best_speeds = [PosSpeed(
+            Pos(Fraction(ps.pos._val), ps.pos.unit()).convert_to(pos_unit),
+            Speed(Fraction(ps.speed._val), ps.speed.unit()).convert_to(
+                speed_unit)) for ps in self._best_speeds]
             
-    def output(self):
-        for point in self._best_speeds:
-            # round so that e.g. 49.99999999999999 displays as 50.0
-            # using HasUnit introduces rounding error, so that's compensating
-            # sort of
-            # on second thought, I will use fractions.Fraction for the
-            # conversion
-            print("{:.1f}, {}".format(point.pos.to_bigger_unit().val(), \
-                point.speed.to_bigger_unit().val()))
-    
+    def run_columnar(self):
+        """Like run(), but keeps the profile only as get_profile_columns()
+        rather than a PosSpeed (and Pos and Speed) per point. The numpy
+        engine never builds the PosSpeeds at all."""
+        if self._engine == "numpy" and self._numeric != "fixed":
+            pos, speed = self._solver.best_columns()
+            self._columns = PosSpeedColumns(
+                    QuantityArray(Pos, pos,
+                        system_to_unit(self._units, "pos", "small")),
+                    QuantityArray(Speed, speed,
+                        system_to_unit(self._units, "speed", "small")))
+        else:
+            self.run()
+            self.get_profile_columns()
+        self._best_speeds = []
+
+    def run_partitioned(self, max_workers=None):
+        """Same result as run(), but splits the track at its stops and
+        simulates the sections concurrently on a process pool (max_workers
+        defaults to the number of CPUs), then stitches them back together"""
+        sections = self._track.split_at_stops()
+        if len(sections) == 1:
+            self.run()
+            return
+        self._columns = None
+        if self._stored_result():
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        import os
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        n = len(sections)
+        with ProcessPoolExecutor(max_workers=min(max_workers, n)) as pool:
+            profiles = pool.map(_simulate_section, sections, [self._accel]*n,
+                    [self._resolution]*n, [self._units]*n, [self._engine]*n,
+                    [self._numeric]*n)
+            for profile in profiles:
+                if len(self._best_speeds) > 0:
+                    # both sides of a stop report it
+                    assert self._best_speeds[-1] == profile[0]
+                    profile = profile[1:]
+                self._best_speeds.extend(profile)
+        self._store_result()
+
+    def output(self, out=None, fmt="csv"):
+        """Writes the profile to out (default stdout) in fmt, one of
+        writers.FORMATS. out has to be a binary file for "binary"."""
+        from writers import write_profile
+        import sys
+        if out is None:
+            out = sys.stdout.buffer if fmt == "binary" else sys.stdout
+        with self._phase("output"):
+            if len(self._best_speeds) == 0 and self._columns is not None:
+                # after run_columnar(); values are floats whatever the mode
+                write_profile(out, fmt, self._units, self._numeric,
+                        columns=self._columns, track=self._track)
+            else:
+                write_profile(out, fmt, self._units, self._numeric,
+                        self._best_speeds, track=self._track)
+
     def _gen_best_speeds_dir(self, direction):
         assert direction=="+" or direction=="-"
+        if self._engine == "analytic":
+            return self._solver.gen_best_speeds_dir(direction)
         best = []
         self._train.set_dir(direction)
         while not self._train.at_end_of_track():
@@ -418,3 +1452,216 @@ class Simulation:
         return best
         
 
+
+
+import unittest
+
+class TestEngines(unittest.TestCase):
+    def setUp(self):
+        self.accel = Accel(1.25, "f/s^2")
+        self.res = Pos(528, "f")
+
+    def _run(self, filename, engine):
+        sim = Simulation(filename, self.accel, self.res, "imperial", engine)
+        sim.run()
+        return sim._best_speeds
+
+    def test_matches_step_engine(self):
+        for filename in ("limits.csv", "short_maxspeeds.csv",
+                "sprinter_maxspeeds_stations.csv"):
+            stepped = self._run(filename, "step")
+            solved = self._run(filename, "analytic")
+            self.assertEqual(len(stepped), len(solved))
+            for s, a in zip(stepped, solved):
+                self.assertEqual(s.pos, a.pos)
+                # only float rounding in the sqrt should differ
+                self.assertAlmostEqual(float(s.speed.val()),
+                        float(a.speed.val()), places=9)
+
+    def test_speed_limits_exact(self):
+        # capped points should be the segments' own (exact) speeds
+        solved = self._run("limits.csv", "analytic")
+        self.assertEqual(solved[2].speed, Speed('20', "mi/h").to_sm())
+        self.assertEqual(solved[-3].speed, Speed('25', "mi/h").to_sm())
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_numpy_matches_step_engine(self):
+        for filename in ("limits.csv", "short_maxspeeds.csv",
+                "sprinter_maxspeeds_stations.csv"):
+            stepped = self._run(filename, "step")
+            envelope = self._run(filename, "numpy")
+            self.assertEqual(len(stepped), len(envelope))
+            for s, n in zip(stepped, envelope):
+                self.assertEqual(s.pos, n.pos)
+                self.assertAlmostEqual(float(s.speed.val()),
+                        float(n.speed.val()), places=9)
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_numpy_zero_length_segs(self):
+        # 0-length segs that aren't stops used to give the numpy engine an
+        # extra point each
+        import os, tempfile
+        from benchmark import write_synthetic_maxspeeds
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "synthetic.csv")
+            write_synthetic_maxspeeds(filename, 300, seed=10,
+                    stop_density=0.05, zero_len_mix=0.3)
+            stepped = self._run(filename, "step")
+            for numeric in Simulation.NUMERICS:
+                sim = Simulation(filename, self.accel, self.res, "imperial",
+                        "numpy", numeric)
+                sim.run()
+                envelope = sim.get_best_speeds()
+                self.assertEqual(len(envelope), len(stepped), numeric)
+                for s, n in zip(stepped, envelope):
+                    self.assertAlmostEqual(float(s.pos.val()),
+                            _float_val(n.pos), places=6)
+                    self.assertAlmostEqual(float(s.speed.val()),
+                            _float_val(n.speed), places=5)
+
+    def test_float_matches_exact(self):
+        exact = self._run("sprinter_maxspeeds_stations.csv", "step")
+        engines = ["step", "analytic"]
+        if numpy is not None:
+            engines.append("numpy")
+        for engine in engines:
+            sim = Simulation("sprinter_maxspeeds_stations.csv", self.accel,
+                    self.res, "imperial", engine, "float")
+            sim.run()
+            self.assertIsInstance(sim.get_best_speeds()[1].speed, float)
+            self.assertTrue(Simulation.profiles_match(exact,
+                sim.get_best_speeds()), engine)
+
+    def test_fixed_matches_exact(self):
+        exact = self._run("sprinter_maxspeeds_stations.csv", "step")
+        engines = ["step", "analytic"]
+        if numpy is not None:
+            engines.append("numpy")
+        for engine in engines:
+            sim = Simulation("sprinter_maxspeeds_stations.csv", self.accel,
+                    self.res, "imperial", engine, "fixed")
+            sim.run()
+            # back in f and f/s, with small denominators
+            for ps in sim.get_best_speeds():
+                self.assertEqual(ps.pos.unit(), "f")
+                self.assertEqual(1000 % ps.pos._val.denominator, 0)
+                self.assertLessEqual(ps.speed._val.denominator,
+                        FIXED_SPEED_DENOMINATOR**2)
+            # speeds are rounded to a millionth of a f/s
+            self.assertTrue(Simulation.profiles_match(exact,
+                sim.get_best_speeds(), 0, 1e-6), engine)
+
+    def test_fixed_rounding_doesnt_build_up(self):
+        # many short steps between limits; the step engine used to round
+        # each one from the last one's rounded speed
+        import os, tempfile
+        from benchmark import write_synthetic_maxspeeds
+        res = Pos(66, "f")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "synthetic.csv")
+            write_synthetic_maxspeeds(filename, 200, seed=0,
+                    zero_len_mix=0.2)
+            exact = Simulation(filename, self.accel, res, "imperial", "step")
+            exact.run()
+            fixed = Simulation(filename, self.accel, res, "imperial", "step",
+                    "fixed")
+            fixed.run()
+        self.assertEqual(len(exact.get_best_speeds()),
+                len(fixed.get_best_speeds()))
+        # each point rounded once: half a millionth of a f/s
+        for e, f in zip(exact.get_best_speeds(), fixed.get_best_speeds()):
+            self.assertLessEqual(abs(float(e.speed._val - f.speed._val)),
+                    0.5e-6 + 1e-9)
+
+    def test_resolution_flag(self):
+        # an -r value used to become a float Pos, which can't be compared
+        # with the track's
+        conf = Config(["trainspeedsim", "short_maxspeeds.csv", "-r", "264"])
+        sim = Simulation(conf.infile, conf.accel, conf.res, conf.units)
+        sim.run()
+        self.assertEqual(sim.get_best_speeds()[1].pos,
+                Pos('10.15', "mi").to_smaller_unit())
+
+    def test_batch_flags(self):
+        conf = Config(["trainspeedsim", "short_maxspeeds.csv"])
+        self.assertFalse(conf.batch)
+        conf = Config(["trainspeedsim", "short_maxspeeds.csv", "limits.csv",
+            "-j", "2"])
+        self.assertTrue(conf.batch)
+        self.assertEqual((conf.infile, conf.infiles, conf.jobs),
+                (None, ["short_maxspeeds.csv", "limits.csv"], 2))
+        self.assertTrue(Config(["trainspeedsim", "*.csv"]).batch)
+        for argv in (["a.csv", "b.csv", "-s"], ["a.csv", "-"],
+                ["a.csv", "b.csv", "-f", "binary"],
+                ["a.csv", "-d", "out", "-o", "all.csv"],
+                ["a.csv", "-j", "0"], ["a.csv", "-a", "-1"],
+                ["a.csv", "-a", "x"], ["a.csv", "-r", "0"],
+                ["a.csv", "-r", "0.5"]):
+            with self.assertRaises(ArgvError):
+                Config(["trainspeedsim"] + argv)
+
+    def test_profiler(self):
+        from profiling import Profiler
+        steps = set()
+        for engine in Simulation.ENGINES:
+            if engine == "numpy" and numpy is None:
+                continue
+            with Profiler() as profiler:
+                sim = Simulation("short_maxspeeds.csv", self.accel, self.res,
+                        "imperial", engine, profiler=profiler)
+                sim.run()
+            report = profiler.report()
+            if engine == "numpy":
+                self.assertEqual(list(report["phases"]), ["load", "solve"])
+            else:
+                self.assertEqual(list(report["phases"]), ["load", "forward",
+                    "reverse", "merge"])
+            self.assertGreater(report["counters"]["HasUnit"], 0)
+            steps.add(report["counters"]["steps"])
+        # every engine takes the same steps
+        self.assertEqual(len(steps), 1)
+        with self.assertRaises(ArgvError):
+            Config(["trainspeedsim", "short_maxspeeds.csv", "-P", "xml"])
+
+    def test_partitioned_matches_run(self):
+        for numeric in Simulation.NUMERICS:
+            whole = Simulation("sprinter_maxspeeds_stations.csv", self.accel,
+                    self.res, "imperial", "analytic", numeric)
+            whole.run()
+            parted = Simulation("sprinter_maxspeeds_stations.csv",
+                    self.accel, self.res, "imperial", "analytic", numeric)
+            parted.run_partitioned(2)
+            self.assertEqual(whole.get_best_speeds(),
+                    parted.get_best_speeds())
+
+    def test_split_at_stops(self):
+        track = Track("limits.csv", "imperial")
+        sections = track.split_at_stops()
+        self.assertEqual(len(sections), 2)
+        self.assertEqual(sections[0].get_first_seg().get_start(),
+                Pos('99.3', "mi").to_sm())
+        self.assertEqual(sections[1].get_first_seg(), TrackSeg(0,
+            Pos('99.6', "mi").to_sm(), Pos('99.6', "mi").to_sm(),
+            Speed('0', "mi/h").to_sm()))
+
+    def test_profile_columns(self):
+        for engine in ("analytic", "numpy"):
+            sim = Simulation("sprinter_maxspeeds_stations.csv", self.accel,
+                    self.res, "imperial", engine, "float")
+            sim.run()
+            columns = sim.get_profile_columns()
+            self.assertEqual(columns.pos.unit(), "f")
+            self.assertEqual(len(columns.pos), len(sim.get_best_speeds()))
+            self.assertEqual(list(gen_column_output_lines(columns)),
+                    list(gen_output_lines(sim.get_best_speeds(), "imperial",
+                        "float")))
+            # same columns without keeping the PosSpeeds
+            columnar = Simulation("sprinter_maxspeeds_stations.csv",
+                    self.accel, self.res, "imperial", engine, "float")
+            columnar.run_columnar()
+            self.assertEqual(columnar.get_best_speeds(), [])
+            self.assertEqual(columnar.get_profile_columns(), columns)
+
+    def test_bad_engine(self):
+        with self.assertRaises(ValueError):
+            Simulation("limits.csv", self.accel, self.res, "imperial", "warp")
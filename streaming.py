@@ -0,0 +1,228 @@
+#! /usr/bin/python3
+
+from simulation import Simulation, Track, PosSpeed, gen_output_lines, \
+    _float_val, _float_seg_point
+from convunits import Speed
+from collections import deque
+from math import sqrt, inf
+import sys
+
+class StreamingSimulation:
+    '''Simulates a maxspeeds file as it is read, yielding each PosSpeed as
+    soon as the braking envelope can no longer change it. Gives the same
+    profile as Simulation.run() (to within Simulation.FLOAT_RTOL), but only
+    ever holds the points within braking distance of the end of what has
+    been read so far.
+
+    Works on the same points as the other engines, in v^2. Point k's forward
+    speed comes from the seg arriving at it, its reverse speed from the seg
+    leaving it (i.e. point k+1's):
+        fwd[k] = min(limit[k], fwd[k-1] + 2a*d[k])
+        rev[k] = min(limit[k+1], rev[k+1] + 2a*d[k+1])
+    Whatever comes after the last point read can't bring rev[k] below 2a
+    times the distance to that point, so once min(fwd[k], rev[k]) is at most
+    that, point k is final.'''
+
+    def __init__(self, infile, accel, resolution, units, numeric="exact"):
+        '''infile is a filename, "-" for stdin, or an open file'''
+        assert accel > 0
+        assert resolution > 0 and resolution % 1 == 0
+        assert units in ["imperial", "metric"]
+        if numeric not in ("exact", "float"):
+            raise ValueError("numeric '{}' must be exact or float".format(
+                numeric))
+        self._infile = infile
+        self._resolution = resolution
+        self._units = units
+        self._numeric = numeric
+        self._two_a = 2.0 * _float_val(accel)
+        self._res_f = _float_val(resolution)
+        # points not yet final, each [pos, limit^2, 2a*d, seg speed, fwd^2]
+        self._pending = deque()
+        self._fwd = 0.0 # train starts out stopped
+        self._last = None # last PosSpeed yielded, for de-duplicating
+        self._last_best = None # and its speed^2 as worked out
+        self._max_pending = 0
+
+    def get_max_pending(self):
+        '''Most points held at once so far (the lookahead actually needed)'''
+        return self._max_pending
+
+    def run(self):
+        '''Generates the final PosSpeeds in order'''
+        if self._infile == "-":
+            yield from self._run_file(sys.stdin)
+        elif isinstance(self._infile, str):
+            with open(self._infile, "r") as maxspeeds_file:
+                yield from self._run_file(maxspeeds_file)
+        else:
+            yield from self._run_file(self._infile)
+
+    def output(self):
+        '''Prints each point as soon as it is final'''
+        for line in gen_output_lines(self.run(), self._units, self._numeric):
+            print(line, flush=True)
+
+    def _run_file(self, maxspeeds_file):
+        segs = Track.gen_segs(Track.gen_raw_maxspeeds(maxspeeds_file),
+                self._units)
+        first = True
+        for seg in segs:
+            if first:
+                assert seg.get_speed() == 0, "track must start at speed 0"
+                first = False
+            self._add_seg(seg)
+            self._max_pending = max(self._max_pending, len(self._pending))
+            yield from self._finalize()
+        assert not first, "there must be at least one track segment"
+        # like every engine, the very end of the track isn't a point of its
+        # own, but the train is stopped there, which the last points brake
+        # for
+        yield from self._finalize(self._pending.pop())
+
+    def _add_seg(self, seg):
+        start = seg.get_start()
+        end = seg.get_end()
+        speed = seg.get_speed()
+        if self._numeric == "float":
+            start, end, speed = _float_val(start), _float_val(end), \
+                    _float_val(speed)
+        limit = _float_val(speed)**2
+        if seg.length() == 0:
+            self._fwd = min(limit, self._fwd)
+            self._pending.append([start, limit, 0.0, speed, self._fwd])
+            return
+
+        if self._numeric == "float":
+            steps = round((end - start) / self._res_f)
+        else:
+            assert seg.length() % self._resolution == 0
+            steps = int(seg.length().val() / self._resolution.val())
+        step = self._two_a * self._res_f
+        pos = start
+        for j in range(1, steps + 1):
+            if self._numeric == "float":
+                pos = _float_seg_point(start, end, j, steps, self._res_f)
+            else:
+                pos = pos + self._resolution
+            self._fwd = min(limit, self._fwd + step)
+            self._pending.append([pos, limit, step, speed, self._fwd])
+
+    def _finalize(self, end_point=None):
+        '''Yields the points at the front of _pending that are now final.
+        end_point is the end of the track once it has been read.'''
+        pending = self._pending
+        n = len(pending)
+        # sweep back from the newest point working out each one's rev and
+        # distance (as 2a*d) to the newest point read, then go forwards
+        # yielding points until one isn't final
+        revs = [0.0] * n
+        slack = [0.0] * n
+        if end_point is None:
+            rev = inf # nothing known past the newest point
+        else:
+            rev = 0.0
+        room = 0.0
+        next_point = end_point
+        for k in range(n - 1, -1, -1):
+            if next_point is not None:
+                rev = min(next_point[1], rev + next_point[2])
+                room += next_point[2]
+            revs[k] = rev
+            slack[k] = room
+            next_point = pending[k]
+
+        done = 0
+        for k in range(n):
+            best = min(pending[k][4], revs[k])
+            # the newest point might turn out to be the end of the track,
+            # which is never yielded
+            if end_point is None and (k == n - 1 or best > slack[k]):
+                break
+            if k + 1 < n:
+                next_point = pending[k+1]
+            else:
+                next_point = end_point
+            yield from self._emit(pending[k], best, next_point)
+            done += 1
+        for k in range(done):
+            pending.popleft()
+
+    def _emit(self, point, best, next_point):
+        pos, limit, step, speed, fwd = point
+        if self._last is not None and best == self._last_best and \
+                pos == self._last.pos:
+            # a 0-length seg's point: the same speed as the one before it,
+            # even if it'd come out as another Speed (e.g. one side's limit
+            # rather than a sqrt)
+            return
+        if best == limit:
+            out_speed = speed
+        elif next_point is not None and best == next_point[1]:
+            out_speed = next_point[3]
+        elif self._numeric == "float":
+            out_speed = sqrt(best)
+        else:
+            out_speed = Speed(str(sqrt(best)), speed.unit())
+        ps = PosSpeed(pos, out_speed)
+        if self._last is None or ps.pos != self._last.pos or \
+                ps.speed != self._last.speed:
+            self._last = ps
+            self._last_best = best
+            yield ps
+
+
+import unittest
+
+class TestStreamingSimulation(unittest.TestCase):
+    def setUp(self):
+        from convunits import Pos, Accel
+        self.accel = Accel(1.25, "f/s^2")
+        self.res = Pos(528, "f")
+
+    def test_matches_simulation(self):
+        for numeric in ("exact", "float"):
+            sim = Simulation("sprinter_maxspeeds_stations.csv", self.accel,
+                    self.res, "imperial", "step", numeric)
+            sim.run()
+            stream = StreamingSimulation("sprinter_maxspeeds_stations.csv",
+                    self.accel, self.res, "imperial", numeric)
+            self.assertTrue(Simulation.profiles_match(sim.get_best_speeds(),
+                list(stream.run())))
+
+    def test_zero_length_segs(self):
+        # 0-length segs that aren't stops used to give an extra point in
+        # exact mode
+        import os, tempfile
+        from benchmark import write_synthetic_maxspeeds
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "synthetic.csv")
+            write_synthetic_maxspeeds(filename, 300, seed=10,
+                    stop_density=0.05, zero_len_mix=0.3)
+            for numeric in ("exact", "float"):
+                sim = Simulation(filename, self.accel, self.res, "imperial",
+                        "step", numeric)
+                sim.run()
+                stream = StreamingSimulation(filename, self.accel, self.res,
+                        "imperial", numeric)
+                streamed = list(stream.run())
+                self.assertEqual(len(streamed), len(sim.get_best_speeds()))
+                self.assertTrue(Simulation.profiles_match(
+                    sim.get_best_speeds(), streamed))
+
+    def test_incremental(self):
+        with open("sprinter_maxspeeds_stations.csv") as f:
+            lines = f.readlines()
+        read = []
+        def feed():
+            for line in lines:
+                read.append(line)
+                yield line
+        stream = StreamingSimulation(feed(), self.accel, self.res,
+                "imperial")
+        points = stream.run()
+        next(points)
+        # first point out long before the file is all read
+        self.assertLess(len(read), len(lines) // 4)
+        list(points)
+        self.assertEqual(len(read), len(lines))
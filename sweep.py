@@ -0,0 +1,122 @@
+#! /usr/bin/python3
+
+from simulation import Simulation, Track
+from convunits import Pos, Accel
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+
+# best_speeds is None and error the exception if that combination failed
+SweepResult = namedtuple("SweepResult", ["best_speeds", "wall_time",
+    "cpu_time", "worker", "error"])
+
+# each worker process gets its own copy of the parsed Track once, through
+# _init_worker(), rather than with every task
+_worker_track = None
+
+def _init_worker(track):
+    global _worker_track
+    _worker_track = track
+
+def _simulate(units, engine, numeric, accel, resolution):
+    '''Runs in a worker process. accel and resolution are plain numbers in
+    units' small units (f/s^2 and f, or m/s^2 and m)'''
+    accel_unit = {"imperial": "f/s^2", "metric": "m/s^2"}
+    dist_unit = {"imperial": "f", "metric": "m"}
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        # str() so they're exact Fractions, like values read from a file
+        sim = Simulation(_worker_track, Accel(str(accel), accel_unit[units]),
+                Pos(str(resolution), dist_unit[units]), units, engine,
+                numeric)
+        sim.run()
+        best_speeds = sim.get_best_speeds()
+        error = None
+    except Exception as e:
+        best_speeds = None
+        error = e
+    return SweepResult(best_speeds, time.perf_counter() - wall_start,
+            time.process_time() - cpu_start, os.getpid(), error)
+
+class ParameterSweep:
+    '''Simulates one Track for many (acceleration, resolution) pairs. The
+    Track is parsed once and the pairs are spread over a process pool.'''
+
+    def __init__(self, filename, units, engine="step", numeric="exact"):
+        assert units in ["imperial", "metric"]
+        self._units = units
+        self._engine = engine
+        self._numeric = numeric
+        if isinstance(filename, Track):
+            self._track = filename
+        else:
+            self._track = Track(filename, units)
+        self._results = {}
+        self._wall_time = None
+        self._workers = None
+
+    def run(self, accels, resolutions, max_workers=None):
+        '''Simulates every combination of accels and resolutions (numbers in
+        the small units). Returns {(accel, resolution): SweepResult}.
+        max_workers defaults to the number of CPUs.'''
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self._workers = max_workers
+        params = [(a, r) for a in accels for r in resolutions]
+
+        wall_start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=max_workers,
+                initializer=_init_worker, initargs=(self._track,)) as pool:
+            futures = {p: pool.submit(_simulate, self._units, self._engine,
+                self._numeric, *p) for p in params}
+            self._results = {p: f.result() for p, f in futures.items()}
+        self._wall_time = time.perf_counter() - wall_start
+        return self._results
+
+    def get_results(self):
+        return self._results
+
+    def output(self):
+        '''Prints per-task timings, then the totals to compare for scaling
+        across cores'''
+        print("accel, resolution, wall s, cpu s, worker, error")
+        for (accel, res), r in self._results.items():
+            print("{}, {}, {:.4f}, {:.4f}, {}, {}".format(accel, res,
+                r.wall_time, r.cpu_time, r.worker,
+                "" if r.error is None else repr(r.error)))
+        task_time = sum(r.wall_time for r in self._results.values())
+        print("{} tasks on {} workers: {:.4f} s wall, {:.4f} s summed task "\
+                "time, speedup {:.2f}".format(len(self._results),
+                self._workers, self._wall_time, task_time,
+                task_time / self._wall_time if self._wall_time else 0))
+
+
+import unittest
+
+class TestParameterSweep(unittest.TestCase):
+    def test_matches_single_runs(self):
+        sweep = ParameterSweep("short_maxspeeds.csv", "imperial", "analytic")
+        results = sweep.run([1.25, 2], [264, 528], max_workers=2)
+        self.assertEqual(set(results), {(1.25, 264), (1.25, 528), (2, 264),
+            (2, 528)})
+        sim = Simulation("short_maxspeeds.csv", Accel('2', "f/s^2"),
+                Pos('264', "f"), "imperial", "analytic")
+        sim.run()
+        self.assertIsNone(results[(2, 264)].error)
+        self.assertTrue(Simulation.profiles_match(sim.get_best_speeds(),
+            results[(2, 264)].best_speeds, 0, 0))
+
+    def test_bad_resolution(self):
+        # 10.1 mi isn't a multiple of 1000 f
+        sweep = ParameterSweep("short_maxspeeds.csv", "imperial", "analytic")
+        results = sweep.run([1.25], [1000], max_workers=1)
+        self.assertIsNone(results[(1.25, 1000)].best_speeds)
+        self.assertIsInstance(results[(1.25, 1000)].error, AssertionError)
+
+if __name__ == "__main__":
+    sweep = ParameterSweep("sprinter_maxspeeds_stations.csv", "imperial",
+            "analytic")
+    sweep.run([1.0, 1.25, 1.5, 2.0], [66, 132, 264, 528])
+    sweep.output()
@@ -0,0 +1,250 @@
+#! /usr/bin/python3
+
+# Compiled tracks: a maxspeeds file's segs, already in the small units, as
+# exact numerators and denominators in a binary file. Named after the hash of
+# the source's contents, so an edited file just gets a new one.
+#
+#   trainspeedsim precompile [-u imperial|metric] [-c CACHE_DIR] DIR|FILE...
+
+from simulation import Track, TrackSeg
+from convunits import Pos, Speed, system_to_unit
+from fractions import Fraction
+import hashlib
+import io
+import os
+import struct
+import sys
+import tempfile
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+        "trainspeedsim")
+
+class TrackCache:
+    '''Directory of compiled tracks. load() returns a maxspeeds file's segs,
+    from the compiled track when there is one for the file's current
+    contents, or else parsing the file and compiling it for next time.
+
+    A compiled track is a header (MAGIC, FORMAT_VERSION, units, seg count)
+    then a record per seg of start, end and speed, each as a numerator and
+    denominator (little-endian int64s) in the small units. A track with a
+    value too big for that is never compiled, just parsed every time.'''
+
+    MAGIC = b"TSTRACK\0"
+    FORMAT_VERSION = 1
+    _UNITS = ("imperial", "metric")
+    _header = struct.Struct("<8sBBQ")
+    _record = struct.Struct("<6q")
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("TRAINSPEEDSIM_CACHE",
+                    DEFAULT_CACHE_DIR)
+        self._dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, source, units):
+        '''Where the compiled track for source's contents (bytes) goes'''
+        digest = hashlib.sha256(source).hexdigest()
+        return os.path.join(self._dir, "{}-{}.tstrack".format(digest, units))
+
+    def load(self, filename, units):
+        '''filename's TrackSegs in the small units, like
+        Track._load_maxspeeds()'''
+        assert units in self._UNITS
+        with open(filename, "rb") as f:
+            source = f.read()
+        path = self.path_for(source, units)
+        try:
+            with open(path, "rb") as f:
+                segs = self._decode(f.read(), units)
+            self.hits += 1
+            return segs
+        except (FileNotFoundError, ValueError):
+            # not compiled yet, or not by this version
+            pass
+        self.misses += 1
+        return self._compile(source, path, units)
+
+    def compile(self, filename, units):
+        '''Compiles filename if it isn't already. Returns the compiled
+        track's path, or None if the track can't be compiled.'''
+        with open(filename, "rb") as f:
+            source = f.read()
+        path = self.path_for(source, units)
+        if not os.path.exists(path):
+            self._compile(source, path, units)
+        return path if os.path.exists(path) else None
+
+    def _compile(self, source, path, units):
+        segs = list(Track.gen_segs(Track.gen_raw_maxspeeds(
+            io.StringIO(source.decode())), units))
+        self._write(path, segs, units)
+        return segs
+
+    def _write(self, path, segs, units):
+        data = bytearray(self._header.pack(self.MAGIC, self.FORMAT_VERSION,
+            self._UNITS.index(units), len(segs)))
+        try:
+            for seg in segs:
+                start = Fraction(seg.get_start()._val)
+                end = Fraction(seg.get_end()._val)
+                speed = Fraction(seg.get_speed()._val)
+                data += self._record.pack(start.numerator, start.denominator,
+                        end.numerator, end.denominator, speed.numerator,
+                        speed.denominator)
+        except struct.error:
+            return # doesn't fit in int64s
+        os.makedirs(self._dir, exist_ok=True)
+        # written under another name then renamed, so a reader never sees
+        # half a file
+        fd, tmp = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _decode(self, data, units):
+        if len(data) < self._header.size:
+            # empty, or cut short while being written by something else
+            raise ValueError("not a compiled {} track".format(units))
+        magic, version, units_index, count = self._header.unpack_from(data)
+        if magic != self.MAGIC or version != self.FORMAT_VERSION or \
+                units_index != self._UNITS.index(units) or \
+                len(data) != self._header.size + count * self._record.size:
+            raise ValueError("not a compiled {} track".format(units))
+        pos_unit = system_to_unit(units, "pos", "small")
+        speed_unit = system_to_unit(units, "speed", "small")
+        # one seg's end is the next one's start, and there are few distinct
+        # speeds, so each value is made into a Pos or Speed only once
+        positions = {}
+        speeds = {}
+        segs = []
+        records = self._record.iter_unpack(memoryview(data)[
+            self._header.size:])
+        for i, (sn, sd, en, ed, vn, vd) in enumerate(records):
+            # TrackSeg's checks, on the ints, once the denominators are
+            # known to be positive
+            if sd <= 0 or ed <= 0 or vd <= 0:
+                raise ValueError("invalid seg {} in compiled track".format(i))
+            if sn * ed > en * sd or vn < 0 or \
+                    (vn == 0 and (sn, sd) != (en, ed)):
+                raise ValueError("invalid seg {} in compiled track".format(i))
+            start = positions.get((sn, sd))
+            if start is None:
+                start = positions[sn, sd] = Pos(Fraction(sn, sd), pos_unit)
+            end = positions.get((en, ed))
+            if end is None:
+                end = positions[en, ed] = Pos(Fraction(en, ed), pos_unit)
+            speed = speeds.get((vn, vd))
+            if speed is None:
+                speed = speeds[vn, vd] = Speed(Fraction(vn, vd), speed_unit)
+            segs.append(TrackSeg._unchecked(i, start, end, speed))
+        return segs
+
+def gen_maxspeeds_files(paths):
+    '''Files named in paths, and the .csv files in any directories there'''
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".csv"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def main(argv):
+    '''trainspeedsim precompile: argv[0] is "precompile"'''
+    units = "imperial"
+    cache_dir = None
+    paths = []
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in ("-u", "--units"):
+            units = next(args, None)
+            if units not in TrackCache._UNITS:
+                sys.stderr.write('-u must be "imperial" or "metric"\n')
+                return 2
+        elif arg in ("-c", "--cache"):
+            cache_dir = next(args, None)
+        else:
+            paths.append(arg)
+    if len(paths) == 0:
+        sys.stderr.write("trainspeedsim precompile [-u imperial|metric] "\
+                "[-c CACHE_DIR] DIR|FILE...\n")
+        return 2
+
+    cache = TrackCache(cache_dir)
+    failed = 0
+    for filename in gen_maxspeeds_files(paths):
+        try:
+            path = cache.compile(filename, units)
+        except Exception as e:
+            sys.stderr.write("{}: {}\n".format(filename, e))
+            failed += 1
+            continue
+        print("{} -> {}".format(filename, path))
+    return 1 if failed else 0
+
+
+import unittest
+
+class TestTrackCache(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = TrackCache(tmpdir)
+            for units in TrackCache._UNITS:
+                parsed = list(Track("sprinter_maxspeeds_stations.csv", units))
+                self.assertEqual(cache.load("sprinter_maxspeeds_stations.csv",
+                    units), parsed)
+                loaded = cache.load("sprinter_maxspeeds_stations.csv", units)
+                self.assertEqual(loaded, parsed)
+                self.assertEqual([type(seg.get_speed()._val) \
+                        for seg in loaded], [Fraction] * len(loaded))
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            track = Track("sprinter_maxspeeds_stations.csv", "metric", cache)
+            self.assertEqual(list(track), parsed)
+            self.assertEqual(cache.hits, 3)
+
+    def test_changed_source(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "track.csv")
+            cache = TrackCache(os.path.join(tmpdir, "cache"))
+            with open("short_maxspeeds.csv") as f:
+                lines = f.readlines()
+            with open(filename, "w") as f:
+                f.writelines(lines)
+            before = cache.load(filename, "imperial")
+            # a different speed limit on the second seg
+            lines[1] = lines[1].split("\t")[0] + "\t5\n"
+            with open(filename, "w") as f:
+                f.writelines(lines)
+            after = cache.load(filename, "imperial")
+            self.assertEqual(cache.misses, 2)
+            self.assertNotEqual(before[1].get_speed(), after[1].get_speed())
+            self.assertEqual(len(os.listdir(os.path.join(tmpdir, "cache"))),
+                    2)
+
+    def test_damaged_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = TrackCache(tmpdir)
+            parsed = cache.load("short_maxspeeds.csv", "imperial")
+            with open("short_maxspeeds.csv", "rb") as f:
+                path = cache.path_for(f.read(), "imperial")
+            with open(path, "rb") as f:
+                data = f.read()
+            # zero denominator in the first seg's start
+            zero_den = bytearray(data)
+            zero_den[TrackCache._header.size+8:TrackCache._header.size+16] = \
+                    bytes(8)
+            for damaged in (b"", data[:5], bytes(zero_den)):
+                with open(path, "wb") as f:
+                    f.write(damaged)
+                self.assertEqual(cache.load("short_maxspeeds.csv",
+                    "imperial"), parsed)
+            self.assertEqual(cache.misses, 4)
+
+if __name__ == "__main__":
+    sys.exit(main(["precompile"] + sys.argv[1:]))
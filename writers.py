@@ -0,0 +1,200 @@
+#! /usr/bin/python3
+
+# Writing a whole profile out in one of FORMATS. Each chunk of CHUNK points
+# is converted to the big units a column at a time and written with one
+# write() call, rather than a print() (and two convert_to()s) per point.
+
+from convunits import Pos, Speed, QuantityArray, system_to_unit
+from fractions import Fraction
+from decimal import Decimal
+from math import floor, ceil
+
+FORMATS = ("csv", "jsonl", "binary", "gnuplot")
+# points converted and written at a time
+CHUNK = 65536
+
+def write_profile(out, fmt, units, numeric, best_speeds=None, columns=None,
+        track=None):
+    '''Writes a profile, given as best_speeds (PosSpeeds as from
+    Simulation.get_best_speeds()) or columns (PosSpeedColumns), to out.
+    out is a text file, except for "binary", which needs a binary one.
+
+    csv is what Simulation.output() has always printed: milepost to 0.1 and
+    speed, in the big units. jsonl is a {"pos": ..., "speed": ...} object
+    per line, also in the big units, at full precision. binary is a
+    mapped.ColumnarFile of track and profile. gnuplot is a script plotting
+    the track's speed limits and the profile, as gnuplot.txt did by hand.
+    binary and gnuplot need the track.'''
+    if fmt not in FORMATS:
+        raise ValueError("format '{}' must be one of {}".format(fmt,
+            FORMATS))
+    if fmt in ("binary", "gnuplot") and track is None:
+        raise ValueError("format '{}' needs the track".format(fmt))
+    if fmt == "binary":
+        from mapped import write_columnar
+        if columns is None:
+            columns = _to_columns(best_speeds, units)
+        write_columnar(out, track, units, columns)
+        return
+
+    chunks = gen_big_chunks(units, numeric, best_speeds, columns)
+    if fmt == "csv":
+        for pos, speed in chunks:
+            out.write("".join(["{:.1f}, {}\n".format(p, v) \
+                    for p, v in zip(pos, speed)]))
+    elif fmt == "jsonl":
+        for pos, speed in chunks:
+            out.write("".join(['{{"pos": {}, "speed": {}}}\n'.format(
+                _json_number(p), _json_number(v)) \
+                for p, v in zip(pos, speed)]))
+    elif fmt == "gnuplot":
+        _write_gnuplot(out, units, chunks, track)
+
+def gen_big_chunks(units, numeric, best_speeds=None, columns=None):
+    '''Generates (positions, speeds) in the big units, CHUNK points at a
+    time: floats from columns or in "float" mode, otherwise each exactly as
+    to_bigger_unit().val() would give it'''
+    pos_small = system_to_unit(units, "pos", "small")
+    speed_small = system_to_unit(units, "speed", "small")
+    if columns is not None:
+        pos = columns.pos.convert_to(pos_small).to_bigger_unit().values()
+        speed = columns.speed.convert_to(speed_small).to_bigger_unit()\
+                .values()
+        for i in range(0, len(pos), CHUNK):
+            yield pos[i:i+CHUNK], speed[i:i+CHUNK]
+        return
+    if numeric == "float":
+        # dividing by the big unit's size, as gen_output_lines() does
+        pos_div = float(1 / Pos._factor(pos_small, Pos._bigger[pos_small]))
+        speed_div = float(1 / Speed._factor(speed_small,
+            Speed._bigger[speed_small]))
+    else:
+        pos_factor = Pos._factor(pos_small, Pos._bigger[pos_small])
+        speed_factor = Speed._factor(speed_small, Speed._bigger[speed_small])
+    for i in range(0, len(best_speeds), CHUNK):
+        chunk = best_speeds[i:i+CHUNK]
+        if numeric == "float":
+            yield [ps.pos / pos_div for ps in chunk], \
+                    [ps.speed / speed_div for ps in chunk]
+        else:
+            yield _big_exact([ps.pos._val for ps in chunk], pos_factor), \
+                    _big_exact([ps.speed._val for ps in chunk], speed_factor)
+
+def _big_floats(quantity_type, vals, unit):
+    return QuantityArray(quantity_type, vals, unit).to_bigger_unit().values()
+
+def _big_exact(vals, factor):
+    """What to_bigger_unit().val() gives for each of vals, by factor. For a
+    Fraction that's Decimal(numerator) / denominator of val * factor. The
+    product's numerator and denominator needn't be in lowest terms for that
+    (the division rounds the same either way), so skipping the Fraction
+    saves a gcd per value."""
+    fn, fd = factor.numerator, factor.denominator
+    return [Decimal(v.numerator * fn) / (v.denominator * fd) \
+            if isinstance(v, Fraction) else v * fn / fd for v in vals]
+
+def _json_number(v):
+    # a Decimal's str() is already a JSON number ("25", "1E+1"); a float's
+    # repr() is the shortest one that reads back the same
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+def _to_columns(best_speeds, units):
+    from simulation import PosSpeedColumns, _float_val
+    return PosSpeedColumns(
+            QuantityArray(Pos, (_float_val(ps.pos) for ps in best_speeds),
+                system_to_unit(units, "pos", "small")),
+            QuantityArray(Speed, (_float_val(ps.speed) for ps in best_speeds),
+                system_to_unit(units, "speed", "small")))
+
+def _write_gnuplot(out, units, chunks, track):
+    '''gnuplot.txt's plot as a script: the limits drawn "with steps" from the
+    start of each seg (and the end of the last), the profile "with lines",
+    mileposts from a mile before the start to a mile past the end, speeds
+    from 0 to the next multiple of 5 above the highest limit'''
+    from simulation import _float_val
+    segs = list(track)
+    pos_small = system_to_unit(units, "pos", "small")
+    speed_small = system_to_unit(units, "speed", "small")
+    limit_pos = _big_floats(Pos, [_float_val(seg.get_start()) \
+            for seg in segs] + [_float_val(segs[-1].get_end())], pos_small)
+    limits = _big_floats(Speed, [_float_val(seg.get_speed()) \
+            for seg in segs] + [_float_val(segs[-1].get_speed())],
+            speed_small)
+    # a whole limit isn't always a whole float after converting
+    top = 5 * floor(round(max(limits), 6) / 5) + 5
+
+    out.write("# speed limits and best speeds; gnuplot -p this_file\n")
+    out.write("set xtics 1\nset ytics 5\n")
+    out.write("$limits << EOD\n")
+    out.write("".join(["{} {}\n".format(p, v) \
+            for p, v in zip(limit_pos, limits)]))
+    out.write("EOD\n$profile << EOD\n")
+    for pos, speed in chunks:
+        out.write("".join(["{} {}\n".format(p, v) \
+                for p, v in zip(pos, speed)]))
+    out.write("EOD\n")
+    out.write("plot [{}:{}] [0:{}] $limits with steps title \"speed limit\", "\
+            "$profile with lines title \"best speed\"\n".format(
+                floor(limit_pos[0]) - 1, ceil(limit_pos[-1]) + 1, top))
+
+
+import unittest
+
+class TestWriters(unittest.TestCase):
+    def setUp(self):
+        from simulation import Simulation
+        from convunits import Accel
+        self.sims = {}
+        for numeric in ("exact", "float"):
+            sim = Simulation("sprinter_maxspeeds_stations.csv",
+                    Accel(1.25, "f/s^2"), Pos(528, "f"), "imperial",
+                    "analytic", numeric)
+            sim.run()
+            self.sims[numeric] = sim
+
+    def test_csv_matches_print(self):
+        import io
+        from simulation import gen_output_lines
+        for numeric, sim in self.sims.items():
+            out = io.StringIO()
+            write_profile(out, "csv", "imperial", numeric,
+                    sim.get_best_speeds())
+            self.assertEqual(out.getvalue(), "".join(line + "\n" \
+                    for line in gen_output_lines(sim.get_best_speeds(),
+                        "imperial", numeric)))
+
+    def test_formats(self):
+        import io
+        import json
+        import os
+        import tempfile
+        from mapped import ColumnarFile
+        from simulation import Simulation
+        sim = self.sims["float"]
+        best = sim.get_best_speeds()
+        out = io.StringIO()
+        write_profile(out, "jsonl", "imperial", "float", best)
+        points = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(points), len(best))
+        self.assertEqual(points[2], {"pos": 99.5, "speed": 25.0})
+
+        out = io.StringIO()
+        write_profile(out, "gnuplot", "imperial", "float", best,
+                track=sim._track)
+        script = out.getvalue()
+        self.assertIn("set xtics 1\nset ytics 5\n", script)
+        self.assertTrue(script.endswith("plot [98:123] [0:55] $limits with "\
+                "steps title \"speed limit\", $profile with lines title "\
+                "\"best speed\"\n"))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "profile.tscols")
+            with open(filename, "wb") as f:
+                write_profile(f, "binary", "imperial", "exact",
+                        self.sims["exact"].get_best_speeds(),
+                        track=sim._track)
+            with ColumnarFile(filename) as f:
+                self.assertTrue(Simulation.profiles_match(
+                    list(f.get_profile()), best))